@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+import threading
+
+# How many stops past the last matched one are tested on each ping
+LOOKAHEAD_STOPS = 3
+# Every N pings scan the whole route anyway, to re-anchor after a GPS gap skipped stops
+FULL_SCAN_EVERY = 30
+
+
+class SessionArrivals:
+    """Arrival state for one driver session: {stop_id: arrived_at} and the furthest matched stop index"""
+
+    def __init__(self, arrivals: Dict[int, datetime]):
+        self.arrivals = arrivals
+        self.route_version: Optional[int] = None
+        self.last_index = -1
+        self.pings = 0
+        self.lock = threading.Lock()
+
+    def sync_route(self, route_version: int, stop_ids: List[Optional[int]]) -> None:
+        """Recompute last_index after (re)compiling the route, e.g. an admin edit or a restart"""
+        if self.route_version == route_version:
+            return
+        self.route_version = route_version
+        self.last_index = -1
+        for idx, stop_id in enumerate(stop_ids):
+            if stop_id in self.arrivals:
+                self.last_index = idx
+
+    def candidate_indices(self, n_stops: int) -> range:
+        """Stop indices worth testing for this ping"""
+        self.pings += 1
+        if self.last_index < 0 or self.pings % FULL_SCAN_EVERY == 0:
+            return range(n_stops)
+        start = self.last_index + 1
+        return range(start, min(n_stops, start + LOOKAHEAD_STOPS))
+
+    def mark(self, idx: int, stop_id: int, arrived_at: datetime) -> None:
+        self.arrivals[stop_id] = arrived_at
+        self.last_index = max(self.last_index, idx)
+
+
+class ArrivalTracker:
+    """
+    Process-wide session_id -> SessionArrivals map (LRU-bounded).
+    State is rebuilt lazily from the stop_arrivals table the first time a session is seen.
+    """
+
+    def __init__(self, max_sessions: int = 2000):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, SessionArrivals]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: int, loader: Callable[[int], Dict[int, datetime]]) -> SessionArrivals:
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                return state
+        state = SessionArrivals(loader(session_id))
+        with self._lock:
+            state = self._sessions.setdefault(session_id, state)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return state
+
+    def preload(self, session_ids: List[int], loader: Callable[[List[int]], Dict[int, Dict[int, datetime]]]) -> None:
+        """Load every session not tracked yet with one loader call (batch warm-up)"""
+        with self._lock:
+            missing = [session_id for session_id in set(session_ids) if session_id not in self._sessions]
+        if not missing:
+            return
+        for session_id, arrivals in loader(missing).items():
+            self.get(session_id, lambda _: arrivals)
+
+    def peek(self, session_id: int) -> Optional[SessionArrivals]:
+        return self._sessions.get(session_id)
+
+    def forget(self, session_id: int) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+
+# Global arrival tracker instance
+arrival_tracker = ArrivalTracker()
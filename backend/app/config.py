@@ -19,6 +19,51 @@ class Settings(BaseSettings):
     # Leave empty to auto-detect from request
     frontend_url: str = os.getenv("FRONTEND_URL", "")
 
+    # Write-behind for GPS pings: queue Location rows in memory and flush them in batches
+    # instead of committing once per ping. Off by default.
+    location_write_behind: bool = os.getenv("LOCATION_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+    location_queue_size: int = int(os.getenv("LOCATION_QUEUE_SIZE", "10000"))
+    location_flush_batch_size: int = int(os.getenv("LOCATION_FLUSH_BATCH_SIZE", "200"))
+    location_flush_interval_seconds: float = float(os.getenv("LOCATION_FLUSH_INTERVAL_SECONDS", "1.0"))
+
+    # Driver session token cache (0 TTL disables it)
+    session_cache_ttl_seconds: float = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "300"))
+    session_cache_max_size: int = int(os.getenv("SESSION_CACHE_MAX_SIZE", "5000"))
+    # Compiled routes and computed stop ETAs kept per process (least recently used buses evicted)
+    route_cache_max_size: int = int(os.getenv("ROUTE_CACHE_MAX_SIZE", "2000"))
+    eta_cache_max_size: int = int(os.getenv("ETA_CACHE_MAX_SIZE", "2000"))
+
+    # Threads for DB work from async handlers (keep <= the SQLAlchemy pool size on Postgres)
+    db_thread_pool_size: int = int(os.getenv("DB_THREAD_POOL_SIZE", "8"))
+
+    # Outgoing WebSocket frames buffered per passenger; a client that falls this far behind is dropped
+    ws_send_queue_size: int = int(os.getenv("WS_SEND_QUEUE_SIZE", "32"))
+    # Server heartbeat to sockets the client has not written to, and how long a socket may send nothing (no pong) before it is reaped
+    ws_heartbeat_seconds: int = int(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+    ws_idle_timeout_seconds: float = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "60"))
+    # Per-bus broadcast conflation window: bursts inside it collapse to the latest location/delay/stops, kept in publish order (0 disables)
+    ws_conflation_ms: int = int(os.getenv("WS_CONFLATION_MS", "500"))
+    # Server-Sent Events: broadcasts kept per bus for Last-Event-ID resume (keep below WS_SEND_QUEUE_SIZE),
+    # and how long they are kept after the bus's last connection closes
+    sse_replay_size: int = int(os.getenv("SSE_REPLAY_SIZE", "24"))
+    sse_replay_idle_seconds: float = float(os.getenv("SSE_REPLAY_IDLE_SECONDS", "60"))
+
+    # Cross-worker WebSocket fan-out: "memory" (single process) or "broker" (uvicorn --workers N).
+    # Broker address: unix:///path/to.sock or tcp://127.0.0.1:8765; empty picks a platform default
+    ws_pubsub_backend: str = os.getenv("WS_PUBSUB_BACKEND", "memory")
+    ws_pubsub_address: str = os.getenv("WS_PUBSUB_ADDRESS", "")
+
+    # Historical segment travel times (aggregated from stop_arrivals in the background) replace the
+    # scheduled minutes in ETAs for segments with at least eta_history_min_samples trips in the bucket
+    eta_history_enabled: bool = os.getenv("ETA_HISTORY_ENABLED", "true").lower() in ("1", "true", "yes")
+    eta_history_refresh_seconds: float = float(os.getenv("ETA_HISTORY_REFRESH_SECONDS", "60"))
+    eta_history_bucket_minutes: int = int(os.getenv("ETA_HISTORY_BUCKET_MINUTES", "30"))
+    eta_history_min_samples: int = int(os.getenv("ETA_HISTORY_MIN_SAMPLES", "3"))
+
+    # HTTP caching of the passenger status/stops endpoints (ETag revalidation in between)
+    passenger_cache_max_age_seconds: int = int(os.getenv("PASSENGER_CACHE_MAX_AGE_SECONDS", "5"))
+    passenger_cache_stale_seconds: int = int(os.getenv("PASSENGER_CACHE_STALE_SECONDS", "15"))
+
     class Config:
         env_file = ".env"
 
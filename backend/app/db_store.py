@@ -1,21 +1,19 @@
 from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 import bcrypt
+import json
+import numpy as np
 
+from .geometry import haversine_km, cumulative_distances_km
 from .models import Bus, DriverSession, Location, DelayInfo, Route, Stop, StopArrival
 from .config import settings
-
-def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Distance between two points in km."""
-    import math
-    R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
+from .location_writer import location_writer
+from .route_cache import CompiledRoute, route_cache
+from .arrival_tracker import arrival_tracker
+from .live_state import live_state
+from . import state_sync
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -57,6 +55,11 @@ class DatabaseStore:
 
     def get_session(self, token: str) -> Optional[str]:
         """Get bus_number from session token"""
+        info = self.get_session_info(token)
+        return info["bus_number"] if info else None
+
+    def get_session_info(self, token: str) -> Optional[Dict]:
+        """Get bus_number, session_id and expires_at for an active session token"""
         session = self.db.query(DriverSession).filter(
             DriverSession.token == token,
             DriverSession.is_active == True,
@@ -66,89 +69,179 @@ class DatabaseStore:
         if not session:
             return None
 
-        return session.bus_number
+        return {
+            "bus_number": session.bus_number,
+            "session_id": session.session_id,
+            "expires_at": session.expires_at,
+        }
 
-    def save_location(self, bus_number: str, latitude: float, longitude: float, recorded_at: datetime) -> Dict:
-        """Save location update"""
-        # Get active session for this bus (optional, for tracking)
+    def _active_session_id(self, bus_number: str) -> Optional[int]:
+        """Latest active session for this bus (used when the caller did not resolve one)"""
         session = self.db.query(DriverSession).filter(
             DriverSession.bus_number == bus_number,
             DriverSession.is_active == True
         ).order_by(DriverSession.started_at.desc()).first()
+        return session.session_id if session else None
 
-        location = Location(
-            bus_number=bus_number,
-            session_id=session.session_id if session else None,
-            latitude=latitude,
-            longitude=longitude,
-            recorded_at=recorded_at,
-        )
-        self.db.add(location)
-        self.db.commit()
-        self.db.refresh(location)
+    def save_location(
+        self, bus_number: str, latitude: float, longitude: float, recorded_at: datetime,
+        session_id: Optional[int] = None,
+    ) -> Dict:
+        """Save location update. Pass session_id when already known to skip the session lookup."""
+        if session_id is None:
+            session_id = self._active_session_id(bus_number)
+
+        if settings.location_write_behind:
+            location_writer.enqueue([{
+                "bus_number": bus_number,
+                "session_id": session_id,
+                "latitude": latitude,
+                "longitude": longitude,
+                "recorded_at": recorded_at,
+            }])
+        else:
+            location = Location(
+                bus_number=bus_number,
+                session_id=session_id,
+                latitude=latitude,
+                longitude=longitude,
+                recorded_at=recorded_at,
+            )
+            self.db.add(location)
+            self.db.commit()
+            self.db.refresh(location)
+        state_sync.location_updated(bus_number, latitude, longitude, recorded_at, session_id)
 
         return {
             "latitude": latitude,
             "longitude": longitude,
             "recorded_at": recorded_at,
-            "session_id": session.session_id if session else None,
+            "session_id": session_id,
         }
 
+    def save_locations(self, bus_number: str, fixes: List[Dict], session_id: Optional[int] = None) -> List[Dict]:
+        """Save a batch of location updates in one transaction (bulk insert)"""
+        if session_id is None:
+            session_id = self._active_session_id(bus_number)
+
+        rows = [
+            {
+                "bus_number": bus_number,
+                "session_id": session_id,
+                "latitude": fix["latitude"],
+                "longitude": fix["longitude"],
+                "recorded_at": fix["recorded_at"],
+            }
+            for fix in fixes
+        ]
+        if settings.location_write_behind:
+            location_writer.enqueue(rows)
+        else:
+            self.db.execute(insert(Location), rows)
+            self.db.commit()
+        if rows:
+            newest = max(rows, key=lambda row: row["recorded_at"])
+            state_sync.location_updated(bus_number, newest["latitude"], newest["longitude"], newest["recorded_at"], session_id)
+
+        return [
+            {
+                "latitude": row["latitude"],
+                "longitude": row["longitude"],
+                "recorded_at": row["recorded_at"],
+                "session_id": session_id,
+            }
+            for row in rows
+        ]
+
     def record_stop_arrivals_if_near(
         self, bus_number: str, session_id: Optional[int],
         latitude: float, longitude: float, recorded_at: datetime
     ) -> None:
         """If bus is within 20m of any stop not yet recorded for this session, record arrival."""
+        self.record_stop_arrivals_for_fixes(bus_number, session_id, [
+            {"latitude": latitude, "longitude": longitude, "recorded_at": recorded_at},
+        ])
+
+    def record_stop_arrivals_for_fixes(self, bus_number: str, session_id: Optional[int], fixes: List[Dict]) -> None:
+        """Record stop arrivals for an ordered list of fixes. Only stops just ahead of the last
+        arrival are tested; new arrivals are written in one commit."""
+        if session_id is None or not fixes:
+            return
         try:
-            if session_id is None:
-                return
-            stops_raw = self.get_stops_for_bus(bus_number)
+            route = self.get_compiled_route(bus_number)
+            stops_raw = route.stops()
             if not stops_raw:
                 return
-            arrived_stop_ids = {
-                a.stop_id for a in self.db.query(StopArrival).filter(
-                    StopArrival.session_id == session_id
-                ).all()
-            }
-            for stop in stops_raw:
-                stop_id = stop.get("stop_id")
-                if stop_id is None or stop_id in arrived_stop_ids:
-                    continue
-                lat, lon = stop.get("latitude"), stop.get("longitude")
-                if lat is None or lon is None:
-                    continue
-                dist_km = _haversine_km(latitude, longitude, lat, lon)
-                if dist_km <= 0.02:  # 20 meters
-                    self.db.add(StopArrival(session_id=session_id, stop_id=stop_id, arrived_at=recorded_at))
-                    self.db.commit()
-                    arrived_stop_ids.add(stop_id)
+            state = arrival_tracker.get(session_id, self._load_stop_arrivals)
+            new_rows = []
+            with state.lock:
+                state.sync_route(route.version, [s.get("stop_id") for s in stops_raw])
+                for fix in fixes:
+                    for idx in state.candidate_indices(len(stops_raw)):
+                        stop = stops_raw[idx]
+                        stop_id = stop.get("stop_id")
+                        if stop_id is None or stop_id in state.arrivals:
+                            continue
+                        lat, lon = stop.get("latitude"), stop.get("longitude")
+                        if lat is None or lon is None:
+                            continue
+                        dist_km = haversine_km(fix["latitude"], fix["longitude"], lat, lon)
+                        if dist_km <= 0.02:  # 20 meters
+                            state.mark(idx, stop_id, fix["recorded_at"])
+                            new_rows.append(StopArrival(session_id=session_id, stop_id=stop_id, arrived_at=fix["recorded_at"]))
+            if new_rows:
+                self.db.add_all(new_rows)
+                self.db.commit()
+                state_sync.arrivals_recorded(bus_number, session_id)
         except Exception:
             self.db.rollback()
+            # Another worker may have written the same arrival; reload from the table next time
+            arrival_tracker.forget(session_id)
+
+    def _load_stop_arrivals(self, session_id: int) -> Dict[int, datetime]:
+        rows = self.db.query(StopArrival).filter(StopArrival.session_id == session_id).all()
+        return {r.stop_id: r.arrived_at for r in rows}
 
     def get_stop_arrivals_for_session(self, session_id: Optional[int]) -> Dict[int, datetime]:
         """Return {stop_id: arrived_at} for the given session."""
         if session_id is None:
             return {}
         try:
-            rows = self.db.query(StopArrival).filter(StopArrival.session_id == session_id).all()
-            return {r.stop_id: r.arrived_at for r in rows}
+            state = arrival_tracker.get(session_id, self._load_stop_arrivals)
+            with state.lock:
+                return dict(state.arrivals)
         except Exception:
             return {}
 
-    def get_last_location(self, bus_number: str) -> Optional[Dict]:
-        """Get most recent location for bus"""
-        location = self.db.query(Location).filter(
-            Location.bus_number == bus_number
-        ).order_by(Location.recorded_at.desc()).first()
+    def get_stop_arrival_count(self, session_id: Optional[int]) -> int:
+        """Number of stops reached in the session (arrivals only ever grow, so this versions them)"""
+        if session_id is None:
+            return 0
+        try:
+            state = arrival_tracker.get(session_id, self._load_stop_arrivals)
+            with state.lock:
+                return len(state.arrivals)
+        except Exception:
+            return 0
+
+    def get_state_version(self, bus_number: str) -> int:
+        """Version of the bus's live state; changes on every location or delay update"""
+        live_state.ensure_loaded(self.db)
+        state = live_state.get(bus_number)
+        return state["version"] if state else 0
 
-        if not location:
+    def get_last_location(self, bus_number: str) -> Optional[Dict]:
+        """Get most recent location for bus (from the in-memory live state)"""
+        live_state.ensure_loaded(self.db)
+        state = live_state.get(bus_number)
+        if not state or state["recorded_at"] is None:
             return None
 
         return {
-            "latitude": location.latitude,
-            "longitude": location.longitude,
-            "recorded_at": location.recorded_at,
-            "session_id": location.session_id,
+            "latitude": state["latitude"],
+            "longitude": state["longitude"],
+            "recorded_at": state["recorded_at"],
+            "session_id": state["session_id"],
         }
 
     def save_delay(self, bus_number: str, delay_minutes: int, current_stop: Optional[str], next_stop: Optional[str]) -> None:
@@ -168,62 +261,96 @@ class DatabaseStore:
             )
             self.db.add(delay)
         self.db.commit()
+        state_sync.delay_updated(bus_number, delay_minutes, current_stop, next_stop)
 
     def get_delay(self, bus_number: str) -> Dict:
-        """Get delay information"""
-        delay = self.db.query(DelayInfo).filter(DelayInfo.bus_number == bus_number).first()
-        if not delay:
+        """Get delay information (from the in-memory live state)"""
+        live_state.ensure_loaded(self.db)
+        state = live_state.get(bus_number)
+        if not state:
             return {"delay_minutes": 0, "current_stop": None, "next_stop": None}
         return {
-            "delay_minutes": delay.delay_minutes,
-            "current_stop": delay.current_stop,
-            "next_stop": delay.next_stop,
+            "delay_minutes": state["delay_minutes"],
+            "current_stop": state["current_stop"],
+            "next_stop": state["next_stop"],
         }
 
     def get_stops_for_bus(self, bus_number: str) -> list:
         """Get all stops for a bus's route, calculating scheduled times from start_time + scheduled_arrival_minutes"""
-        route = self.db.query(Route).filter(Route.bus_number == bus_number).first()
-        if not route:
-            return []
-        
-        # Get bus to access start_time
-        bus = self.db.query(Bus).filter(Bus.bus_number == bus_number).first()
-        start_time = bus.start_time if bus else None
-        
-        stops = self.db.query(Stop).filter(
-            Stop.route_id == route.route_id
-        ).order_by(Stop.sequence_order).all()
-        try:
-            india_tz = ZoneInfo("Asia/Kolkata")
-        except Exception:
-            india_tz = timezone(timedelta(hours=5, minutes=30))
-        result = []
-        for stop in stops:
-            # Calculate scheduled time from start_time + scheduled_arrival_minutes
-            # Use today's date + the time from start_time (since start_time is daily)
-            scheduled = None
-            if start_time and stop.scheduled_arrival_minutes is not None:
-                # start_time is stored as UTC (admin sends IST converted to UTC)
-                if start_time.tzinfo is None:
-                    start_time = start_time.replace(tzinfo=timezone.utc)
-                start_time_ist = start_time.astimezone(india_tz)
-                today = datetime.now(india_tz).replace(hour=0, minute=0, second=0, microsecond=0)
-                today_start = today.replace(hour=start_time_ist.hour, minute=start_time_ist.minute)
-                scheduled = today_start + timedelta(minutes=stop.scheduled_arrival_minutes)
-            elif stop.scheduled_arrival:
-                scheduled = stop.scheduled_arrival
-            elif stop.scheduled_departure:
-                scheduled = stop.scheduled_departure
-            
-            result.append({
-                "stop_id": stop.stop_id,
-                "name": stop.stop_name,
-                "scheduled": scheduled,
-                "latitude": stop.latitude,
-                "longitude": stop.longitude,
-                "scheduled_arrival_minutes": stop.scheduled_arrival_minutes,
-                "sequence_order": stop.sequence_order,
-            })
-        
-        return result
+        return self.get_compiled_route(bus_number).stops()
+
+    def get_compiled_route(self, bus_number: str) -> CompiledRoute:
+        """Compiled route for a bus from the process-wide cache (DB only on first use or after an admin edit)"""
+        return route_cache.get(bus_number, self._compile_route)
+
+    def _compile_route(self, bus_number: str) -> CompiledRoute:
+        return self._compile_routes([bus_number])[bus_number]
+
+    def _compile_routes(self, bus_numbers: List[str]) -> Dict[str, CompiledRoute]:
+        """Compile several routes with three queries (buses, routes, stops)"""
+        start_times = {
+            bus.bus_number: bus.start_time
+            for bus in self.db.query(Bus).filter(Bus.bus_number.in_(bus_numbers))
+        }
+        routes = {
+            route.bus_number: route
+            for route in self.db.query(Route).filter(Route.bus_number.in_(bus_numbers))
+        }
+        stops_by_route: Dict[int, List[Stop]] = {}
+        if routes:
+            for stop in self.db.query(Stop).filter(
+                Stop.route_id.in_([route.route_id for route in routes.values()])
+            ).order_by(Stop.route_id, Stop.sequence_order):
+                stops_by_route.setdefault(stop.route_id, []).append(stop)
+
+        compiled = {}
+        for bus_number in bus_numbers:
+            route = routes.get(bus_number)
+            stops = stops_by_route.get(route.route_id, []) if route else []
+
+            base_stops = [
+                {
+                    "stop_id": stop.stop_id,
+                    "name": stop.stop_name,
+                    "latitude": stop.latitude,
+                    "longitude": stop.longitude,
+                    "scheduled_arrival_minutes": stop.scheduled_arrival_minutes,
+                    "scheduled_arrival": stop.scheduled_arrival,
+                    "scheduled_departure": stop.scheduled_departure,
+                    "sequence_order": stop.sequence_order,
+                }
+                for stop in stops
+            ]
+
+            # Cumulative distance from the first stop
+            route_distances = cumulative_distances_km(
+                np.array([s["latitude"] for s in base_stops], dtype=float),
+                np.array([s["longitude"] for s in base_stops], dtype=float),
+            ).tolist()
+
+            shape = json.loads(route.shape) if route and route.shape else None
+            compiled[bus_number] = CompiledRoute(
+                bus_number, start_times.get(bus_number), base_stops, route_distances, shape,
+                known=bus_number in start_times,
+            )
+        return compiled
+
+    def preload_buses(self, bus_numbers: List[str]) -> Dict[str, CompiledRoute]:
+        """Warm the live state, route and arrival caches for many buses with a constant number
+        of queries, so per-bus reads after it (batch endpoints) never hit the DB. Returns the
+        compiled routes, including those of unknown bus numbers, which the cache does not keep."""
+        live_state.ensure_loaded(self.db)
+        routes = route_cache.get_many(bus_numbers, self._compile_routes)
+        session_ids = []
+        for bus_number in bus_numbers:
+            state = live_state.get(bus_number)
+            if state and state["session_id"] is not None:
+                session_ids.append(state["session_id"])
+        arrival_tracker.preload(session_ids, self._load_stop_arrivals_many)
+        return routes
 
+    def _load_stop_arrivals_many(self, session_ids: List[int]) -> Dict[int, Dict[int, datetime]]:
+        arrivals: Dict[int, Dict[int, datetime]] = {session_id: {} for session_id in session_ids}
+        for row in self.db.query(StopArrival).filter(StopArrival.session_id.in_(session_ids)):
+            arrivals[row.session_id][row.stop_id] = row.arrived_at
+        return arrivals
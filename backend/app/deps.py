@@ -1,21 +1,31 @@
+from typing import Dict
 from fastapi import Header, HTTPException, status, Depends
 from .database import get_db
 from .db_store import DatabaseStore
+from .session_cache import session_cache
 from sqlalchemy.orm import Session
 
 
-def get_bus_from_session(
+def get_driver_session(
     x_session_token: str = Header(...),
     db: Session = Depends(get_db)
-) -> str:
+) -> Dict:
+    """Resolve a session token to {bus_number, session_id, expires_at}, cached in memory"""
+    info = session_cache.get(x_session_token)
+    if info:
+        return info
     store = DatabaseStore(db)
-    bus_number = store.get_session(x_session_token)
-    if not bus_number:
+    info = store.get_session_info(x_session_token)
+    if not info:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired session")
-    return bus_number
+    session_cache.put(x_session_token, info)
+    return info
+
+
+def get_bus_from_session(session: Dict = Depends(get_driver_session)) -> str:
+    return session["bus_number"]
 
 
 def get_store(db: Session = Depends(get_db)):
     """Get database store instance"""
     return DatabaseStore(db)
-
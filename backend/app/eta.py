@@ -0,0 +1,410 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import time
+import numpy as np
+
+from . import schemas
+from .db_store import DatabaseStore
+from .eta_cache import eta_cache
+from .travel_times import travel_times
+from .geometry import distances_km, haversine_km_array
+
+# Fallback schedules (no start time, demo stops) are anchored to the current hour in IST or UTC;
+# both roll over on half-hour boundaries, so cached ETAs are keyed by the half hour too
+SCHEDULE_BUCKET_SECONDS = 1800
+
+
+def _fake_schedule(bus_number: str) -> list:
+    """
+    Placeholder schedule for demonstration when no database stops are available.
+    In production, this should not be used - all buses should have routes configured.
+    """
+    base = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    stops = []
+    for idx, name in enumerate(["Stop A", "Stop B", "Stop C", "Stop D"]):
+        stops.append({
+            "name": name,
+            "scheduled": base + timedelta(minutes=idx * 15),
+            "latitude": None,
+            "longitude": None,
+            "scheduled_arrival_minutes": idx * 15
+        })
+    return stops
+
+
+
+def calculate_eta_from_scheduled_times(current_lat: float, current_lon: float, stops: list, current_time: datetime, target_stop_idx: int):
+    """
+    Calculate ETA for a target stop using scheduled times and current GPS position.
+    Single-stop view of calculate_etas_from_scheduled_times; use that when ETAs for several stops are needed.
+    
+    Returns:
+        Tuple[datetime, int]: (ETA, delay_minutes) or (None, None) if calculation fails
+    """
+    if not stops or target_stop_idx < 0 or target_stop_idx >= len(stops):
+        return None, None
+    return calculate_etas_from_scheduled_times(current_lat, current_lon, stops, current_time)[target_stop_idx]
+
+
+def calculate_etas_from_scheduled_times(current_lat: float, current_lon: float, stops: list, current_time: datetime,
+                                        segment_minutes=None, route_distances: Optional[list] = None) -> list:
+    """
+    Calculate ETAs for every stop using scheduled times and current GPS position.
+    This is more accurate than using fixed speed because it uses actual route timing.
+    
+    Approach (the bus is located once; every stop then takes O(1)):
+    1. Calculate cumulative distances between consecutive stops (or take route_distances,
+       e.g. CompiledRoute.route_distances, when the caller already has them)
+    2. Find which segment (between two stops) the bus is currently in
+    3. Interpolate bus position within that segment
+    4. Use scheduled_arrival_minutes to calculate time differences between stops
+    5. Interpolate current time position based on bus position
+    6. Calculate remaining time to each stop
+    segment_minutes (see SegmentTravelTimes.segment_lookup) replaces scheduled segment durations
+    with historical ones from step 4 on.
+    
+    Returns:
+        List[Tuple[datetime, int]]: (ETA, delay_minutes) per stop, (None, None) where calculation fails
+    """
+    if not stops:
+        return []
+    if current_lat is None or current_lon is None:
+        return [(None, None)] * len(stops)
+    if route_distances is None:
+        route_distances = _compute_route_distances(stops)
+    bus_distance_from_start, current_segment_idx = _locate_bus(current_lat, current_lon, stops, route_distances)
+    return _etas_from_route_position(stops, route_distances, bus_distance_from_start, current_segment_idx, current_time, segment_minutes)
+
+
+def calculate_etas_along_shape(stops: list, stop_distances: list, bus_distance_from_start: float, current_time: datetime, segment_minutes=None) -> list:
+    """
+    calculate_etas_from_scheduled_times for a route with a road shape: the bus and the stops are
+    already placed by projecting onto the polyline (RouteShape.stop_distances / locate, km along
+    the road) instead of by their straight-line distances to the two stops of each segment.
+    """
+    if not stops:
+        return []
+    current_segment_idx = min(max(bisect_right(stop_distances, bus_distance_from_start) - 1, 0), max(len(stops) - 2, 0))
+    return _etas_from_route_position(stops, stop_distances, bus_distance_from_start, current_segment_idx, current_time, segment_minutes)
+
+
+def _etas_from_route_position(stops: list, route_distances: list, bus_distance_from_start: float, current_segment_idx: int,
+                              current_time: datetime, segment_minutes=None) -> list:
+    """Steps 4-6 of calculate_etas_from_scheduled_times, once the bus is placed on the route"""
+    # Get scheduled_arrival_minutes for all stops
+    scheduled_minutes = []
+    for stop in stops:
+        minutes = stop.get("scheduled_arrival_minutes")
+        if minutes is not None:
+            scheduled_minutes.append(minutes)
+        elif scheduled_minutes:
+            # Estimate: add 10 minutes from previous stop
+            scheduled_minutes.append(scheduled_minutes[-1] + 10)
+        else:
+            scheduled_minutes.append(0)
+    
+    # Calculate current time position (minutes from start) by interpolating within segment
+    current_minutes_from_start = None
+    progress = 0.0
+    if len(scheduled_minutes) >= 2:
+        if current_segment_idx < len(scheduled_minutes) - 1:
+            segment_start_minutes = scheduled_minutes[current_segment_idx]
+            segment_end_minutes = scheduled_minutes[current_segment_idx + 1]
+            segment_distance = route_distances[current_segment_idx + 1] - route_distances[current_segment_idx]
+            
+            if segment_distance > 0.001:
+                progress = (bus_distance_from_start - route_distances[current_segment_idx]) / segment_distance
+                progress = max(0.0, min(1.0, progress))
+                current_minutes_from_start = segment_start_minutes + (segment_end_minutes - segment_start_minutes) * progress
+            else:
+                current_minutes_from_start = segment_start_minutes
+        else:
+            # Bus is at or past last stop
+            current_minutes_from_start = scheduled_minutes[-1]
+    
+    # Typical (historical) travel times replace the scheduled durations of the segments still ahead
+    if segment_minutes is not None and current_minutes_from_start is not None and current_segment_idx < len(scheduled_minutes) - 1:
+        scheduled_minutes, current_minutes_from_start = _apply_segment_history(
+            scheduled_minutes, current_segment_idx, progress, current_time, segment_minutes
+        )
+    
+    results = []
+    for idx, target_stop in enumerate(stops):
+        if not target_stop.get("latitude") or not target_stop.get("longitude"):
+            results.append((None, None))
+        elif bus_distance_from_start >= route_distances[idx]:
+            # Bus is past target stop, ETA is immediate
+            results.append((current_time, 0))
+        elif current_minutes_from_start is None:
+            results.append((None, None))
+        else:
+            # Remaining time to target stop, and delay (ETA vs scheduled time)
+            remaining_minutes = max(0, scheduled_minutes[idx] - current_minutes_from_start)
+            eta = current_time + timedelta(minutes=remaining_minutes)
+            results.append((eta, _delay_against_schedule(eta, target_stop.get("scheduled"))))
+    return results
+
+
+def _apply_segment_history(scheduled_minutes: list, current_segment_idx: int, progress: float, current_time: datetime, segment_minutes) -> tuple:
+    """Minutes from start per stop where every segment from the bus's onwards takes its historical
+    time (looked up for when the bus will start it, falling back to the schedule), and the bus's
+    own position on that timeline"""
+    minutes = list(scheduled_minutes[:current_segment_idx + 1])
+    current_minutes_from_start = None
+    for idx in range(current_segment_idx, len(scheduled_minutes) - 1):
+        if current_minutes_from_start is None:
+            starts_at = current_time
+        else:
+            starts_at = current_time + timedelta(minutes=minutes[idx] - current_minutes_from_start)
+        duration = segment_minutes(idx, starts_at)
+        if duration is None:
+            duration = scheduled_minutes[idx + 1] - scheduled_minutes[idx]
+        minutes.append(minutes[idx] + duration)
+        if current_minutes_from_start is None:
+            current_minutes_from_start = minutes[idx] + duration * progress
+    return minutes, current_minutes_from_start
+
+
+def _delay_against_schedule(eta: datetime, target_scheduled) -> int:
+    """Whole minutes the ETA is behind the stop's scheduled time (naive schedules are IST), 0 without one"""
+    if not target_scheduled:
+        return 0
+    if isinstance(target_scheduled, str):
+        target_scheduled = datetime.fromisoformat(target_scheduled.replace('Z', '+00:00'))
+    if not isinstance(target_scheduled, datetime):
+        return 0
+    if target_scheduled.tzinfo is None:
+        try:
+            target_scheduled = target_scheduled.replace(tzinfo=ZoneInfo("Asia/Kolkata"))
+        except Exception:
+            target_scheduled = target_scheduled.replace(tzinfo=timezone(timedelta(hours=5, minutes=30)))
+    return int((eta - target_scheduled).total_seconds() / 60)
+
+
+def _status_for_delay(delay: int) -> str:
+    return "on_time" if delay <= 1 and delay >= -1 else ("delayed" if delay > 1 else "early")
+
+
+def _compute_route_distances(stops: list) -> list:
+    """Cumulative distances from start for each stop (1 km for a leg with a missing coordinate)."""
+    if not stops:
+        return []
+    lats, lons, has_coords = _stop_coordinates(stops)
+    legs = np.where(has_coords[:-1] & has_coords[1:], haversine_km_array(lats[:-1], lons[:-1], lats[1:], lons[1:]), 1.0)
+    return np.concatenate(([0.0], np.cumsum(legs))).tolist()
+
+
+def _stop_coordinates(stops: list) -> tuple:
+    """(lats, lons, has_coords) arrays for a stop list; missing coordinates become 0 with has_coords False."""
+    has_coords = np.array([bool(s.get("latitude")) and bool(s.get("longitude")) for s in stops])
+    lats = np.array([s["latitude"] if ok else 0.0 for s, ok in zip(stops, has_coords)], dtype=float)
+    lons = np.array([s["longitude"] if ok else 0.0 for s, ok in zip(stops, has_coords)], dtype=float)
+    return lats, lons, has_coords
+
+
+def _compute_bus_position(lat: float, lon: float, stops: list, route_distances: list) -> float:
+    """Bus distance from start in km, or 0 if no GPS."""
+    return _locate_bus(lat, lon, stops, route_distances)[0]
+
+
+def _locate_bus(lat: float, lon: float, stops: list, route_distances: list) -> Tuple[float, int]:
+    """(distance from start in km, index of the segment the bus is on); (0, 0) if no segment has coordinates."""
+    if not stops or not route_distances or len(stops) < 2:
+        return 0.0, 0
+    lats, lons, has_coords = _stop_coordinates(stops)
+    d = distances_km(lat, lon, lats, lons)
+    da, db = d[:-1], d[1:]
+    rd = np.asarray(route_distances[:len(stops)], dtype=float)
+    seg = rd[1:] - rd[:-1]
+    total = da + db
+    prog = np.where(total > 0.001, np.clip(da / np.where(total > 0, total, 1.0), 0.0, 1.0), 0.0)
+    bus_dists = np.where(seg > 0.001, rd[:-1] + seg * prog, rd[:-1])
+    # Segment whose nearer end is closest to the bus (first one on ties)
+    nearest_end = np.where(has_coords[:-1] & has_coords[1:], np.minimum(da, db), np.inf)
+    if not np.isfinite(nearest_end).any():
+        return 0.0, 0
+    segment = int(np.argmin(nearest_end))
+    return float(bus_dists[segment]), segment
+
+
+class _CachedEtas:
+    """Stop ETAs computed at computed_at. ETAs from the scheduled-times model are 'now + remaining',
+    so for those stops (relative: [(index, scheduled)]) the ETA moves with the clock and the delay
+    and status are re-derived from it; everything else is fixed until the inputs change."""
+
+    __slots__ = ("response", "computed_at", "relative")
+
+    def __init__(self, response: schemas.StopEtaResponse, computed_at: datetime, relative: List[Tuple[int, object]]):
+        self.response = response
+        self.computed_at = computed_at
+        self.relative = relative
+
+    def at(self, now: datetime) -> schemas.StopEtaResponse:
+        if not self.relative or now == self.computed_at:
+            return self.response
+        shift = now - self.computed_at
+        stops = list(self.response.stops)
+        for idx, scheduled in self.relative:
+            eta = stops[idx].eta + shift
+            delay = _delay_against_schedule(eta, scheduled)
+            stops[idx] = stops[idx].model_copy(update={"eta": eta, "delay_minutes": delay, "status": _status_for_delay(delay)})
+        return schemas.StopEtaResponse(bus_number=self.response.bus_number, stops=stops)
+
+
+def _india_tz():
+    try:
+        return ZoneInfo("Asia/Kolkata")
+    except Exception:
+        return timezone(timedelta(hours=5, minutes=30))
+
+
+def eta_inputs_key(store: DatabaseStore, bus_number: str) -> tuple:
+    """Everything compute_stop_etas reads that can change: live state (location, delay), compiled
+    route (admin edits recompile it), stops reached this session, the fallback schedule anchor and
+    the historical travel time table"""
+    last_location = store.get_last_location(bus_number)
+    session_id = last_location.get("session_id") if last_location else None
+    return (
+        store.get_state_version(bus_number),
+        store.get_compiled_route(bus_number).version,
+        store.get_stop_arrival_count(session_id),
+        int(time.time() // SCHEDULE_BUCKET_SECONDS),
+        travel_times.version,
+    )
+
+
+def compute_stop_etas(store: DatabaseStore, bus_number: str) -> Optional[schemas.StopEtaResponse]:
+    """ETA for all stops. Passed stops: no ETA; at_stop: 'At stop'; upcoming: ETA. None if the bus has no stops.
+    Served from eta_cache while the bus's inputs are unchanged (i.e. between driver pings)."""
+    now = datetime.now(_india_tz())
+    if not store.get_compiled_route(bus_number).known:
+        # Not in the DB: demo schedule, computed per request so unknown numbers take no cache space
+        cached = _build_stop_etas(store, bus_number, now)
+        return cached.at(now) if cached is not None else None
+    # Key first: an update landing during the computation then only causes one extra miss
+    key = eta_inputs_key(store, bus_number)
+    cached = eta_cache.get(bus_number, key)
+    if cached is None:
+        cached = _build_stop_etas(store, bus_number, now)
+        eta_cache.put(bus_number, key, cached)
+    return cached.at(now) if cached is not None else None
+
+
+def _build_stop_etas(store: DatabaseStore, bus_number: str, now: datetime) -> Optional[_CachedEtas]:
+    delay_info = store.get_delay(bus_number)
+    base_delay = delay_info.get("delay_minutes", 0)
+
+    last_location = store.get_last_location(bus_number)
+    current_lat = last_location.get("latitude") if last_location else None
+    current_lon = last_location.get("longitude") if last_location else None
+    session_id = last_location.get("session_id") if last_location else None
+
+    compiled = store.get_compiled_route(bus_number)
+    db_stops = compiled.stops()
+    schedule = db_stops if db_stops else _fake_schedule(bus_number)
+    if not schedule or len(schedule) == 0:
+        return None
+
+    india_tz = now.tzinfo
+
+    arrivals = store.get_stop_arrivals_for_session(session_id)
+    # With a road shape, distances are measured along it (stops and bus projected onto the polyline)
+    shape = compiled.shape if db_stops else None
+    if shape is not None:
+        route_distances = shape.stop_distances
+        bus_dist = shape.locate(current_lat, current_lon) if current_lat and current_lon else 0.0
+    else:
+        route_distances = compiled.route_distances if db_stops else _compute_route_distances(schedule)
+        bus_dist = _compute_bus_position(current_lat or 0, current_lon or 0, schedule, route_distances) if current_lat and current_lon else 0.0
+
+    use_scheduled_calculation = (
+        current_lat is not None and current_lon is not None and
+        len(schedule) > 0 and all(s.get("scheduled_arrival_minutes") is not None for s in schedule)
+    )
+    # ETA for every stop from one pass over the route (only the upcoming ones are used below)
+    scheduled_etas = None
+    if use_scheduled_calculation:
+        segment_minutes = travel_times.segment_lookup([s.get("stop_id") for s in schedule]) if db_stops else None
+        if shape is not None:
+            scheduled_etas = calculate_etas_along_shape(schedule, route_distances, bus_dist, now, segment_minutes)
+        else:
+            scheduled_etas = calculate_etas_from_scheduled_times(current_lat, current_lon, schedule, now, segment_minutes, route_distances)
+
+    # Distance from the bus to every stop, in one pass
+    stop_lats, stop_lons, stop_has_coords = _stop_coordinates(schedule)
+    if current_lat and current_lon:
+        dists_to_stops = np.where(stop_has_coords, distances_km(current_lat, current_lon, stop_lats, stop_lons), 999.0)
+    else:
+        dists_to_stops = np.full(len(schedule), 999.0)
+
+    stops_out = []
+    relative = []
+    for idx, entry in enumerate(schedule):
+        scheduled = entry.get("scheduled")
+        if isinstance(scheduled, datetime):
+            if scheduled.tzinfo is None:
+                scheduled = scheduled.replace(tzinfo=timezone.utc).astimezone(india_tz)
+            else:
+                scheduled = scheduled.astimezone(india_tz)
+        else:
+            scheduled = now.replace(minute=0, second=0, microsecond=0)
+
+        stop_dist = route_distances[idx] if idx < len(route_distances) else 0
+        stop_lat = entry.get("latitude")
+        stop_lon = entry.get("longitude")
+        dist_to_stop = dists_to_stops[idx]
+
+        is_passed = bus_dist >= stop_dist
+        is_at_stop = not is_passed and dist_to_stop < 0.02
+
+        actual_arrived = None
+        stop_id = entry.get("stop_id")
+        if stop_id and stop_id in arrivals:
+            actual_arrived = arrivals[stop_id]
+            if actual_arrived.tzinfo is None:
+                actual_arrived = actual_arrived.replace(tzinfo=timezone.utc).astimezone(india_tz)
+            elif actual_arrived.tzinfo != india_tz:
+                actual_arrived = actual_arrived.astimezone(india_tz)
+
+        eta = None
+        status_label = "on_time"
+        delay = base_delay
+
+        if is_passed:
+            eta = None
+            status_label = "arrived"
+            delay = 0
+        elif is_at_stop:
+            eta = None
+            status_label = "at_stop"
+            delay = 0
+        else:
+            if use_scheduled_calculation and stop_lat and stop_lon:
+                eta_result = scheduled_etas[idx]
+                if eta_result and eta_result[0]:
+                    eta, delay = eta_result
+                    status_label = _status_for_delay(delay)
+                    relative.append((idx, entry.get("scheduled")))
+                else:
+                    eta = scheduled + timedelta(minutes=base_delay)
+                    status_label = "on_time"
+            else:
+                eta = scheduled + timedelta(minutes=base_delay)
+                status_label = "on_time"
+
+        stops_out.append(
+            schemas.StopEta(
+                stop_name=entry.get("name", f"Stop {idx + 1}"),
+                scheduled_time=scheduled,
+                eta=eta,
+                actual_arrived_at=actual_arrived,
+                delay_minutes=delay,
+                status=status_label,
+                latitude=stop_lat,
+                longitude=stop_lon,
+            )
+        )
+
+    return _CachedEtas(schemas.StopEtaResponse(bus_number=bus_number, stops=stops_out), now, relative)
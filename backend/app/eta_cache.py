@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import threading
+
+from .config import settings
+
+
+class EtaCache:
+    """
+    Process-wide bus_number -> (inputs key, computed stop ETAs) cache for the passenger endpoints.
+    The key is built from the versions of everything the ETAs are computed from (live state,
+    compiled route, stop arrivals), so ingest and admin route edits invalidate an entry simply by
+    changing its inputs; a stale key is a miss and the entry is replaced. One entry per bus,
+    at most max_size buses (least recently used evicted).
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bus_number: str, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(bus_number)
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(bus_number)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, bus_number: str, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[bus_number] = (key, value)
+            self._entries.move_to_end(bus_number)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bus_number: str) -> None:
+        with self._lock:
+            self._entries.pop(bus_number, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Global ETA cache instance
+eta_cache = EtaCache(max_size=settings.eta_cache_max_size)
@@ -0,0 +1,81 @@
+"""
+Geometry helpers for GPS points and bus routes.
+Scalar haversine for one-off distances, NumPy batch versions for route work
+(one point against every stop, projection onto every segment, cumulative distance).
+"""
+import math
+from typing import Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG_LAT = math.pi * EARTH_RADIUS_KM / 180.0
+
+# Equirectangular is used below this distance; its relative error against haversine
+# stays below 1e-7 there up to 80 degrees latitude (tests/test_geometry.py)
+FAST_PATH_MAX_KM = 1.0
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance between two points in km."""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return EARTH_RADIUS_KM * c
+
+
+def haversine_km_array(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Element-wise haversine (km) over broadcastable arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def equirectangular_km_array(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Flat-earth approximation (km); only accurate for short distances."""
+    lat1, lon1, lat2, lon2 = (np.asarray(v, dtype=float) for v in (lat1, lon1, lat2, lon2))
+    x = (lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2))
+    y = lat2 - lat1
+    return KM_PER_DEG_LAT * np.hypot(x, y)
+
+
+def distances_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distance (km) from one point to each of N points.
+    Uses the equirectangular fast path, then recomputes anything beyond FAST_PATH_MAX_KM with haversine."""
+    d = equirectangular_km_array(lat, lon, lats, lons)
+    far = d > FAST_PATH_MAX_KM
+    if far.any():
+        d[far] = haversine_km_array(lat, lon, lats[far], lons[far])
+    return d
+
+
+def cumulative_distances_km(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Cumulative distance along a polyline (km), starting at 0."""
+    if len(lats) == 0:
+        return np.zeros(0)
+    legs = haversine_km_array(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    return np.concatenate(([0.0], np.cumsum(legs)))
+
+
+def to_local_xy(lats, lons, origin_lat: float, origin_lon: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Project points into a planar km frame centred on the origin."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    x = (lons - origin_lon) * KM_PER_DEG_LAT * math.cos(math.radians(origin_lat))
+    y = (lats - origin_lat) * KM_PER_DEG_LAT
+    return x, y
+
+
+def project_onto_segments(x: float, y: float, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Project a planar point onto every segment (xs[i], ys[i]) -> (xs[i+1], ys[i+1]).
+    Returns (t, dist): clamped position along each segment in [0, 1] and the distance to it (km)."""
+    dx = xs[1:] - xs[:-1]
+    dy = ys[1:] - ys[:-1]
+    seg_len2 = dx * dx + dy * dy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((x - xs[:-1]) * dx + (y - ys[:-1]) * dy) / seg_len2
+    t = np.where(seg_len2 > 0, np.clip(t, 0.0, 1.0), 0.0)
+    px = xs[:-1] + t * dx
+    py = ys[:-1] + t * dy
+    return t, np.hypot(x - px, y - py)
@@ -0,0 +1,130 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import itertools
+import threading
+
+from sqlalchemy import and_, func
+from sqlalchemy.orm import Session
+
+from .models import DelayInfo, Location
+
+_versions = itertools.count(1)
+
+
+def _as_utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+class LiveState:
+    """
+    Process-wide bus_number -> latest state table:
+    latitude, longitude, recorded_at, session_id, delay_minutes, current_stop, next_stop, version.
+    Written by the ingest path (through state_sync, which forwards every update to the other
+    workers), read by the passenger endpoints. Loaded from the DB on first use and again after
+    clear() (state_sync resync); in between a missing bus simply has no location yet.
+    """
+
+    def __init__(self):
+        self._buses: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def ensure_loaded(self, db: Session) -> None:
+        """Cold start: latest location per bus plus all delay rows, once per process (or per clear())"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            latest = db.query(
+                Location.bus_number,
+                func.max(Location.recorded_at).label("max_at"),
+            ).group_by(Location.bus_number).subquery()
+            locations = db.query(Location).join(
+                latest,
+                and_(Location.bus_number == latest.c.bus_number, Location.recorded_at == latest.c.max_at),
+            ).all()
+            for loc in locations:
+                entry = self._entry(loc.bus_number)
+                entry.update({
+                    "latitude": loc.latitude,
+                    "longitude": loc.longitude,
+                    "recorded_at": loc.recorded_at,
+                    "session_id": loc.session_id,
+                })
+            for delay in db.query(DelayInfo).all():
+                entry = self._entry(delay.bus_number)
+                entry.update({
+                    "delay_minutes": delay.delay_minutes,
+                    "current_stop": delay.current_stop,
+                    "next_stop": delay.next_stop,
+                })
+            self._loaded = True
+
+    def _entry(self, bus_number: str) -> Dict:
+        entry = self._buses.get(bus_number)
+        if entry is None:
+            entry = {
+                "bus_number": bus_number,
+                "latitude": None,
+                "longitude": None,
+                "recorded_at": None,
+                "session_id": None,
+                "delay_minutes": 0,
+                "current_stop": None,
+                "next_stop": None,
+                "version": next(_versions),
+            }
+            self._buses[bus_number] = entry
+        return entry
+
+    def update_location(
+        self, bus_number: str, latitude: float, longitude: float,
+        recorded_at: datetime, session_id: Optional[int],
+    ) -> None:
+        """Record a fix; older fixes (e.g. a late batch) never replace a newer one"""
+        with self._lock:
+            entry = self._entry(bus_number)
+            current = entry["recorded_at"]
+            if current is not None and _as_utc(recorded_at) < _as_utc(current):
+                return
+            entry.update({
+                "latitude": latitude,
+                "longitude": longitude,
+                "recorded_at": recorded_at,
+                "session_id": session_id,
+                "version": next(_versions),
+            })
+
+    def update_delay(self, bus_number: str, delay_minutes: int, current_stop: Optional[str], next_stop: Optional[str]) -> None:
+        with self._lock:
+            entry = self._entry(bus_number)
+            entry.update({
+                "delay_minutes": delay_minutes,
+                "current_stop": current_stop,
+                "next_stop": next_stop,
+                "version": next(_versions),
+            })
+
+    def get(self, bus_number: str) -> Optional[Dict]:
+        """Copy of the bus's state, or None if nothing is known"""
+        entry = self._buses.get(bus_number)
+        return dict(entry) if entry is not None else None
+
+    def all(self) -> List[Dict]:
+        """Copies of every bus's state"""
+        with self._lock:
+            return [dict(entry) for entry in self._buses.values()]
+
+    def remove(self, bus_number: str) -> None:
+        with self._lock:
+            self._buses.pop(bus_number, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buses.clear()
+            self._loaded = False
+
+
+# Global live state instance
+live_state = LiveState()
@@ -0,0 +1,203 @@
+from typing import Dict, List, Optional
+import logging
+import math
+import queue
+import threading
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .database import engine
+from .models import Location
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Wait between flush attempts while the DB refuses writes (doubles per failure)
+RETRY_BACKOFF_MIN_SECONDS = 0.5
+RETRY_BACKOFF_MAX_SECONDS = 30.0
+
+
+class WriteBehindOverflow(Exception):
+    """The queue is full and the DB is not taking writes; the ping must fail instead of being lost"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after  # Seconds until the next flush attempt, for Retry-After
+
+
+class LocationWriteBehind:
+    """
+    Write-behind buffer for Location rows.
+    Pings are queued in memory and a background thread flushes them to the
+    locations table in batches (by size or time) with one executemany per batch.
+    A failed batch is retried row by row: rows the DB rejects (e.g. their bus was deleted while
+    queued) are dropped and logged on their own, and if the DB itself is failing the rows are kept
+    and retried with backoff. When the queue fills up meanwhile, enqueue raises instead of dropping.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=max_size)
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Rows of a batch the DB failed on, written before anything still queued (under _flush_lock)
+        self._retry: List[Dict] = []
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        # Metrics
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0  # Rows the DB rejected individually
+        self.inline_flushes = 0  # Queue was full, caller flushed synchronously
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the background flusher thread"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flusher and write out everything still queued"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush(force=True)
+        unwritten = self._queue.qsize() + len(self._retry)
+        if unwritten:
+            logger.error("Location write-behind stopped with %d rows not written", unwritten)
+
+    def retry_after_seconds(self) -> int:
+        """Whole seconds until the next flush attempt while backing off (at least 1), for Retry-After"""
+        return max(1, math.ceil(self._retry_at - time.monotonic()))
+
+    def _free_slots(self) -> int:
+        # Rows waiting for a retry still hold their place, or a failing DB would never fill the queue
+        return self._queue.maxsize - self._queue.qsize() - len(self._retry)
+
+    def enqueue(self, rows: List[Dict]) -> None:
+        """Queue Location rows (dicts of column values). Flushes inline if the queue is full; raises
+        WriteBehindOverflow (queuing none of the rows) if that does not make room."""
+        if self._free_slots() < len(rows):
+            self.inline_flushes += 1
+            self.flush(force=True)
+            if self._free_slots() < len(rows):
+                raise WriteBehindOverflow(
+                    f"Location queue full ({self._queue.qsize() + len(self._retry)} rows) and the DB is not taking writes",
+                    retry_after=self.retry_after_seconds(),
+                )
+        for row in rows:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                raise WriteBehindOverflow("Location queue full", retry_after=self.retry_after_seconds())
+            self.enqueued += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def flush(self, force: bool = False) -> int:
+        """Drain the queue into the DB. Returns the number of rows written.
+        While backing off after a DB failure this is a no-op unless force is set."""
+        written = 0
+        with self._flush_lock:
+            if not force and time.monotonic() < self._retry_at:
+                return 0
+            while True:
+                batch = self._retry[:self.batch_size]
+                del self._retry[:len(batch)]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    break
+                started = time.perf_counter()
+                flushed_before = self.flushed
+                left = self._write(batch)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.flushes += 1
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                written += self.flushed - flushed_before
+                if left:
+                    self.failed_flushes += 1
+                    self._retry[:0] = left
+                    self._backoff = min(RETRY_BACKOFF_MAX_SECONDS, max(RETRY_BACKOFF_MIN_SECONDS, self._backoff * 2))
+                    self._retry_at = time.monotonic() + self._backoff
+                    break
+                self._backoff = 0.0
+                self._retry_at = 0.0
+        return written
+
+    def _write(self, batch: List[Dict]) -> List[Dict]:
+        """Insert a batch. Returns the rows still to be written: empty when done, or the rest of
+        the batch from the first row that failed for a reason other than the row itself."""
+        try:
+            with engine.begin() as conn:
+                conn.execute(Location.__table__.insert(), batch)
+            self.flushed += len(batch)
+            return []
+        except Exception as e:
+            if len(batch) == 1 and not isinstance(e, (IntegrityError, DataError)):
+                logger.warning("Location write-behind flush failed, 1 row kept for retry: %s", e)
+                return batch
+        # One row at a time, so a rejected row does not take the other buses' rows with it
+        for idx, row in enumerate(batch):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(Location.__table__.insert(), [row])
+                self.flushed += 1
+            except (IntegrityError, DataError) as e:
+                self.dropped += 1
+                logger.error("Location row dropped for bus %s at %s: %s", row.get("bus_number"), row.get("recorded_at"), e)
+            except Exception as e:
+                logger.warning("Location write-behind flush failed, %d rows kept for retry: %s", len(batch) - idx, e)
+                return batch[idx:]
+        return []
+
+    def metrics(self) -> Dict:
+        return {
+            "enabled": settings.location_write_behind,
+            "running": self.running,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "retry_depth": len(self._retry),
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "inline_flushes": self.inline_flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+# Global write-behind instance; only used when settings.location_write_behind is on
+location_writer = LocationWriteBehind(
+    max_size=settings.location_queue_size,
+    batch_size=settings.location_flush_batch_size,
+    flush_interval=settings.location_flush_interval_seconds,
+)
@@ -1,16 +1,41 @@
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from .config import settings
 from .database import engine, Base
+from .location_writer import location_writer
+from .travel_times import travel_times
+from .db_executor import shutdown_db_executor
+from .websocket_manager import websocket_manager
+from . import state_sync
 from . import models  # Ensure all models (including StopArrival) are loaded before create_all
 from .routes import auth, driver, passenger, admin
 
 # Create database tables (includes stop_arrivals if missing)
 Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Bus Tracker MVP")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.location_write_behind:
+        location_writer.start()
+    if settings.eta_history_enabled:
+        travel_times.start()
+    websocket_manager.set_sync_handler(state_sync.apply_remote)
+    await websocket_manager.start()
+    yield
+    await websocket_manager.stop()
+    travel_times.stop()
+    # Flush queued Location rows before the process exits
+    if settings.location_write_behind:
+        location_writer.stop()
+    shutdown_db_executor()
+
+
+app = FastAPI(title="Bus Tracker MVP", lifespan=lifespan)
 
 # CORS middleware - MUST be added before routes
 # allow_credentials=False allows allow_origins=["*"] (required for wildcard)
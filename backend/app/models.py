@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Boolean, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -26,6 +26,7 @@ class Route(Base):
     route_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     bus_number = Column(String, ForeignKey("buses.bus_number"), nullable=False, unique=True)
     route_name = Column(String, nullable=False)
+    shape = Column(Text, nullable=True)  # Optional road polyline, JSON [[lat, lon], ...] from first to last stop
 
     # Relationships
     stops = relationship("Stop", back_populates="route", order_by="Stop.sequence_order", cascade="all, delete-orphan")
@@ -0,0 +1,194 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone, date
+from zoneinfo import ZoneInfo
+from typing import Callable, Dict, List, Optional, Tuple
+import itertools
+import threading
+
+import numpy as np
+
+from .config import settings
+from .geometry import to_local_xy
+from .route_shape import RouteShape
+
+try:
+    INDIA_TZ = ZoneInfo("Asia/Kolkata")
+except Exception:
+    INDIA_TZ = timezone(timedelta(hours=5, minutes=30))
+
+_versions = itertools.count(1)
+
+
+class CompiledRoute:
+    """
+    Read-only route model for one bus: ordered stops, cumulative distances, planar
+    segment vectors and the scheduled timestamps for the current IST service day.
+    With a road shape (Route.shape), `shape` holds it projected into the same planar frame.
+    Built once from the DB and shared by the hot paths (delay, stop arrivals, ETAs).
+    known is False for bus numbers with no Bus row; those are never cached.
+    """
+
+    def __init__(self, bus_number: str, start_time: Optional[datetime], stops: List[Dict], route_distances: List[float],
+                 shape: Optional[List[Tuple[float, float]]] = None, known: bool = True):
+        self.bus_number = bus_number
+        self.known = known
+        self.version = next(_versions)
+        if start_time is not None and start_time.tzinfo is None:
+            start_time = start_time.replace(tzinfo=timezone.utc)
+        self.start_time = start_time  # UTC, daily reference time
+        self._base_stops = stops
+        self.route_distances = route_distances
+        self.lat_array = np.array([s["latitude"] for s in stops], dtype=float)
+        self.lon_array = np.array([s["longitude"] for s in stops], dtype=float)
+
+        # Local equirectangular frame (km) centred on the first stop
+        self.origin_lat = float(self.lat_array[0]) if stops else 0.0
+        self.origin_lon = float(self.lon_array[0]) if stops else 0.0
+        self.xs, self.ys = to_local_xy(self.lat_array, self.lon_array, self.origin_lat, self.origin_lon)
+        # segment i: stop i -> stop i + 1 as (dx, dy) in km
+        self.segment_vectors = np.column_stack((np.diff(self.xs), np.diff(self.ys)))
+
+        self.shape: Optional[RouteShape] = None
+        if shape and len(stops) >= 2:
+            self.shape = RouteShape(shape, self.lat_array, self.lon_array, self.origin_lat, self.origin_lon)
+
+        # Stop name -> first index, for compact (binary) frames that send stop positions
+        self._index_by_name: Dict[str, int] = {}
+        for idx, stop in enumerate(stops):
+            self._index_by_name.setdefault(stop["name"], idx)
+
+        self._service_day: Optional[date] = None
+        self._stops_today: List[Dict] = []
+
+    def __len__(self) -> int:
+        return len(self._base_stops)
+
+    def stop_index(self, name: Optional[str]) -> Optional[int]:
+        """Position of a stop by name, or None if unknown"""
+        return self._index_by_name.get(name) if name is not None else None
+
+    def to_local(self, latitude: float, longitude: float) -> tuple:
+        """Project a GPS point into this route's planar frame (km)"""
+        x, y = to_local_xy(latitude, longitude, self.origin_lat, self.origin_lon)
+        return float(x), float(y)
+
+    def start_today(self, now_ist: Optional[datetime] = None) -> Optional[datetime]:
+        """Today's start time in IST, or None if the bus has no start_time"""
+        if self.start_time is None:
+            return None
+        now_ist = now_ist or datetime.now(INDIA_TZ)
+        start_ist = self.start_time.astimezone(INDIA_TZ)
+        today = now_ist.replace(hour=0, minute=0, second=0, microsecond=0)
+        return today.replace(hour=start_ist.hour, minute=start_ist.minute)
+
+    def stops(self) -> List[Dict]:
+        """Stops with 'scheduled' materialized for the current IST service day"""
+        now_ist = datetime.now(INDIA_TZ)
+        if self._service_day != now_ist.date():
+            self._stops_today = self._materialize(now_ist)
+            self._service_day = now_ist.date()
+        return self._stops_today
+
+    def _materialize(self, now_ist: datetime) -> List[Dict]:
+        today_start = self.start_today(now_ist)
+        result = []
+        for stop in self._base_stops:
+            scheduled = None
+            if today_start is not None and stop["scheduled_arrival_minutes"] is not None:
+                scheduled = today_start + timedelta(minutes=stop["scheduled_arrival_minutes"])
+            elif stop["scheduled_arrival"]:
+                scheduled = stop["scheduled_arrival"]
+            elif stop["scheduled_departure"]:
+                scheduled = stop["scheduled_departure"]
+            result.append({
+                "stop_id": stop["stop_id"],
+                "name": stop["name"],
+                "scheduled": scheduled,
+                "latitude": stop["latitude"],
+                "longitude": stop["longitude"],
+                "scheduled_arrival_minutes": stop["scheduled_arrival_minutes"],
+                "sequence_order": stop["sequence_order"],
+            })
+        return result
+
+
+class RouteCache:
+    """
+    Process-wide bus_number -> CompiledRoute cache, invalidated by the admin route/stop/bus endpoints.
+    LRU-bounded; bus numbers that are not in the DB (any caller can ask for them) are compiled
+    per request and not stored.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._routes: "OrderedDict[str, CompiledRoute]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a compile that raced with an admin edit is not cached
+        self._generation = 0
+
+    def _hit(self, bus_number: str) -> Optional[CompiledRoute]:
+        with self._lock:
+            route = self._routes.get(bus_number)
+            if route is not None:
+                self._routes.move_to_end(bus_number)
+            return route
+
+    def _store(self, bus_number: str, route: CompiledRoute, generation: int) -> CompiledRoute:
+        """Cache a freshly compiled route (caller holds the lock) unless it raced with an invalidation"""
+        if generation != self._generation or not route.known:
+            return route
+        route = self._routes.setdefault(bus_number, route)
+        self._routes.move_to_end(bus_number)
+        while len(self._routes) > self.max_size:
+            self._routes.popitem(last=False)
+        return route
+
+    def get(self, bus_number: str, loader: Callable[[str], CompiledRoute]) -> CompiledRoute:
+        route = self._hit(bus_number)
+        if route is not None:
+            return route
+        generation = self._generation
+        route = loader(bus_number)
+        with self._lock:
+            return self._store(bus_number, route, generation)
+
+    def get_many(self, bus_numbers: List[str], loader: Callable[[List[str]], Dict[str, CompiledRoute]]) -> Dict[str, CompiledRoute]:
+        """Like get() for several buses; the missing ones are compiled by one loader call"""
+        routes = {}
+        missing = []
+        for bus_number in bus_numbers:
+            route = self._hit(bus_number)
+            if route is not None:
+                routes[bus_number] = route
+            else:
+                missing.append(bus_number)
+        if missing:
+            generation = self._generation
+            loaded = loader(missing)
+            with self._lock:
+                for bus_number, route in loaded.items():
+                    routes[bus_number] = self._store(bus_number, route, generation)
+        return routes
+
+    def peek(self, bus_number: str) -> Optional[CompiledRoute]:
+        return self._routes.get(bus_number)
+
+    def invalidate(self, bus_number: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._routes.pop(bus_number, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._routes.clear()
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self._routes),
+            "max_size": self.max_size,
+        }
+
+
+# Global route cache instance
+route_cache = RouteCache(max_size=settings.route_cache_max_size)
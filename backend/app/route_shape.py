@@ -0,0 +1,81 @@
+"""
+Road geometry for a route: the optional Route.shape polyline, from the first stop to the last.
+
+Compiled once per route version (see CompiledRoute): vertices in the route's planar frame,
+cumulative distance per vertex and each stop's distance along the shape. Locating the bus
+projects it onto a few segments around the last matched vertex instead of the whole line.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from .geometry import cumulative_distances_km, project_onto_segments, to_local_xy
+
+# Segments searched behind / ahead of the last matched one on each fix
+SEARCH_BACK_SEGMENTS = 2
+SEARCH_AHEAD_SEGMENTS = 8
+# Further than this from every searched segment -> GPS jump, detour or new trip: scan the whole shape
+MAX_WINDOW_OFFSET_KM = 0.1
+
+
+class RouteShape:
+    """Polyline with precomputed distances; stop_distances replaces the straight-line route_distances"""
+
+    def __init__(self, points: Sequence[Tuple[float, float]], stop_lats: np.ndarray, stop_lons: np.ndarray,
+                 origin_lat: float, origin_lon: float):
+        lats = np.array([p[0] for p in points], dtype=float)
+        lons = np.array([p[1] for p in points], dtype=float)
+        self.origin_lat = origin_lat
+        self.origin_lon = origin_lon
+        self.xs, self.ys = to_local_xy(lats, lons, origin_lat, origin_lon)
+        self.cumulative_km = cumulative_distances_km(lats, lons)
+        self.segment_km = np.diff(self.cumulative_km)
+        self.length_km = float(self.cumulative_km[-1])
+        # Last matched segment; only a search hint, so unsynchronized updates are harmless
+        self._segment = 0
+        self.stop_distances = self._project_stops(stop_lats, stop_lons)
+
+    def _project_stops(self, stop_lats: np.ndarray, stop_lons: np.ndarray) -> List[float]:
+        """Distance along the shape of each stop. Stops are matched in order, each no earlier
+        than the previous one, so a road used twice (out and back) maps to the right pass."""
+        xs, ys = to_local_xy(stop_lats, stop_lons, self.origin_lat, self.origin_lon)
+        distances = []
+        first = 0
+        for x, y in zip(xs, ys):
+            t, dist = project_onto_segments(float(x), float(y), self.xs[first:], self.ys[first:])
+            i = int(np.argmin(dist))
+            along = float(self.cumulative_km[first + i] + t[i] * self.segment_km[first + i])
+            distances.append(max(along, distances[-1]) if distances else along)
+            first += i
+        return distances
+
+    def locate(self, latitude: float, longitude: float) -> float:
+        """Bus distance along the shape (km): a bounded search around the last match, amortized O(1) per fix"""
+        x, y = to_local_xy(latitude, longitude, self.origin_lat, self.origin_lon)
+        x, y = float(x), float(y)
+        first = max(0, self._segment - SEARCH_BACK_SEGMENTS)
+        last = min(len(self.segment_km), self._segment + SEARCH_AHEAD_SEGMENTS)
+        t, dist = project_onto_segments(x, y, self.xs[first:last + 1], self.ys[first:last + 1])
+        i = int(np.argmin(dist))
+        if dist[i] > MAX_WINDOW_OFFSET_KM:
+            first = 0
+            t, dist = project_onto_segments(x, y, self.xs, self.ys)
+            i = int(np.argmin(dist))
+        segment = first + i
+        self._segment = segment
+        return float(self.cumulative_km[segment] + t[i] * self.segment_km[segment])
+
+
+def parse_shape(points) -> List[Tuple[float, float]]:
+    """Validate [[lat, lon], ...] (at least two points). Raises ValueError."""
+    if not isinstance(points, (list, tuple)) or len(points) < 2:
+        raise ValueError("shape needs at least two [latitude, longitude] points")
+    parsed = []
+    for point in points:
+        if not isinstance(point, (list, tuple)) or len(point) != 2:
+            raise ValueError("each shape point must be [latitude, longitude]")
+        lat, lon = float(point[0]), float(point[1])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError("shape point out of range")
+        parsed.append((lat, lon))
+    return parsed
@@ -1,23 +1,47 @@
 from datetime import datetime, timezone, timedelta
-from fastapi import APIRouter, HTTPException, status, Depends, Header, Query, Request, Body
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Query, Request, Body, WebSocket, WebSocketDisconnect
+from typing import List, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from pydantic import BaseModel
+import asyncio
+import json
 import secrets
 import string
 
-from .. import schemas
+from .. import schemas, state_sync
+from ..database import SessionLocal
+from ..db_executor import run_db
 from ..deps import get_db, get_store
 from ..db_store import DatabaseStore
 from ..models import Bus, Route, Stop, DriverSession, Location, DelayInfo, TrackingCode
 from ..config import settings
+from ..location_writer import location_writer
+from ..session_cache import session_cache
+from ..route_cache import route_cache
+from ..route_shape import parse_shape
+from ..live_state import live_state
+from ..eta import compute_stop_etas
+from ..eta_cache import eta_cache
+from ..travel_times import travel_times
+from ..websocket_manager import PONG_FRAME, websocket_manager, in_bbox
+from ..ws_pubsub import FLEET_TOPIC
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
 # Simple admin password (in production, use proper auth)
 ADMIN_PASSWORD = "admin123"  # Change this!
 
+# WebSocket close code for a failed admin login or bad parameters
+WS_CLOSE_POLICY_VIOLATION = 1008
+# How long a fleet socket may take to send its {"password": ...} message
+FLEET_AUTH_TIMEOUT_SECONDS = 10
+
+
+class RouteShapeBody(BaseModel):
+    """Road polyline from the first stop to the last: [[latitude, longitude], ...]"""
+    points: List[List[float]]
+
 
 class BusUpdateBody(BaseModel):
     """JSON body for bus update - avoids URL encoding issues with start_time"""
@@ -127,6 +151,7 @@ def create_bus(
     db.add(bus)
     db.commit()
     db.refresh(bus)
+    state_sync.invalidate_route(bus_number)
     
     return {
         "bus_number": bus.bus_number,
@@ -207,6 +232,7 @@ def update_bus(
 
     db.commit()
     db.refresh(bus)
+    state_sync.invalidate_route(bus_number)
 
     return {
         "bus_number": bus.bus_number,
@@ -229,6 +255,7 @@ def delete_bus(
     
     db.delete(bus)
     db.commit()
+    state_sync.remove_bus(bus_number)
     return {"ok": True, "message": f"Bus {bus_number} deleted"}
 
 
@@ -359,6 +386,7 @@ def get_route(
             "route_id": route.route_id,
             "route_name": route.route_name,
             "bus_number": route.bus_number,
+            "shape": json.loads(route.shape) if route.shape else None,
         },
         "start_time": bus.start_time.isoformat() if bus and bus.start_time else None,
         "stops": [
@@ -403,6 +431,7 @@ def create_or_update_route(
     
     db.commit()
     db.refresh(route)
+    state_sync.invalidate_route(bus_number)
     
     return {
         "route_id": route.route_id,
@@ -411,6 +440,52 @@ def create_or_update_route(
     }
 
 
+@router.put("/buses/{bus_number}/route/shape")
+def set_route_shape(
+    bus_number: str,
+    body: RouteShapeBody,
+    store: DatabaseStore = Depends(get_store),
+    _: bool = Depends(verify_admin_password),
+):
+    """Set the road polyline of a bus route; ETAs then measure progress along it"""
+    route = store.db.query(Route).filter(Route.bus_number == bus_number).first()
+    if not route:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
+    try:
+        points = parse_shape(body.points)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    route.shape = json.dumps([list(p) for p in points])
+    store.db.commit()
+    state_sync.invalidate_route(bus_number)
+    # Compile now so the projection work is done here rather than on the next ping
+    compiled = store.get_compiled_route(bus_number)
+    
+    return {
+        "ok": True,
+        "points": len(points),
+        "length_km": round(compiled.shape.length_km, 3) if compiled.shape else None,
+    }
+
+
+@router.delete("/buses/{bus_number}/route/shape")
+def delete_route_shape(
+    bus_number: str,
+    db: Session = Depends(get_db),
+    _: bool = Depends(verify_admin_password),
+):
+    """Remove the road polyline; ETAs fall back to straight lines between stops"""
+    route = db.query(Route).filter(Route.bus_number == bus_number).first()
+    if not route:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
+    
+    route.shape = None
+    db.commit()
+    state_sync.invalidate_route(bus_number)
+    return {"ok": True}
+
+
 @router.post("/buses/{bus_number}/stops")
 def add_stop(
     bus_number: str,
@@ -470,6 +545,7 @@ def add_stop(
     db.add(stop)
     db.commit()
     db.refresh(stop)
+    state_sync.invalidate_route(bus_number)
     
     return {
         "stop_id": stop.stop_id,
@@ -553,6 +629,7 @@ def update_stop(
     
     db.commit()
     db.refresh(stop)
+    state_sync.invalidate_route(bus_number)
     
     return {
         "stop_id": stop.stop_id,
@@ -577,6 +654,7 @@ def delete_stop(
     
     db.delete(stop)
     db.commit()
+    state_sync.invalidate_route(bus_number)
     return {"ok": True, "message": f"Stop {stop_id} deleted"}
 
 
@@ -621,6 +699,157 @@ def get_active_drivers(
     return result
 
 
+def _parse_bbox(value) -> Optional[Tuple[float, float, float, float]]:
+    """"min_lon,min_lat,max_lon,max_lat" (or a 4-item list) -> tuple, None if empty. Raises ValueError."""
+    if value is None or value == "":
+        return None
+    parts = value.split(",") if isinstance(value, str) else list(value)
+    if len(parts) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    min_lon, min_lat, max_lon, max_lat = (float(p) for p in parts)
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("bbox min must not exceed max")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def _fleet_snapshot(bbox: Optional[Tuple[float, float, float, float]]) -> dict:
+    """Latest position, delay and status of every bus (inside bbox) from the live state table"""
+    db = SessionLocal()
+    try:
+        live_state.ensure_loaded(db)
+    finally:
+        db.close()
+    now = datetime.now(timezone.utc)
+    buses = []
+    for entry in live_state.all():
+        if entry["latitude"] is None or not in_bbox(bbox, (entry["latitude"], entry["longitude"])):
+            continue
+        recorded_at = entry["recorded_at"]
+        recorded_at = recorded_at.replace(tzinfo=timezone.utc) if recorded_at.tzinfo is None else recorded_at.astimezone(timezone.utc)
+        last_seen_seconds = int((now - recorded_at).total_seconds())
+        buses.append({
+            "bus_number": entry["bus_number"],
+            "latitude": entry["latitude"],
+            "longitude": entry["longitude"],
+            "recorded_at": recorded_at.isoformat(),
+            "last_seen_seconds": last_seen_seconds,
+            "status": "online" if last_seen_seconds < 120 else "stale",
+            "delay_minutes": entry["delay_minutes"],
+            "current_stop": entry["current_stop"],
+            "next_stop": entry["next_stop"],
+        })
+    return {"type": "fleet_snapshot", "buses": buses}
+
+
+def _monitor_stops(bus_number: str) -> Optional[list]:
+    """Stop ETAs (as GET /passenger/bus/{n}/stops) for a bus the monitor starts watching"""
+    db = SessionLocal()
+    try:
+        etas = compute_stop_etas(DatabaseStore(db), bus_number)
+        return etas.model_dump(mode="json")["stops"] if etas is not None else None
+    finally:
+        db.close()
+
+
+async def _watch_bus(websocket: WebSocket, bus_number: Optional[str]) -> None:
+    """Forward a bus's stop lists to this fleet stream, starting with the current one"""
+    if bus_number is None:
+        websocket_manager.watch(websocket, None)
+        return
+    cached = websocket_manager.get_stop_snapshot(bus_number)
+    stops = cached[1] if cached is not None else await run_db(_monitor_stops, bus_number)
+    # No await from here on, so no broadcast lands between the current list and the watch
+    current = websocket_manager.get_stop_snapshot(bus_number)
+    if current is not None:
+        stops = current[1]
+    websocket_manager.watch(websocket, bus_number)
+    if stops is not None:
+        websocket_manager.send(websocket, FLEET_TOPIC, {"type": "stops_update", "bus_number": bus_number, "stops": stops})
+
+
+async def _fleet_authenticated(websocket: WebSocket) -> bool:
+    """X-Admin-Password header, or a first message {"password": "..."} (browsers cannot set
+    WebSocket headers, and a query parameter would end up in access logs)"""
+    if websocket.headers.get("x-admin-password") == ADMIN_PASSWORD:
+        return True
+    try:
+        message = json.loads(await asyncio.wait_for(websocket.receive_text(), FLEET_AUTH_TIMEOUT_SECONDS))
+    except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        return False
+    return isinstance(message, dict) and message.get("password") == ADMIN_PASSWORD
+
+
+@router.websocket("/ws/fleet")
+async def fleet_websocket(websocket: WebSocket, bbox: Optional[str] = None):
+    """
+    Live stream of every bus for the admin dashboard: a fleet_snapshot, then the same
+    location_update / delay_update frames passengers get, for all buses.
+    Auth with X-Admin-Password, or send {"password": "..."} as the first message.
+    Optional ?bbox=min_lon,min_lat,max_lon,max_lat; send {"bbox": [...]} or {"bbox": null}
+    to change it, which is answered with a fresh snapshot.
+    Send {"watch": "<bus>"} to also get that bus's stops_update frames (monitor view),
+    {"watch": null} to stop.
+    """
+    try:
+        area = _parse_bbox(bbox)
+    except ValueError:
+        await websocket.close(code=WS_CLOSE_POLICY_VIOLATION)
+        return
+
+    await websocket_manager.accept(websocket)
+    if not await _fleet_authenticated(websocket):
+        try:
+            await websocket.close(code=WS_CLOSE_POLICY_VIOLATION)
+        except Exception:
+            pass
+        return
+    await websocket_manager.connect(websocket, FLEET_TOPIC, accepted=True)
+    websocket_manager.set_bbox(websocket, area)
+    try:
+        websocket_manager.send(websocket, FLEET_TOPIC, await run_db(_fleet_snapshot, area))
+        while True:
+            data = await websocket.receive_text()
+            websocket_manager.touch(websocket, FLEET_TOPIC)
+            if data == PONG_FRAME:
+                continue
+            try:
+                message = json.loads(data)
+                if isinstance(message, dict) and "watch" in message:
+                    watch = message["watch"]
+                    await _watch_bus(websocket, str(watch) if watch is not None else None)
+                    continue
+                if not isinstance(message, dict) or "bbox" not in message:
+                    continue
+                area = _parse_bbox(message["bbox"])
+            except (ValueError, TypeError):
+                websocket_manager.send(websocket, FLEET_TOPIC, {"type": "error", "detail": "Invalid bbox"})
+                continue
+            websocket_manager.set_bbox(websocket, area)
+            websocket_manager.send(websocket, FLEET_TOPIC, await run_db(_fleet_snapshot, area))
+    except WebSocketDisconnect:
+        websocket_manager.disconnect(websocket, FLEET_TOPIC)
+    except Exception as e:
+        print(f"Fleet WebSocket error: {e}")
+        websocket_manager.disconnect(websocket, FLEET_TOPIC)
+
+
+@router.delete("/active-drivers/{session_id}")
+def deactivate_driver_session(
+    session_id: int,
+    db: Session = Depends(get_db),
+    _: bool = Depends(verify_admin_password),
+):
+    """End a driver session (driver must log in again)"""
+    session = db.query(DriverSession).filter(DriverSession.session_id == session_id).first()
+    if not session:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+
+    session.is_active = False
+    db.commit()
+    state_sync.end_session(session.bus_number, session_id)
+    return {"ok": True, "message": f"Session {session_id} deactivated"}
+
+
 # Statistics
 @router.get("/stats")
 def get_stats(
@@ -666,6 +895,12 @@ def get_stats(
             "on_time_percentage": round(on_time_percentage, 1),
             "on_time_count": on_time_count,
             "total_tracked_buses": len(total_delays),
+            "location_write_behind": location_writer.metrics(),
+            "session_cache": session_cache.metrics(),
+            "route_cache": route_cache.metrics(),
+            "eta_cache": eta_cache.metrics(),
+            "segment_travel_times": travel_times.metrics(),
+            "websockets": websocket_manager.metrics(),
         }
     except Exception as e:
         # Return basic stats even if some queries fail
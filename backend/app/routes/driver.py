@@ -1,67 +1,45 @@
 from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, status
 import logging
-import math
+import numpy as np
 
 from .. import schemas
 
 logger = logging.getLogger(__name__)
-from ..deps import get_bus_from_session, get_store
+from ..deps import get_bus_from_session, get_driver_session, get_store
 from ..db_store import DatabaseStore
+from ..db_executor import run_db
+from ..eta import compute_stop_etas
+from ..geometry import distances_km
+from ..location_writer import WriteBehindOverflow
 from ..websocket_manager import websocket_manager
-from ..models import Bus
 
 router = APIRouter(prefix="/driver", tags=["driver"])
 
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calculate distance between two GPS coordinates in kilometers"""
-    R = 6371  # Earth's radius in km
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
-
-
 def calculate_automatic_delay(store: DatabaseStore, bus_number: str, current_lat: float, current_lon: float, current_time: datetime):
     """Automatically calculate delay based on GPS position and scheduled times"""
-    # Get bus start_time
-    bus = store.db.query(Bus).filter(Bus.bus_number == bus_number).first()
-    if not bus or not bus.start_time:
+    # Compiled route carries the bus start_time and today's schedule (no DB on the hot path)
+    route = store.get_compiled_route(bus_number)
+    if not route.start_time:
         return 0, None, None
     
     # Get route stops
-    stops = store.get_stops_for_bus(bus_number)
+    stops = route.stops()
     if not stops or len(stops) < 2:
         return 0, None, None
     
     # Find nearest stop
-    min_distance = float('inf')
-    nearest_stop_idx = 0
-    for idx, stop in enumerate(stops):
-        distance = haversine_distance(current_lat, current_lon, stop["latitude"], stop["longitude"])
-        if distance < min_distance:
-            min_distance = distance
-            nearest_stop_idx = idx
+    nearest_stop_idx = int(np.argmin(distances_km(current_lat, current_lon, route.lat_array, route.lon_array)))
     
     nearest_stop = stops[nearest_stop_idx]
     
     # Calculate scheduled arrival time for nearest stop
-    # Use pre-calculated scheduled from get_stops_for_bus (already in India/Kolkata)
+    # Use pre-calculated scheduled from the compiled route (already in India/Kolkata)
     if nearest_stop.get("scheduled"):
         scheduled_arrival = nearest_stop["scheduled"]
     elif nearest_stop.get("scheduled_arrival_minutes") is not None:
-        from zoneinfo import ZoneInfo
-        try:
-            india_tz = ZoneInfo("Asia/Kolkata")
-        except Exception:
-            india_tz = timezone(timedelta(hours=5, minutes=30))
-        start_dt = bus.start_time.replace(tzinfo=timezone.utc) if bus.start_time.tzinfo is None else bus.start_time
-        start_ist = start_dt.astimezone(india_tz)
-        today_ist = datetime.now(india_tz).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_start = today_ist.replace(hour=start_ist.hour, minute=start_ist.minute)
-        scheduled_arrival = today_start + timedelta(minutes=nearest_stop["scheduled_arrival_minutes"])
+        scheduled_arrival = route.start_today() + timedelta(minutes=nearest_stop["scheduled_arrival_minutes"])
     else:
         return 0, None, None
     
@@ -86,50 +64,89 @@ def calculate_automatic_delay(store: DatabaseStore, bus_number: str, current_lat
     return delay_minutes, current_stop, next_stop
 
 
-@router.post("/location", response_model=schemas.LastLocation)
-async def update_location(
-    payload: schemas.LocationUpdate,
-    bus_number: str = Depends(get_bus_from_session),
-    store: DatabaseStore = Depends(get_store),
-):
-    logger.info("Location received: bus=%s lat=%.6f lon=%.6f", bus_number, payload.latitude, payload.longitude)
-    saved = store.save_location(bus_number, payload.latitude, payload.longitude, payload.recorded_at)
+def _delay_payload(store: DatabaseStore, bus_number: str, delay_minutes: int, current_stop, next_stop) -> dict:
+    """Delay broadcast payload; stop indices are for clients on the binary WebSocket protocol"""
+    route = store.get_compiled_route(bus_number)
+    return {
+        "delay_minutes": delay_minutes,
+        "current_stop": current_stop,
+        "next_stop": next_stop,
+        "current_stop_index": route.stop_index(current_stop),
+        "next_stop_index": route.stop_index(next_stop),
+    }
+
+
+def _process_fixes(store: DatabaseStore, bus_number: str, session_id: int, fixes: list) -> dict:
+    """Blocking part of ingest: persist fixes, record stop arrivals, recompute delay. Runs on the DB pool."""
+    if len(fixes) == 1:
+        fix = fixes[0]
+        saved_rows = [store.save_location(
+            bus_number, fix["latitude"], fix["longitude"], fix["recorded_at"],
+            session_id=session_id,
+        )]
+    else:
+        saved_rows = store.save_locations(bus_number, fixes, session_id=session_id)
+    saved = saved_rows[-1]
 
     # Record actual stop arrivals when bus is within 20m of a stop (per-trip, session-scoped)
-    store.record_stop_arrivals_if_near(
-        bus_number, saved.get("session_id"),
-        payload.latitude, payload.longitude, payload.recorded_at
-    )
-    
-    # Automatically calculate delay based on GPS position
-    current_time = payload.recorded_at
+    store.record_stop_arrivals_for_fixes(bus_number, saved.get("session_id"), saved_rows)
+
+    # Automatically calculate delay based on the newest GPS position
+    current_time = saved["recorded_at"]
     if current_time.tzinfo is None:
         current_time = current_time.replace(tzinfo=timezone.utc)
-    
+
     delay_minutes, current_stop, next_stop = calculate_automatic_delay(
-        store, bus_number, payload.latitude, payload.longitude, current_time
+        store, bus_number, saved["latitude"], saved["longitude"], current_time
     )
-    
-    # Save calculated delay
+
+    delay = None
     if delay_minutes is not None:
         store.save_delay(bus_number, delay_minutes, current_stop, next_stop)
-        
-        # Broadcast delay update via WebSocket
-        await websocket_manager.broadcast_delay(bus_number, {
-            "delay_minutes": delay_minutes,
-            "current_stop": current_stop,
-            "next_stop": next_stop,
-        })
-    
-    delay_info = store.get_delay(bus_number)
-    
+        delay = _delay_payload(store, bus_number, delay_minutes, current_stop, next_stop)
+
+    # One ETA computation per ping for all connected passengers (skipped when nobody is listening on any worker)
+    stops = None
+    if websocket_manager.has_listeners(bus_number):
+        etas = compute_stop_etas(store, bus_number)
+        stops = etas.model_dump(mode="json") if etas is not None else None
+
+    return {"saved": saved, "delay": delay, "delay_info": store.get_delay(bus_number), "stops": stops}
+
+
+async def _ingest(store: DatabaseStore, bus_number: str, session_id: int, fixes: list) -> dict:
+    """Run _process_fixes; a full write-behind queue becomes 503 + Retry-After so the app keeps the fixes and resends"""
+    try:
+        return await run_db(_process_fixes, store, bus_number, session_id, fixes)
+    except WriteBehindOverflow as e:
+        logger.warning("Location ingest refused for bus %s: %s", bus_number, e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Location storage is busy, retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+async def _broadcast_and_respond(bus_number: str, result: dict) -> schemas.LastLocation:
+    """Broadcast the newest fix (and delay) to passengers and build the driver response"""
+    saved = result["saved"]
+    delay_info = result["delay_info"]
+
+    # Broadcast delay update via WebSocket
+    if result["delay"] is not None:
+        await websocket_manager.broadcast_delay(bus_number, result["delay"])
+
     # Broadcast location update via WebSocket
     await websocket_manager.broadcast_location(bus_number, {
         "latitude": saved["latitude"],
         "longitude": saved["longitude"],
         "recorded_at": saved["recorded_at"],
     })
-    
+
+    # Push the stop ETA snapshot computed during ingest
+    if result["stops"] is not None:
+        await websocket_manager.broadcast_stops(bus_number, result["stops"])
+
     return schemas.LastLocation(
         latitude=saved["latitude"],
         longitude=saved["longitude"],
@@ -142,6 +159,47 @@ async def update_location(
     )
 
 
+@router.post("/location", response_model=schemas.LastLocation)
+async def update_location(
+    payload: schemas.LocationUpdate,
+    session: dict = Depends(get_driver_session),
+    store: DatabaseStore = Depends(get_store),
+):
+    bus_number = session["bus_number"]
+    logger.info("Location received: bus=%s lat=%.6f lon=%.6f", bus_number, payload.latitude, payload.longitude)
+    fixes = [{
+        "latitude": payload.latitude,
+        "longitude": payload.longitude,
+        "recorded_at": payload.recorded_at,
+    }]
+    result = await _ingest(store, bus_number, session["session_id"], fixes)
+    return await _broadcast_and_respond(bus_number, result)
+
+
+@router.post("/locations", response_model=schemas.LastLocation)
+async def update_locations(
+    payload: schemas.LocationBatchUpdate,
+    session: dict = Depends(get_driver_session),
+    store: DatabaseStore = Depends(get_store),
+):
+    """Ingest fixes buffered by the driver app while offline. Only the newest fix is broadcast."""
+    fixes = sorted(
+        (
+            {
+                "latitude": fix.latitude,
+                "longitude": fix.longitude,
+                "recorded_at": fix.recorded_at,
+            }
+            for fix in payload.locations
+        ),
+        key=lambda f: f["recorded_at"] if f["recorded_at"].tzinfo else f["recorded_at"].replace(tzinfo=timezone.utc),
+    )
+    bus_number = session["bus_number"]
+    logger.info("Location batch received: bus=%s count=%d", bus_number, len(fixes))
+    result = await _ingest(store, bus_number, session["session_id"], fixes)
+    return await _broadcast_and_respond(bus_number, result)
+
+
 @router.post("/delay")
 async def update_delay(
     delay_minutes: int,
@@ -150,14 +208,11 @@ async def update_delay(
     bus_number: str = Depends(get_bus_from_session),
     store: DatabaseStore = Depends(get_store),
 ):
-    store.save_delay(bus_number, delay_minutes, current_stop, next_stop)
+    await run_db(store.save_delay, bus_number, delay_minutes, current_stop, next_stop)
+    delay = await run_db(_delay_payload, store, bus_number, delay_minutes, current_stop, next_stop)
     
     # Broadcast delay update via WebSocket
-    await websocket_manager.broadcast_delay(bus_number, {
-        "delay_minutes": delay_minutes,
-        "current_stop": current_stop,
-        "next_stop": next_stop,
-    })
+    await websocket_manager.broadcast_delay(bus_number, delay)
     
     return {"ok": True, "delay_minutes": delay_minutes, "current_stop": current_stop, "next_stop": next_stop}
 
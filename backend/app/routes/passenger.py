@@ -1,34 +1,61 @@
-from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
-from fastapi import APIRouter, HTTPException, status, Depends, WebSocket, WebSocketDisconnect
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import hashlib
 import secrets
 import string
 
 from .. import schemas
+from ..config import settings
+from ..database import SessionLocal
+from ..db_executor import run_db
 from ..deps import get_store
 from ..db_store import DatabaseStore
+from ..eta import compute_stop_etas, eta_inputs_key
 from ..websocket_manager import websocket_manager
 from ..models import TrackingCode
 
 router = APIRouter(prefix="/passenger", tags=["passenger"])
 
+# Most buses one GET /passenger/buses request may ask for
+MAX_BATCH_BUSES = 300
+
+# "Last seen" moves on while a bus is quiet; the status ETag changes once per step so pages stay roughly current
+LAST_SEEN_STEP_SECONDS = 30
+
+
+def _etag(*parts) -> str:
+    """Weak validator over the inputs a body is computed from (clock-driven fields such as
+    last_seen_seconds or ETAs of a stationary bus may drift within one tag)"""
+    return 'W/"%s"' % hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
 
-def _fake_schedule(bus_number: str) -> list:
-    """
-    Placeholder schedule for demonstration when no database stops are available.
-    In production, this should not be used - all buses should have routes configured.
-    """
-    base = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
-    stops = []
-    for idx, name in enumerate(["Stop A", "Stop B", "Stop C", "Stop D"]):
-        stops.append({
-            "name": name,
-            "scheduled": base + timedelta(minutes=idx * 15),
-            "latitude": None,
-            "longitude": None,
-            "scheduled_arrival_minutes": idx * 15
-        })
-    return stops
+
+def _cache_headers(etag: str, last_modified: Optional[datetime]) -> dict:
+    headers = {
+        "ETag": etag,
+        "Cache-Control": (
+            f"public, max-age={settings.passenger_cache_max_age_seconds}, "
+            f"stale-while-revalidate={settings.passenger_cache_stale_seconds}"
+        ),
+    }
+    if isinstance(last_modified, datetime):
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    """If-None-Match (weak comparison). If-Modified-Since is not used: route edits change the
+    body without changing the last fix time that Last-Modified reports."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag[2:] in {tag.strip().removeprefix("W/") for tag in header.split(",")}
 
 
 def calculate_bus_status(store: DatabaseStore, bus_number: str, last_location_time: datetime | None) -> str:
@@ -38,19 +65,14 @@ def calculate_bus_status(store: DatabaseStore, bus_number: str, last_location_ti
     Returns:
         str: Bus status
     """
-    from ..models import Bus
-    
-    bus = store.db.query(Bus).filter(Bus.bus_number == bus_number).first()
-    if not bus or not bus.start_time:
+    route = store.get_compiled_route(bus_number)
+    if not route.start_time:
         return "not_started"
     
     # Check if bus has started (current time >= start_time today)
     # start_time is stored as UTC (admin sends IST as UTC)
     now = datetime.now(timezone.utc)
-    if bus.start_time.tzinfo is None:
-        start_utc = bus.start_time.replace(tzinfo=timezone.utc)
-    else:
-        start_utc = bus.start_time
+    start_utc = route.start_time
     today = now.replace(hour=0, minute=0, second=0, microsecond=0)
     today_start = today.replace(hour=start_utc.hour, minute=start_utc.minute)
     
@@ -73,7 +95,7 @@ def calculate_bus_status(store: DatabaseStore, bus_number: str, last_location_ti
             return "offline"
     
     # Check if route is completed (reached final stop)
-    stops = store.get_stops_for_bus(bus_number)
+    stops = route.stops()
     delay_info = store.get_delay(bus_number)
     current_stop = delay_info.get("current_stop")
     
@@ -85,15 +107,11 @@ def calculate_bus_status(store: DatabaseStore, bus_number: str, last_location_ti
     return "in_transit"
 
 
-@router.get("/bus/{bus_number}", response_model=schemas.LastLocation)
-def passenger_bus_status(bus_number: str, store: DatabaseStore = Depends(get_store)):
-    """Get current bus status and location"""
+def build_bus_status(store: DatabaseStore, bus_number: str) -> schemas.LastLocation | None:
+    """Current location, delay and status of a bus from the live state table; None if it never reported"""
     last = store.get_last_location(bus_number)
     if not last:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Bus not found or no location data available"
-        )
+        return None
     
     delay_info = store.get_delay(bus_number)
     recorded_at = last.get("recorded_at")
@@ -135,302 +153,72 @@ def passenger_bus_status(bus_number: str, store: DatabaseStore = Depends(get_sto
     )
 
 
-def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Calculate distance between two GPS coordinates in kilometers using Haversine formula"""
-    import math
-    R = 6371.0  # Earth's radius in km
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
-
-
-def calculate_eta_from_scheduled_times(current_lat: float, current_lon: float, stops: list, current_time: datetime, target_stop_idx: int):
-    """
-    Calculate ETA for a target stop using scheduled times and current GPS position.
-    This is more accurate than using fixed speed because it uses actual route timing.
-    
-    Approach:
-    1. Calculate cumulative distances between consecutive stops
-    2. Find which segment (between two stops) the bus is currently in
-    3. Interpolate bus position within that segment
-    4. Use scheduled_arrival_minutes to calculate time differences between stops
-    5. Interpolate current time position based on bus position
-    6. Calculate remaining time to target stop
-    
-    Returns:
-        Tuple[datetime, int]: (ETA, delay_minutes) or (None, None) if calculation fails
-    """
-    # Validate inputs
-    if not stops or target_stop_idx < 0 or target_stop_idx >= len(stops):
-        return None, None
-    
-    if current_lat is None or current_lon is None:
-        return None, None
-    
-    target_stop = stops[target_stop_idx]
-    if not target_stop.get("latitude") or not target_stop.get("longitude"):
-        return None, None
-    
-    # Calculate cumulative distances from start for all stops
-    route_distances = [0.0]
-    for i in range(1, len(stops)):
-        prev = stops[i-1]
-        curr = stops[i]
-        if (prev.get("latitude") and prev.get("longitude") and 
-            curr.get("latitude") and curr.get("longitude")):
-            dist = haversine_distance(
-                prev["latitude"], prev["longitude"],
-                curr["latitude"], curr["longitude"]
-            )
-            route_distances.append(route_distances[-1] + dist)
-        else:
-            # Missing coordinates - use estimated distance
-            route_distances.append(route_distances[-1] + 1.0)
-    
-    # Find which segment the bus is in and calculate position along route
-    min_dist_to_route = float('inf')
-    bus_distance_from_start = 0.0
-    current_segment_idx = 0
-    
-    for i in range(len(stops) - 1):
-        stop_a = stops[i]
-        stop_b = stops[i + 1]
-        
-        if not (stop_a.get("latitude") and stop_b.get("latitude")):
-            continue
-        
-        # Calculate distances from bus to both stops in this segment
-        dist_a = haversine_distance(
-            current_lat, current_lon,
-            stop_a["latitude"], stop_a["longitude"]
-        )
-        dist_b = haversine_distance(
-            current_lat, current_lon,
-            stop_b["latitude"], stop_b["longitude"]
+@router.get("/bus/{bus_number}", response_model=schemas.LastLocation)
+def passenger_bus_status(bus_number: str, request: Request, response: Response, store: DatabaseStore = Depends(get_store)):
+    """Get current bus status and location (ETag: last fix, live state version, status and last-seen step)"""
+    result = build_bus_status(store, bus_number)
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bus not found or no location data available"
         )
-        segment_dist = route_distances[i+1] - route_distances[i]
-        
-        # Interpolate bus position along segment based on distance ratio
-        if segment_dist > 0.001:  # Avoid division by zero
-            total_dist = dist_a + dist_b
-            if total_dist > 0.001:
-                # Progress: closer to A = less progress, closer to B = more progress
-                progress_in_segment = dist_a / total_dist
-                progress_in_segment = max(0.0, min(1.0, progress_in_segment))
-                bus_dist_approx = route_distances[i] + (segment_dist * progress_in_segment)
-            else:
-                # Bus is exactly at one of the stops
-                bus_dist_approx = route_distances[i] if dist_a < dist_b else route_distances[i+1]
-        else:
-            # Zero-length segment
-            bus_dist_approx = route_distances[i]
-        
-        # Track closest segment
-        min_dist_to_segment = min(dist_a, dist_b)
-        if min_dist_to_segment < min_dist_to_route:
-            min_dist_to_route = min_dist_to_segment
-            bus_distance_from_start = bus_dist_approx
-            current_segment_idx = i
-    
-    # If bus is past target stop, ETA is immediate
-    if bus_distance_from_start >= route_distances[target_stop_idx]:
-        return current_time, 0
-    
-    # Get scheduled_arrival_minutes for all stops
-    scheduled_minutes = []
-    for stop in stops:
-        minutes = stop.get("scheduled_arrival_minutes")
-        if minutes is not None:
-            scheduled_minutes.append(minutes)
-        elif scheduled_minutes:
-            # Estimate: add 10 minutes from previous stop
-            scheduled_minutes.append(scheduled_minutes[-1] + 10)
-        else:
-            scheduled_minutes.append(0)
-    
-    if len(scheduled_minutes) < 2:
-        return None, None
-    
-    # Calculate current time position (minutes from start) by interpolating within segment
-    if current_segment_idx < len(scheduled_minutes) - 1:
-        segment_start_minutes = scheduled_minutes[current_segment_idx]
-        segment_end_minutes = scheduled_minutes[current_segment_idx + 1]
-        segment_distance = route_distances[current_segment_idx + 1] - route_distances[current_segment_idx]
-        
-        if segment_distance > 0.001:
-            progress = (bus_distance_from_start - route_distances[current_segment_idx]) / segment_distance
-            progress = max(0.0, min(1.0, progress))
-            current_minutes_from_start = segment_start_minutes + (segment_end_minutes - segment_start_minutes) * progress
-        else:
-            current_minutes_from_start = segment_start_minutes
-    else:
-        # Bus is at or past last stop
-        current_minutes_from_start = scheduled_minutes[-1]
-    
-    # Calculate remaining time to target stop
-    target_minutes_from_start = scheduled_minutes[target_stop_idx]
-    remaining_minutes = max(0, target_minutes_from_start - current_minutes_from_start)
-    
-    # Calculate ETA
-    eta = current_time + timedelta(minutes=remaining_minutes)
-    
-    # Calculate delay (ETA vs scheduled time)
-    target_scheduled = target_stop.get("scheduled")
-    if target_scheduled:
-        if isinstance(target_scheduled, str):
-            target_scheduled = datetime.fromisoformat(target_scheduled.replace('Z', '+00:00'))
-        if isinstance(target_scheduled, datetime):
-            if target_scheduled.tzinfo is None:
-                try:
-                    target_scheduled = target_scheduled.replace(tzinfo=ZoneInfo("Asia/Kolkata"))
-                except Exception:
-                    target_scheduled = target_scheduled.replace(tzinfo=timezone(timedelta(hours=5, minutes=30)))
-            delay_minutes = int((eta - target_scheduled).total_seconds() / 60)
-        else:
-            delay_minutes = 0
-    else:
-        delay_minutes = 0
-    
-    return eta, delay_minutes
-
-
-def _compute_route_distances(stops: list) -> list:
-    """Cumulative distances from start for each stop."""
-    dists = [0.0]
-    for i in range(1, len(stops)):
-        p, c = stops[i - 1], stops[i]
-        if p.get("latitude") and c.get("latitude"):
-            d = haversine_distance(p["latitude"], p["longitude"], c["latitude"], c["longitude"])
-            dists.append(dists[-1] + d)
-        else:
-            dists.append(dists[-1] + 1.0)
-    return dists
-
-
-def _compute_bus_position(lat: float, lon: float, stops: list, route_distances: list) -> float:
-    """Bus distance from start in km, or 0 if no GPS."""
-    if not stops or not route_distances:
-        return 0.0
-    min_dist = float("inf")
-    bus_dist = 0.0
-    for i in range(len(stops) - 1):
-        a, b = stops[i], stops[i + 1]
-        if not (a.get("latitude") and b.get("latitude")):
-            continue
-        da = haversine_distance(lat, lon, a["latitude"], a["longitude"])
-        db = haversine_distance(lat, lon, b["latitude"], b["longitude"])
-        seg = route_distances[i + 1] - route_distances[i]
-        if seg > 0.001:
-            prog = max(0, min(1, da / (da + db))) if (da + db) > 0.001 else 0
-            bd = route_distances[i] + seg * prog
-        else:
-            bd = route_distances[i]
-        if min(da, db) < min_dist:
-            min_dist = min(da, db)
-            bus_dist = bd
-    return bus_dist
+    # Versions are per process; the fix time keeps tags from different workers apart
+    etag = _etag("status", bus_number, result.recorded_at, store.get_state_version(bus_number), result.status,
+                 result.last_seen_seconds // LAST_SEEN_STEP_SECONDS)
+    headers = _cache_headers(etag, result.recorded_at)
+    if _not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return result
 
 
 @router.get("/bus/{bus_number}/stops", response_model=schemas.StopEtaResponse)
-def passenger_stop_etas(bus_number: str, store: DatabaseStore = Depends(get_store)):
-    """Get ETA for all stops. Passed stops: no ETA; at_stop: 'At stop'; upcoming: ETA."""
-    delay_info = store.get_delay(bus_number)
-    base_delay = delay_info.get("delay_minutes", 0)
-
+def passenger_stop_etas(bus_number: str, request: Request, response: Response, store: DatabaseStore = Depends(get_store)):
+    """Get ETA for all stops. Passed stops: no ETA; at_stop: 'At stop'; upcoming: ETA.
+    ETag: last fix plus the ETA inputs key (location, delay, route, arrivals, history), checked before computing."""
     last_location = store.get_last_location(bus_number)
-    current_lat = last_location.get("latitude") if last_location else None
-    current_lon = last_location.get("longitude") if last_location else None
-    session_id = last_location.get("session_id") if last_location else None
-
-    db_stops = store.get_stops_for_bus(bus_number)
-    schedule = db_stops if db_stops else _fake_schedule(bus_number)
-    if not schedule or len(schedule) == 0:
+    recorded_at = last_location["recorded_at"] if last_location else None
+    etag = _etag("stops", bus_number, recorded_at, eta_inputs_key(store, bus_number))
+    headers = _cache_headers(etag, recorded_at)
+    if _not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    result = compute_stop_etas(store, bus_number)
+    if result is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No stops found for this bus")
+    response.headers.update(headers)
+    return result
 
-    try:
-        india_tz = ZoneInfo("Asia/Kolkata")
-    except Exception:
-        india_tz = timezone(timedelta(hours=5, minutes=30))
-    now = datetime.now(india_tz)
-
-    arrivals = store.get_stop_arrivals_for_session(session_id)
-    route_distances = _compute_route_distances(schedule)
-    bus_dist = _compute_bus_position(current_lat or 0, current_lon or 0, schedule, route_distances) if current_lat and current_lon else 0.0
-
-    use_scheduled_calculation = (
-        current_lat is not None and current_lon is not None and
-        len(schedule) > 0 and all(s.get("scheduled_arrival_minutes") is not None for s in schedule)
-    )
 
-    stops_out = []
-    for idx, entry in enumerate(schedule):
-        scheduled = entry.get("scheduled")
-        if isinstance(scheduled, datetime):
-            if scheduled.tzinfo is None:
-                scheduled = scheduled.replace(tzinfo=timezone.utc).astimezone(india_tz)
-            else:
-                scheduled = scheduled.astimezone(india_tz)
-        else:
-            scheduled = now.replace(minute=0, second=0, microsecond=0)
-
-        stop_dist = route_distances[idx] if idx < len(route_distances) else 0
-        stop_lat = entry.get("latitude")
-        stop_lon = entry.get("longitude")
-        dist_to_stop = haversine_distance(current_lat or 0, current_lon or 0, stop_lat or 0, stop_lon or 0) if current_lat and stop_lat else 999.0
-
-        is_passed = bus_dist >= stop_dist
-        is_at_stop = not is_passed and dist_to_stop < 0.02
-
-        actual_arrived = None
-        stop_id = entry.get("stop_id")
-        if stop_id and stop_id in arrivals:
-            actual_arrived = arrivals[stop_id]
-            if actual_arrived.tzinfo is None:
-                actual_arrived = actual_arrived.replace(tzinfo=timezone.utc).astimezone(india_tz)
-            elif actual_arrived.tzinfo != india_tz:
-                actual_arrived = actual_arrived.astimezone(india_tz)
-
-        eta = None
-        status_label = "on_time"
-        delay = base_delay
-
-        if is_passed:
-            eta = None
-            status_label = "arrived"
-            delay = 0
-        elif is_at_stop:
-            eta = None
-            status_label = "at_stop"
-            delay = 0
-        else:
-            if use_scheduled_calculation and stop_lat and stop_lon:
-                eta_result = calculate_eta_from_scheduled_times(current_lat, current_lon, schedule, now, idx)
-                if eta_result and eta_result[0]:
-                    eta, delay = eta_result
-                    status_label = "on_time" if delay <= 1 and delay >= -1 else ("delayed" if delay > 1 else "early")
-                else:
-                    eta = scheduled + timedelta(minutes=base_delay)
-                    status_label = "on_time"
-            else:
-                eta = scheduled + timedelta(minutes=base_delay)
-                status_label = "on_time"
-
-        stops_out.append(
-            schemas.StopEta(
-                stop_name=entry.get("name", f"Stop {idx + 1}"),
-                scheduled_time=scheduled,
-                eta=eta,
-                actual_arrived_at=actual_arrived,
-                delay_minutes=delay,
-                status=status_label,
-                latitude=stop_lat,
-                longitude=stop_lon,
-            )
+@router.get("/buses", response_model=schemas.BusSummaryResponse)
+def passenger_buses(numbers: str, store: DatabaseStore = Depends(get_store)):
+    """
+    Status and next-stop ETA for many buses at once: ?numbers=12,14,27 (up to MAX_BATCH_BUSES).
+    Caches are warmed for the whole set with a few IN queries, then every bus is served
+    from memory (live state, compiled routes, ETA cache).
+    """
+    bus_numbers = list(dict.fromkeys(n.strip() for n in numbers.split(",") if n.strip()))
+    if not bus_numbers:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No bus numbers given")
+    if len(bus_numbers) > MAX_BATCH_BUSES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BATCH_BUSES} buses per request",
         )
-
-    return schemas.StopEtaResponse(bus_number=bus_number, stops=stops_out)
+    
+    routes = store.preload_buses(bus_numbers)
+    buses = []
+    for bus_number in bus_numbers:
+        next_stop = None
+        # Unknown bus numbers get no demo schedule here (and cost no further queries)
+        if routes[bus_number].known and len(routes[bus_number]) > 0:
+            etas = compute_stop_etas(store, bus_number)
+            next_stop = next((stop for stop in etas.stops if stop.status != "arrived"), None) if etas else None
+        buses.append(schemas.BusSummary(
+            bus_number=bus_number,
+            status=build_bus_status(store, bus_number),
+            next_stop=next_stop,
+        ))
+    return schemas.BusSummaryResponse(buses=buses)
 
 
 @router.get("/track/{code}")
@@ -458,17 +246,109 @@ def resolve_tracking_code(code: str, store: DatabaseStore = Depends(get_store)):
     return {"bus_number": tracking.bus_number, "code": code}
 
 
+def _load_snapshot(bus_number: str, with_stops: bool = True) -> dict:
+    """Status (as GET /bus/{n}) and stop ETAs (as GET /bus/{n}/stops) for a WebSocket snapshot.
+    Served from the live state, compiled route and arrival caches; the DB is only hit when they are cold."""
+    db = SessionLocal()
+    try:
+        store = DatabaseStore(db)
+        bus_status = build_bus_status(store, bus_number)
+        stops = None
+        if with_stops:
+            etas = compute_stop_etas(store, bus_number)
+            stops = etas.model_dump(mode="json")["stops"] if etas is not None else None
+        return {
+            "status": bus_status.model_dump(mode="json") if bus_status is not None else None,
+            "stops": stops,
+        }
+    finally:
+        db.close()
+
+
+def _send_connect_snapshot(websocket: WebSocket, bus_number: str, state: dict, cached_stops) -> None:
+    """First frame on connect: latest location/delay and stop ETAs, so the page needs no HTTP bootstrap.
+    Prefers the stop list last broadcast for the bus (the delta base) over the one computed at connect."""
+    current = websocket_manager.get_stop_snapshot(bus_number)
+    if current is not None:
+        seq, stops = current
+    else:
+        stops = cached_stops[1] if cached_stops is not None else state["stops"]
+        seq = websocket_manager.set_stop_snapshot(bus_number, stops) if stops is not None else None
+    websocket_manager.send(websocket, bus_number, {
+        "type": "snapshot",
+        "bus_number": bus_number,
+        "seq": seq,
+        "status": state["status"],
+        "stops": stops,
+    })
+
+
+async def _send_stop_snapshot(websocket: WebSocket, bus_number: str) -> None:
+    """Queue the full stop list for a delta client (resync), computing it if nothing was broadcast yet"""
+    if websocket_manager.send_stop_snapshot(websocket, bus_number):
+        return
+    state = await run_db(_load_snapshot, bus_number)
+    if state["stops"] is not None:
+        websocket_manager.set_stop_snapshot(bus_number, state["stops"])
+        websocket_manager.send_stop_snapshot(websocket, bus_number)
+
+
+@router.get("/bus/{bus_number}/events")
+async def passenger_bus_events(bus_number: str, request: Request):
+    """
+    Server-Sent Events alternative to the WebSocket for networks and proxies that break it.
+    Same pipeline and JSON messages as the plain WebSocket (snapshot first, then location_update,
+    delay_update and full stops_update), one per "data:" line. Every broadcast has an event id;
+    a reconnect with Last-Event-ID (EventSource sends it automatically) gets only the events it
+    missed from the bus's replay buffer, or a fresh snapshot when they are no longer there.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    # As on the WebSocket: register first (broadcasts held back), then read and queue the snapshot
+    stream, resumed = websocket_manager.connect_stream(bus_number, last_event_id, hold=True)
+    if not resumed:
+        try:
+            cached_stops = websocket_manager.get_stop_snapshot(bus_number)
+            state = await run_db(_load_snapshot, bus_number, cached_stops is None)
+        except Exception:
+            websocket_manager.disconnect(stream, bus_number)
+            raise
+        _send_connect_snapshot(stream, bus_number, state, cached_stops)
+    websocket_manager.release(stream, bus_number)
+    return StreamingResponse(
+        websocket_manager.stream_frames(stream, bus_number),
+        media_type="text/event-stream",
+        # No caching or proxy buffering: events must reach the client as they are written
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.websocket("/ws/bus/{bus_number}")
-async def websocket_endpoint(websocket: WebSocket, bus_number: str):
-    """WebSocket endpoint for real-time bus location updates"""
-    await websocket_manager.connect(websocket, bus_number)
+async def websocket_endpoint(websocket: WebSocket, bus_number: str, mode: str = "json"):
+    """
+    WebSocket endpoint for real-time bus location updates.
+    The first frame is a snapshot: {status, stops, seq} with the same shapes as the HTTP endpoints.
+    mode=delta: after the snapshot only stops_delta frames (changed stops, with a seq number);
+    the client sends "resync" after a gap to get a fresh stops_snapshot.
+    """
+    delta = mode == "delta"
     try:
+        # Register first with broadcasts held back, then read the snapshot: every update is either
+        # in the snapshot or held, and held ones are queued after it
+        await websocket_manager.connect(websocket, bus_number, delta=delta, hold=True)
+        cached_stops = websocket_manager.get_stop_snapshot(bus_number)
+        state = await run_db(_load_snapshot, bus_number, cached_stops is None)
+        _send_connect_snapshot(websocket, bus_number, state, cached_stops)
+        websocket_manager.release(websocket, bus_number)
         while True:
             # Keep connection alive and handle any incoming messages
             data = await websocket.receive_text()
-            # Echo back or handle ping/pong
+            # Any frame (usually the "pong" answering a heartbeat) shows the client is still there
+            websocket_manager.touch(websocket, bus_number)
+            # Cached pages may still send "ping"
             if data == "ping":
-                await websocket.send_text("pong")
+                websocket_manager.send(websocket, bus_number, "pong")
+            elif data == "resync" and delta:
+                await _send_stop_snapshot(websocket, bus_number)
     except WebSocketDisconnect:
         websocket_manager.disconnect(websocket, bus_number)
     except Exception as e:
@@ -19,6 +19,11 @@ class LocationUpdate(BaseModel):
     recorded_at: datetime
 
 
+class LocationBatchUpdate(BaseModel):
+    """Buffered fixes from the driver app, oldest first."""
+    locations: List[LocationUpdate] = Field(..., min_length=1, max_length=500)
+
+
 class LastLocation(BaseModel):
     latitude: float
     longitude: float
@@ -45,3 +50,14 @@ class StopEtaResponse(BaseModel):
     bus_number: str
     stops: List[StopEta]
 
+
+
+class BusSummary(BaseModel):
+    """One bus in GET /passenger/buses"""
+    bus_number: str
+    status: Optional[LastLocation] = None  # None if the bus never reported a location
+    next_stop: Optional[StopEta] = None  # First stop not yet passed; None without a route
+
+
+class BusSummaryResponse(BaseModel):
+    buses: List[BusSummary]
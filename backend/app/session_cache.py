@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import threading
+import time
+
+from .config import settings
+
+
+class SessionCache:
+    """
+    In-memory token -> {bus_number, session_id, expires_at} cache with TTL and LRU eviction.
+    Saves the DriverSession lookup on every driver ping. Entries are dropped when the
+    admin routes deactivate a session or delete a bus; the TTL bounds staleness for
+    changes made elsewhere (another worker, direct DB edits).
+    """
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max(1, max_size)
+        # token -> (cached_until monotonic, session info)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_until, info = entry
+            if cached_until < time.monotonic() or _is_expired(info):
+                del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return info
+
+    def put(self, token: str, info: Dict) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self.ttl_seconds, info)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_token(self, token: str) -> None:
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def invalidate_session(self, session_id: int) -> None:
+        with self._lock:
+            for token in [t for t, (_, info) in self._entries.items() if info["session_id"] == session_id]:
+                del self._entries[token]
+
+    def invalidate_bus(self, bus_number: str) -> None:
+        with self._lock:
+            for token in [t for t, (_, info) in self._entries.items() if info["bus_number"] == bus_number]:
+                del self._entries[token]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _is_expired(info: Dict) -> bool:
+    expires_at = info.get("expires_at")
+    if expires_at is None:
+        return False
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at <= datetime.now(timezone.utc)
+
+
+# Global session cache instance
+session_cache = SessionCache(
+    ttl_seconds=settings.session_cache_ttl_seconds,
+    max_size=settings.session_cache_max_size,
+)
@@ -0,0 +1,139 @@
+"""
+Keeps each worker's in-memory state (live_state, route_cache, eta_cache, session_cache, arrival_tracker)
+in step with the other workers when running uvicorn --workers N with the broker pub/sub backend.
+
+Code that changes shared state calls one of the functions below instead of touching the
+caches directly: the change is applied locally, then broadcast through websocket_manager.pubsub,
+and every other worker applies it in apply_remote. With the memory backend (single process)
+the broadcast is a no-op. After connecting to the broker a worker gets RESYNC and drops its
+caches, so events missed while it was disconnected cannot leave it stale.
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from .arrival_tracker import arrival_tracker
+from .eta_cache import eta_cache
+from .live_state import live_state
+from .route_cache import route_cache
+from .session_cache import session_cache
+from .websocket_manager import websocket_manager
+from .ws_pubsub import RESYNC
+
+ROUTE_CHANGED = "sync.route"
+BUS_REMOVED = "sync.bus_removed"
+SESSION_ENDED = "sync.session_ended"
+ARRIVALS_CHANGED = "sync.arrivals"
+LOCATION_UPDATED = "sync.location"
+DELAY_UPDATED = "sync.delay"
+
+
+def _broadcast(kind: str, bus_number: str, data: Any = None) -> None:
+    try:
+        websocket_manager.pubsub.broadcast(kind, bus_number, data)
+    except Exception as e:
+        print(f"State sync broadcast failed ({kind}): {e}")
+
+
+def _invalidate_route(bus_number: str, data: Any = None) -> None:
+    route_cache.invalidate(bus_number)
+    # Its key would miss on the new route version anyway; don't keep the old stop list around
+    eta_cache.invalidate(bus_number)
+
+
+def _remove_bus(bus_number: str, data: Any = None) -> None:
+    session_cache.invalidate_bus(bus_number)
+    route_cache.invalidate(bus_number)
+    live_state.remove(bus_number)
+    eta_cache.invalidate(bus_number)
+
+
+def _end_session(bus_number: str, data: Any) -> None:
+    session_cache.invalidate_session(data["session_id"])
+
+
+def _forget_arrivals(bus_number: str, data: Any) -> None:
+    # Reloaded from stop_arrivals on next use (the rows are committed before the broadcast)
+    arrival_tracker.forget(data["session_id"])
+
+
+def _apply_location(bus_number: str, data: Any) -> None:
+    live_state.update_location(
+        bus_number, data["latitude"], data["longitude"],
+        datetime.fromisoformat(data["recorded_at"]), data["session_id"],
+    )
+
+
+def _apply_delay(bus_number: str, data: Any) -> None:
+    live_state.update_delay(bus_number, data["delay_minutes"], data["current_stop"], data["next_stop"])
+
+
+def resync() -> None:
+    """Drop everything cached; it is rebuilt from the DB on demand (live_state reloads on next read)"""
+    live_state.clear()
+    route_cache.clear()
+    eta_cache.clear()
+    session_cache.clear()
+    arrival_tracker.clear()
+
+
+def invalidate_route(bus_number: str) -> None:
+    """A bus's route, stops, shape or start time changed (admin edits)"""
+    _invalidate_route(bus_number)
+    _broadcast(ROUTE_CHANGED, bus_number)
+
+
+def remove_bus(bus_number: str) -> None:
+    """A bus was deleted"""
+    _remove_bus(bus_number)
+    _broadcast(BUS_REMOVED, bus_number)
+
+
+def end_session(bus_number: str, session_id: int) -> None:
+    """A driver session was deactivated; its token must stop working on every worker"""
+    _end_session(bus_number, {"session_id": session_id})
+    _broadcast(SESSION_ENDED, bus_number, {"session_id": session_id})
+
+
+def location_updated(
+    bus_number: str, latitude: float, longitude: float,
+    recorded_at: datetime, session_id: Optional[int],
+) -> None:
+    """A fix was stored; batches only need to send their newest fix"""
+    live_state.update_location(bus_number, latitude, longitude, recorded_at, session_id)
+    _broadcast(LOCATION_UPDATED, bus_number, {
+        "latitude": latitude,
+        "longitude": longitude,
+        "recorded_at": recorded_at.isoformat(),
+        "session_id": session_id,
+    })
+
+
+def delay_updated(bus_number: str, delay_minutes: int, current_stop: Optional[str], next_stop: Optional[str]) -> None:
+    data = {"delay_minutes": delay_minutes, "current_stop": current_stop, "next_stop": next_stop}
+    _apply_delay(bus_number, data)
+    _broadcast(DELAY_UPDATED, bus_number, data)
+
+
+def arrivals_recorded(bus_number: str, session_id: int) -> None:
+    """New stop arrivals were committed for a session (already applied to the local tracker)"""
+    _broadcast(ARRIVALS_CHANGED, bus_number, {"session_id": session_id})
+
+
+_APPLY: Dict[str, Callable[[str, Any], None]] = {
+    ROUTE_CHANGED: _invalidate_route,
+    BUS_REMOVED: _remove_bus,
+    SESSION_ENDED: _end_session,
+    ARRIVALS_CHANGED: _forget_arrivals,
+    LOCATION_UPDATED: _apply_location,
+    DELAY_UPDATED: _apply_delay,
+}
+
+
+def apply_remote(kind: str, bus_number: str, data: Any) -> None:
+    """Apply another worker's change (websocket_manager sync handler)"""
+    if kind == RESYNC:
+        resync()
+        return
+    apply = _APPLY.get(kind)
+    if apply is not None:
+        apply(bus_number, data)
@@ -0,0 +1,214 @@
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import threading
+
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .models import Stop, StopArrival
+from .config import settings
+
+try:
+    INDIA_TZ = ZoneInfo("Asia/Kolkata")
+except Exception:
+    INDIA_TZ = timezone(timedelta(hours=5, minutes=30))
+
+# Stop-to-stop times outside this range are GPS glitches or a bus parked mid-route, not travel
+MIN_SEGMENT_SECONDS = 5
+MAX_SEGMENT_SECONDS = 2 * 60 * 60
+# After this many samples the average becomes exponentially weighted, so it follows changing traffic
+FULL_AVERAGE_SAMPLES = 20
+
+# (from_stop_id, to_stop_id, weekday or None for any day, time-of-day bucket)
+SegmentKey = Tuple[int, int, Optional[int], int]
+
+
+class SegmentTravelTimes:
+    """
+    In-memory table of typical travel times between consecutive stops, by weekday and
+    time-of-day bucket (IST), aggregated from the stop_arrivals history.
+    A background thread folds in StopArrival rows newer than the last one it has seen, so the
+    ETA path only does dict lookups. Each worker builds its own copy (history is replayed
+    once at startup in batches).
+    """
+
+    def __init__(self, refresh_interval: float, bucket_minutes: int, min_samples: int, batch_size: int = 5000):
+        self.refresh_interval = refresh_interval
+        self.bucket_minutes = max(1, bucket_minutes)
+        self.min_samples = max(1, min_samples)
+        self.batch_size = max(1, batch_size)
+        # key -> [samples, average seconds]
+        self._segments: Dict[SegmentKey, List[float]] = {}
+        # (from_stop_id, to_stop_id) pairs with any data, to skip lookups for routes without history
+        self._pairs: set = set()
+        self._last_id = 0
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Bumped whenever new samples land (part of the ETA cache key)
+        self.version = 0
+        # Metrics
+        self.samples = 0
+        self.rows_seen = 0
+        self.refreshes = 0
+        self.failed_refreshes = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the background refresh thread"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="segment-travel-times", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _bucket(self, at: datetime) -> Tuple[int, int]:
+        """(weekday, bucket) of a moment in IST; naive datetimes are UTC"""
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        local = at.astimezone(INDIA_TZ)
+        return local.weekday(), (local.hour * 60 + local.minute) // self.bucket_minutes
+
+    def _add(self, from_stop_id: int, to_stop_id: int, departed_at: datetime, seconds: float) -> None:
+        weekday, bucket = self._bucket(departed_at)
+        for key in ((from_stop_id, to_stop_id, weekday, bucket), (from_stop_id, to_stop_id, None, bucket)):
+            stat = self._segments.get(key)
+            if stat is None:
+                self._segments[key] = [1, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += (seconds - stat[1]) / min(stat[0], FULL_AVERAGE_SAMPLES)
+        self._pairs.add((from_stop_id, to_stop_id))
+        self.samples += 1
+
+    def segment_seconds(self, from_stop_id: int, to_stop_id: int, at: datetime) -> Optional[float]:
+        """Typical travel time for a segment started at `at`: same weekday and bucket, else any
+        weekday in that bucket; None below min_samples"""
+        weekday, bucket = self._bucket(at)
+        for key in ((from_stop_id, to_stop_id, weekday, bucket), (from_stop_id, to_stop_id, None, bucket)):
+            stat = self._segments.get(key)
+            if stat is not None and stat[0] >= self.min_samples:
+                return stat[1]
+        return None
+
+    def segment_lookup(self, stop_ids: List[Optional[int]]) -> Optional[Callable[[int, datetime], Optional[float]]]:
+        """(segment index, start time) -> minutes for segment i (stop i -> i + 1) of a route,
+        or None if no segment of the route has any history"""
+        pairs = [(a, b) for a, b in zip(stop_ids, stop_ids[1:])]
+        if not any(pair in self._pairs for pair in pairs):
+            return None
+
+        def lookup(idx: int, at: datetime) -> Optional[float]:
+            a, b = pairs[idx]
+            if (a, b) not in self._pairs:
+                return None
+            seconds = self.segment_seconds(a, b, at)
+            return seconds / 60 if seconds is not None else None
+        return lookup
+
+    def refresh(self) -> int:
+        """Fold StopArrival rows added since the last refresh into the table. Returns rows read."""
+        total = 0
+        with self._refresh_lock:
+            while True:
+                db = SessionLocal()
+                try:
+                    count = self._refresh_batch(db)
+                finally:
+                    db.close()
+                total += count
+                if count < self.batch_size:
+                    break
+        self.refreshes += 1
+        return total
+
+    def _refresh_batch(self, db) -> int:
+        rows = db.query(StopArrival).filter(StopArrival.id > self._last_id).order_by(StopArrival.id).limit(self.batch_size).all()
+        if not rows:
+            return 0
+
+        # Route order of every stop involved: previous and next stop ids
+        route_ids = select(Stop.route_id).where(Stop.stop_id.in_({r.stop_id for r in rows}))
+        neighbours: Dict[int, Tuple[Optional[int], Optional[int]]] = {}
+        route_stops: Dict[int, List[int]] = {}
+        for stop_id, route_id in db.query(Stop.stop_id, Stop.route_id).filter(Stop.route_id.in_(route_ids)).order_by(Stop.route_id, Stop.sequence_order):
+            route_stops.setdefault(route_id, []).append(stop_id)
+        for ordered in route_stops.values():
+            for idx, stop_id in enumerate(ordered):
+                neighbours[stop_id] = (
+                    ordered[idx - 1] if idx > 0 else None,
+                    ordered[idx + 1] if idx + 1 < len(ordered) else None,
+                )
+
+        # Arrivals of those sessions (a trip is a few dozen rows), for the other end of each segment
+        arrivals = {
+            (a.session_id, a.stop_id): a
+            for a in db.query(StopArrival).filter(StopArrival.session_id.in_({r.session_id for r in rows}))
+        }
+
+        added = 0
+        for row in rows:
+            previous_id, next_id = neighbours.get(row.stop_id, (None, None))
+            # Each segment is counted once, when the later of its two rows is read
+            for start, end in (
+                (arrivals.get((row.session_id, previous_id)), row),
+                (row, arrivals.get((row.session_id, next_id))),
+            ):
+                if start is None or end is None or max(start.id, end.id) != row.id:
+                    continue
+                seconds = (end.arrived_at - start.arrived_at).total_seconds()
+                if MIN_SEGMENT_SECONDS <= seconds <= MAX_SEGMENT_SECONDS:
+                    self._add(start.stop_id, end.stop_id, start.arrived_at, seconds)
+                    added += 1
+        self._last_id = rows[-1].id
+        self.rows_seen += len(rows)
+        if added:
+            self.version += 1
+        return len(rows)
+
+    def clear(self) -> None:
+        with self._refresh_lock:
+            self._segments.clear()
+            self._pairs.clear()
+            self._last_id = 0
+            self.samples = 0
+            self.rows_seen = 0
+            self.version += 1
+
+    def metrics(self) -> Dict:
+        return {
+            "enabled": settings.eta_history_enabled,
+            "running": self.running,
+            "segments": len(self._pairs),
+            "samples": self.samples,
+            "rows_seen": self.rows_seen,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                self.failed_refreshes += 1
+                print(f"Segment travel time refresh failed: {e}")
+            self._stop.wait(self.refresh_interval)
+
+
+# Global travel time table; refreshed in the background when settings.eta_history_enabled is on
+travel_times = SegmentTravelTimes(
+    refresh_interval=settings.eta_history_refresh_seconds,
+    bucket_minutes=settings.eta_history_bucket_minutes,
+    min_samples=settings.eta_history_min_samples,
+)
@@ -1,81 +1,629 @@
-from typing import Dict, Set
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 from fastapi import WebSocket
+import asyncio
 import json
 from datetime import datetime, timezone
+import secrets
+import time
+
+from .config import settings
+from .ws_pubsub import FLEET_TOPIC, Handler, create_pubsub
+from .ws_binary import BINARY_SUBPROTOCOL, encode_delay, encode_location
+
+try:
+    import orjson  # Optional: faster JSON encoding for broadcast frames
+except ImportError:
+    orjson = None
+
+
+def _stdlib_encode(message: dict) -> str:
+    # Same output format as Starlette's send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def _orjson_encode(message: dict) -> str:
+    return orjson.dumps(message).decode("utf-8")
+
+
+default_encoder: Callable[[dict], str] = _orjson_encode if orjson is not None else _stdlib_encode
+
+# Per-stop fields that change between pings; everything else in a StopEta is static for the day
+DELTA_FIELDS = ("eta", "status", "delay_minutes", "actual_arrived_at")
+
+
+def _route_fields(stops: List[dict]) -> List[dict]:
+    """The static part of a stop list; when it differs (admin edited a stop) delta clients need a new snapshot"""
+    return [{k: v for k, v in stop.items() if k not in DELTA_FIELDS} for stop in stops]
+
+# Close code for clients that cannot keep up with the broadcast rate (RFC 6455 "Try Again Later")
+WS_CLOSE_SLOW_CONSUMER = 1013
+# Close code for connections reaped after ws_idle_timeout_seconds without a frame from the client
+WS_CLOSE_IDLE = 1001
+
+# Sent to sockets the client has not written to for a heartbeat interval; clients answer with PONG_FRAME.
+# An application frame rather than a protocol ping: ASGI has no ping/pong events, so Starlette can
+# neither send a control ping nor see the pong (uvicorn answers and times them out on its own), and
+# browser JavaScript cannot send one either. The reply is the only liveness signal the app can observe.
+HEARTBEAT_FRAME = '{"type":"heartbeat"}'
+PONG_FRAME = "pong"
+# Event-stream equivalents: a comment line (ignored by EventSource), and the reconnect delay sent first
+SSE_HEARTBEAT_FRAME = ": heartbeat\n\n"
+SSE_RETRY_FRAME = "retry: 3000\n\n"
+
+
+def in_bbox(bbox: Optional[Tuple[float, float, float, float]], position: Optional[Tuple[float, float]]) -> bool:
+    """True if no bbox is set, the position is unknown, or (lat, lon) lies inside the bbox"""
+    if bbox is None or position is None:
+        return True
+    min_lon, min_lat, max_lon, max_lat = bbox
+    latitude, longitude = position
+    return min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+
+
+class EventStream:
+    """Handle of a Server-Sent Events connection; stands in for the WebSocket in active_connections"""
+
+
+class _ReplayBuffer:
+    """
+    The last few broadcasts for one bus as event-stream frames, for Last-Event-ID resume.
+    Event ids are "<token>-<seq>": the token is new for every buffer, so an id from another
+    worker, or from a buffer that was dropped in between, never matches and gets a snapshot.
+    """
+
+    def __init__(self, size: int):
+        self.token = secrets.token_hex(4)
+        self.seq = 0
+        self.events: "deque[Tuple[int, str]]" = deque(maxlen=max(1, size))
+        self.idle_since = time.monotonic()  # Last time the bus lost its last connection
+
+    @property
+    def last_id(self) -> str:
+        return f"{self.token}-{self.seq}"
+
+    def event(self, text: str) -> str:
+        """Event-stream frame for a JSON message, carrying the current id (not recorded)"""
+        return f"id: {self.last_id}\ndata: {text}\n\n"
+
+    def add(self, text: str) -> str:
+        """Number and record a broadcast; returns its frame"""
+        self.seq += 1
+        frame = self.event(text)
+        self.events.append((self.seq, frame))
+        return frame
+
+    def since(self, event_id: str) -> Optional[List[str]]:
+        """Frames after event_id, or None if the id is not from this buffer or events were dropped since"""
+        token, _, seq = event_id.rpartition("-")
+        if token != self.token or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self.seq or seq < self.seq - len(self.events):
+            return None
+        return [frame for event_seq, frame in self.events if event_seq > seq]
+
+
+class _Window:
+    """Conflation state of one bus for the current period: kinds already sent, and the latest
+    held-back event of each kind in publish order"""
+
+    def __init__(self):
+        self.sent: set = set()
+        self.pending: Dict[str, dict] = {}
+        self.flushing = False
+
+
+class _Client:
+    """One passenger connection: a bounded outgoing queue drained by its own sender task
+    (for event streams, by the streaming response body instead)"""
+
+    def __init__(self, websocket: Union[WebSocket, EventStream], bus_number: str, queue_size: int,
+                 delta: bool = False, binary: bool = False, sse: bool = False):
+        self.websocket = websocket
+        self.bus_number = bus_number
+        self.delta = delta  # Versioned mode: stops_snapshot once, then stops_delta frames
+        self.binary = binary  # Negotiated BINARY_SUBPROTOCOL: location/delay as struct frames
+        self.sse = sse  # Server-Sent Events stream: JSON frames wrapped as numbered events
+        self.queue: "asyncio.Queue[Union[str, bytes]]" = asyncio.Queue(maxsize=queue_size)
+        self.sender: Optional[asyncio.Task] = None
+        self.last_sent = time.monotonic()  # Last frame the socket accepted
+        self.last_seen = self.last_sent  # Last frame received from the client (WebSockets only)
+        self.slot = 0  # Heartbeat wheel slot
+        self.bbox: Optional[Tuple[float, float, float, float]] = None  # Fleet streams: (min_lon, min_lat, max_lon, max_lat)
+        self.watch: Optional[str] = None  # Fleet streams: bus whose stop lists are forwarded too (admin monitor)
+        self.held: Optional[List[Union[str, bytes]]] = None  # Broadcasts kept back until its snapshot is queued (release)
 
 
 class WebSocketManager:
     """
     Manages WebSocket connections for real-time bus location updates.
-    bus_number -> Set of WebSocket connections
+    bus_number -> {WebSocket: client}. Broadcasts only enqueue; each connection's
+    sender task does the actual socket writes, so one slow client never delays the others
+    (or the driver request that triggered the broadcast). Each frame is encoded to text
+    once per broadcast and the same string is queued for every subscriber.
+    Broadcasts are delivered locally and also published through self.pubsub so passengers
+    connected to other worker processes get them too (see ws_pubsub). Bursts are conflated
+    per bus first (ws_conflation_ms), which bounds the frame rate per bus and kind without
+    reordering the bus's events.
+    Liveness: one heartbeat task walks a timer wheel with one slot per second, so each
+    connection is visited once per heartbeat interval. A WebSocket the client has not written
+    to for a heartbeat interval gets a heartbeat frame, which clients answer with "pong"; one
+    that sent nothing for the idle timeout is closed and removed. This is judged on inbound
+    frames (the endpoints call touch()) because a half-open socket keeps accepting writes into
+    the kernel buffer. Protocol-level pings would be cheaper but are out of reach here (see
+    HEARTBEAT_FRAME); uvicorn's ws_ping_interval still closes dead TCP connections on its own,
+    which reaches the endpoint as a disconnect. Event streams have no inbound channel: they get a heartbeat comment when
+    quiet and are closed only when a write fails or stays blocked for the idle timeout.
+    Server-Sent Events streams (connect_stream) are registered like sockets and get the plain
+    JSON broadcasts; every bus with a stream also keeps a small replay buffer of numbered events,
+    retained for replay_idle_seconds after its last connection so reconnects can resume.
     """
     
-    def __init__(self):
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+    def __init__(
+        self,
+        queue_size: int = settings.ws_send_queue_size,
+        encoder: Optional[Callable[[dict], str]] = None,
+        pubsub=None,
+        heartbeat_seconds: int = settings.ws_heartbeat_seconds,
+        idle_timeout_seconds: float = settings.ws_idle_timeout_seconds,
+        conflation_ms: int = settings.ws_conflation_ms,
+        replay_size: int = settings.sse_replay_size,
+        replay_idle_seconds: float = settings.sse_replay_idle_seconds,
+    ):
+        self.queue_size = queue_size
+        self.encode = encoder or default_encoder
+        self.pubsub = pubsub or create_pubsub(settings.ws_pubsub_backend, settings.ws_pubsub_address)
+        self.active_connections: Dict[str, Dict[WebSocket, _Client]] = {}
+        # bus_number -> (seq, stops) last stop ETA list sent; base for delta frames
+        self._stop_snapshots: Dict[str, Tuple[int, List[dict]]] = {}
+        self.heartbeat_seconds = max(1, heartbeat_seconds)
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self._wheel: List[set] = [set() for _ in range(self.heartbeat_seconds)]
+        self._tick = 0
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # bus_number -> (latitude, longitude) of the last location broadcast, for fleet bbox filters
+        self._positions: Dict[str, Tuple[float, float]] = {}
+        self.evicted = 0
+        self.reaped = 0
+        self.heartbeats = 0
+        # Conflation: (bus_number, kind) -> latest data held back while that window is open
+        self.conflation_seconds = max(0, conflation_ms) / 1000
+        self._windows: Dict[str, _Window] = {}
+        self._window_tasks: set = set()
+        self.sent_events = 0
+        self.coalesced_events = 0
+        # bus_number -> replay buffer of numbered events for SSE resume
+        self.replay_size = replay_size
+        self.replay_idle_seconds = replay_idle_seconds
+        self._replay: Dict[str, _ReplayBuffer] = {}
+        self.resumed_streams = 0
+        # bus_number -> fleet streams watching its stop lists
+        self._watchers: Dict[str, set] = {}
+        self._deliver = {
+            "location": self._deliver_location,
+            "delay": self._deliver_delay,
+            "stops": self._deliver_stops,
+        }
+        # Receives the other workers' state sync events ("sync.*" kinds, see state_sync)
+        self._sync_handler: Optional[Handler] = None
+
+    def set_sync_handler(self, handler: Handler) -> None:
+        self._sync_handler = handler
+
+    async def start(self):
+        """Start the cross-process pub/sub backend (app lifespan)"""
+        await self.pubsub.start(self._deliver_remote)
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await self.pubsub.stop()
     
-    async def connect(self, websocket: WebSocket, bus_number: str):
-        """Add a new WebSocket connection for a bus"""
-        await websocket.accept()
-        if bus_number not in self.active_connections:
-            self.active_connections[bus_number] = set()
-        self.active_connections[bus_number].add(websocket)
-        print(f"WebSocket connected for bus {bus_number}. Total connections: {len(self.active_connections.get(bus_number, set()))}")
+    async def accept(self, websocket: WebSocket) -> None:
+        """Accept a socket, choosing BINARY_SUBPROTOCOL when the client offers it (JSON text otherwise).
+        For endpoints that talk to the client before connect(accepted=True), e.g. to authenticate."""
+        binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        await websocket.accept(subprotocol=BINARY_SUBPROTOCOL if binary else None)
+
+    async def connect(
+        self, websocket: WebSocket, bus_number: str, delta: bool = False,
+        accepted: bool = False, hold: bool = False,
+    ):
+        """Add a new WebSocket connection for a bus (delta=True for versioned stop updates).
+        Accepts it first (see accept) unless the endpoint already did. hold=True keeps broadcasts
+        back until release(), so the endpoint can read and send a snapshot without losing any."""
+        if not accepted:
+            await self.accept(websocket)
+        binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        client = _Client(websocket, bus_number, self.queue_size, delta=delta, binary=binary)
+        if hold:
+            client.held = []
+        client.sender = asyncio.create_task(self._send_loop(client))
+        self._register(client)
+        print(f"WebSocket connected for bus {bus_number}. Total connections: {self.get_connection_count(bus_number)}")
+
+    def _register(self, client: _Client) -> None:
+        # Spread connections over the wheel: the slot the hand just passed is the one visited last
+        client.slot = self._tick % self.heartbeat_seconds
+        self._wheel[client.slot].add(client)
+        if not self._wanted(client.bus_number):
+            self.pubsub.subscribe(client.bus_number)
+        self.active_connections.setdefault(client.bus_number, {})[client.websocket] = client
+
+    def _wanted(self, bus_number: str) -> bool:
+        """Whether this worker needs the bus's events (connections, a replay buffer or a watching fleet stream)"""
+        return bus_number in self.active_connections or bus_number in self._replay or bus_number in self._watchers
+
+    def watch(self, websocket: WebSocket, bus_number: Optional[str]) -> None:
+        """Forward one bus's stop lists (stops_update) to a fleet stream as well; None to stop"""
+        client = self.active_connections.get(FLEET_TOPIC, {}).get(websocket)
+        if client is None:
+            return
+        self._unwatch(client)
+        if bus_number is not None:
+            if not self._wanted(bus_number):
+                self.pubsub.subscribe(bus_number)
+            self._watchers.setdefault(bus_number, set()).add(client)
+            client.watch = bus_number
+
+    def _unwatch(self, client: _Client) -> None:
+        bus_number = client.watch
+        if bus_number is None:
+            return
+        client.watch = None
+        watchers = self._watchers.get(bus_number)
+        if watchers is not None:
+            watchers.discard(client)
+            if not watchers:
+                del self._watchers[bus_number]
+        if not self._wanted(bus_number):
+            self.pubsub.unsubscribe(bus_number)
+            self._stop_snapshots.pop(bus_number, None)
+
+    def touch(self, websocket: WebSocket, bus_number: str) -> None:
+        """The client sent a frame (pong, resync, bbox...): it is still there"""
+        client = self.active_connections.get(bus_number, {}).get(websocket)
+        if client is not None:
+            client.last_seen = time.monotonic()
+
+    def _missed_events(self, bus_number: str, last_event_id: Optional[str]) -> Optional[List[str]]:
+        """Frames a stream resuming after last_event_id needs, or None if it needs a snapshot
+        (unknown id, or more missed events than its queue holds)"""
+        replay = self._replay.get(bus_number)
+        if replay is None or not last_event_id:
+            return None
+        missed = replay.since(last_event_id)
+        if missed is None or len(missed) >= self.queue_size:
+            return None
+        return missed
+
+    def can_resume(self, bus_number: str, last_event_id: Optional[str]) -> bool:
+        return self._missed_events(bus_number, last_event_id) is not None
+
+    def connect_stream(
+        self, bus_number: str, last_event_id: Optional[str] = None, hold: bool = False,
+    ) -> Tuple[EventStream, bool]:
+        """Register a Server-Sent Events stream for a bus. If last_event_id is still in the bus's
+        replay buffer the missed events are queued and resumed is True; otherwise the caller queues
+        a snapshot (send), holding broadcasts back until release() as for connect(hold=True)."""
+        missed = self._missed_events(bus_number, last_event_id)
+        stream = EventStream()
+        client = _Client(stream, bus_number, self.queue_size, sse=True)
+        if hold:
+            client.held = []
+        self._register(client)
+        if bus_number not in self._replay:
+            self._replay[bus_number] = _ReplayBuffer(self.replay_size)
+        for frame in missed or []:
+            self._put(client, frame)
+        if missed is not None:
+            self.resumed_streams += 1
+        print(f"Event stream connected for bus {bus_number}. Total connections: {self.get_connection_count(bus_number)}")
+        return stream, missed is not None
+
+    async def stream_frames(self, stream: EventStream, bus_number: str) -> AsyncIterator[str]:
+        """Body of a Server-Sent Events response: queued frames until the stream is closed or the client leaves"""
+        client = self.active_connections.get(bus_number, {}).get(stream)
+        if client is None:
+            return
+        try:
+            yield SSE_RETRY_FRAME
+            while True:
+                frame = await client.queue.get()
+                if frame is None:
+                    return
+                yield frame
+                client.last_sent = time.monotonic()
+        finally:
+            self.disconnect(stream, bus_number)
     
-    def disconnect(self, websocket: WebSocket, bus_number: str):
-        """Remove a WebSocket connection"""
-        if bus_number in self.active_connections:
-            self.active_connections[bus_number].discard(websocket)
-            if len(self.active_connections[bus_number]) == 0:
-                del self.active_connections[bus_number]
+    def disconnect(self, websocket: Union[WebSocket, EventStream], bus_number: str):
+        """Remove a WebSocket connection (or event stream)"""
+        clients = self.active_connections.get(bus_number)
+        client = clients.pop(websocket, None) if clients is not None else None
+        if clients is not None and len(clients) == 0:
+            del self.active_connections[bus_number]
+            replay = self._replay.get(bus_number)
+            if replay is not None:
+                # Keep receiving and numbering this bus's events for a while: event streams cut
+                # by a proxy reconnect within seconds and resume from the buffer
+                replay.idle_since = time.monotonic()
+            elif bus_number not in self._watchers:
+                self.pubsub.unsubscribe(bus_number)
+            if bus_number not in self._watchers:
+                # Nobody left to apply deltas against it; rebuilt on the next connect
+                self._stop_snapshots.pop(bus_number, None)
+        if client is not None:
+            self._wheel[client.slot].discard(client)
+            self._unwatch(client)
+        if client is not None and client.sender is not None and client.sender is not asyncio.current_task():
+            client.sender.cancel()
         print(f"WebSocket disconnected for bus {bus_number}")
+
+    def release(self, websocket: Union[WebSocket, EventStream], bus_number: str) -> None:
+        """Queue the broadcasts held back since connect(hold=True), after whatever was sent meanwhile.
+        Some may already be reflected in the snapshot; clients treat those as no-ops (deltas by seq)."""
+        client = self.active_connections.get(bus_number, {}).get(websocket)
+        if client is None or client.held is None:
+            return
+        held, client.held = client.held, None
+        for frame in held:
+            self._enqueue(client, frame)
+
+    def send(self, websocket: WebSocket, bus_number: str, message) -> None:
+        """Queue a frame (dict or pre-encoded text) for one connection, ahead of any held broadcasts.
+        Replies must go through the queue too, never a direct send."""
+        client = self.active_connections.get(bus_number, {}).get(websocket)
+        if client is not None:
+            frame = message if isinstance(message, str) else self.encode(message)
+            if client.sse:
+                # Not a broadcast: carries the current id, so a reconnect resumes right after it
+                frame = self._replay[bus_number].event(frame)
+            self._put(client, frame)
+
+    def _enqueue(self, client: _Client, frame: Union[str, bytes]) -> None:
+        if client.held is not None:
+            if len(client.held) >= self.queue_size:
+                self._evict(client)
+            else:
+                client.held.append(frame)
+            return
+        self._put(client, frame)
+
+    def _put(self, client: _Client, frame: Union[str, bytes]) -> None:
+        try:
+            client.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._evict(client)
+
+    def _evict(self, client: _Client) -> None:
+        """Drop a client whose queue overflowed and close it with WS_CLOSE_SLOW_CONSUMER"""
+        self.evicted += 1
+        print(f"WebSocket for bus {client.bus_number} too slow, closing")
+        self._close(client, WS_CLOSE_SLOW_CONSUMER)
+
+    def _close(self, client: _Client, code: int) -> None:
+        self.disconnect(client.websocket, client.bus_number)
+        if client.sse:
+            # Ends the response body; EventSource reconnects and resumes with Last-Event-ID
+            while not client.queue.empty():
+                client.queue.get_nowait()
+            client.queue.put_nowait(None)
+            return
+
+        async def _close():
+            try:
+                await client.websocket.close(code=code)
+            except Exception:
+                pass
+
+        asyncio.create_task(_close())
+
+    async def _heartbeat_loop(self):
+        """Timer wheel: each second, visit one slot's connections"""
+        while True:
+            await asyncio.sleep(1)
+            self._tick += 1
+            try:
+                now = time.monotonic()
+                self._check_slot(self._wheel[self._tick % self.heartbeat_seconds], now)
+                self._prune_replay(now)
+            except Exception as e:
+                print(f"WebSocket heartbeat error: {e}")
+
+    def _check_slot(self, slot: set, now: float) -> None:
+        for client in list(slot):
+            # WebSockets: time since the client last wrote; event streams: since a write last completed
+            quiet = now - (client.last_sent if client.sse else client.last_seen)
+            if (client.sender is not None and client.sender.done()) or quiet > self.idle_timeout_seconds:
+                # No answer to heartbeats for too long (or its sender died): half-open or stuck
+                self.reaped += 1
+                print(f"WebSocket for bus {client.bus_number} idle, closing")
+                self._close(client, WS_CLOSE_IDLE)
+            elif client.sse:
+                if quiet >= self.heartbeat_seconds and client.queue.empty():
+                    self.heartbeats += 1
+                    self._enqueue(client, SSE_HEARTBEAT_FRAME)
+            elif quiet >= self.heartbeat_seconds:
+                # Sent even when broadcasts are flowing: the client only writes when asked
+                self.heartbeats += 1
+                self._enqueue(client, HEARTBEAT_FRAME)
+
+    def _prune_replay(self, now: float) -> None:
+        """Drop replay buffers of buses that have had no connection for replay_idle_seconds"""
+        for bus_number, replay in list(self._replay.items()):
+            if bus_number not in self.active_connections and now - replay.idle_since > self.replay_idle_seconds:
+                del self._replay[bus_number]
+                if bus_number not in self._watchers:
+                    self._stop_snapshots.pop(bus_number, None)
+                    self.pubsub.unsubscribe(bus_number)
+
+    async def _send_loop(self, client: _Client):
+        try:
+            while True:
+                frame = await client.queue.get()
+                if isinstance(frame, bytes):
+                    await client.websocket.send_bytes(frame)
+                else:
+                    await client.websocket.send_text(frame)
+                client.last_sent = time.monotonic()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error sending to WebSocket: {e}")
+            self.disconnect(client.websocket, client.bus_number)
+
+    def _fan_out(
+        self, bus_number: str, message: dict, fleet: bool = False,
+        binary: Optional[Callable[[], bytes]] = None,
+    ) -> None:
+        """Encode once per format, enqueue the same frame for every subscriber (and fleet streams
+        whose bbox contains the bus). Each format is only encoded if some client needs it,
+        except that buses with a replay buffer always get the numbered event recorded."""
+        frames: Dict[str, Union[str, bytes]] = {}
+        replay = self._replay.get(bus_number)
+        if replay is not None:
+            frames["json"] = self.encode(message)
+            frames["sse"] = replay.add(frames["json"])
+
+        def frame_for(client: _Client) -> Union[str, bytes]:
+            if client.sse:
+                return frames["sse"]
+            kind = "binary" if client.binary and binary is not None else "json"
+            if kind not in frames:
+                frames[kind] = binary() if kind == "binary" else self.encode(message)
+            return frames[kind]
+
+        for client in list(self.active_connections.get(bus_number, {}).values()):
+            self._enqueue(client, frame_for(client))
+        if fleet:
+            position = self._positions.get(bus_number)
+            for client in list(self.active_connections.get(FLEET_TOPIC, {}).values()):
+                if in_bbox(client.bbox, position):
+                    self._enqueue(client, frame_for(client))
+
+    def _has_subscribers(self, bus_number: str, fleet: bool = False) -> bool:
+        return (
+            bus_number in self.active_connections
+            or bus_number in self._replay
+            or (fleet and FLEET_TOPIC in self.active_connections)
+        )
     
+    async def _publish(self, kind: str, bus_number: str, data: dict):
+        """
+        Conflate per bus: the first event of each kind in a period goes out at once, unless
+        something for the bus is already held back; then it is held too, so a stops frame never
+        overtakes the location it was computed from. A held event only replaces the held one of
+        its kind (never serialized), and everything held is sent in publish order when the
+        period ends.
+        """
+        if self.conflation_seconds <= 0:
+            await self._emit(kind, bus_number, data)
+            return
+        window = self._windows.get(bus_number)
+        if window is None:
+            window = self._windows[bus_number] = _Window()
+            task = asyncio.create_task(self._close_window(bus_number, window))
+            self._window_tasks.add(task)
+            task.add_done_callback(self._window_tasks.discard)
+        elif kind in window.sent or window.pending or window.flushing:
+            if window.pending.pop(kind, None) is not None:
+                self.coalesced_events += 1
+            window.pending[kind] = data
+            return
+        window.sent.add(kind)
+        await self._emit(kind, bus_number, data)
+
+    async def _close_window(self, bus_number: str, window: _Window):
+        try:
+            while True:
+                await asyncio.sleep(self.conflation_seconds)
+                if not window.pending:
+                    return
+                # Send what was held and keep the window open for another period
+                pending, window.pending = window.pending, {}
+                window.sent = set(pending)
+                window.flushing = True
+                try:
+                    for kind, data in pending.items():
+                        await self._emit(kind, bus_number, data)
+                finally:
+                    window.flushing = False
+        except Exception as e:
+            print(f"WebSocket conflation error: {e}")
+        finally:
+            self._windows.pop(bus_number, None)
+
+    async def _emit(self, kind: str, bus_number: str, data: dict):
+        """Deliver to this process's passengers, then forward to the other workers"""
+        self.sent_events += 1
+        self._deliver[kind](bus_number, data)
+        # The fleet topic only carries location/delay; watched stop lists travel on the bus's own topic
+        await self.pubsub.publish(kind, bus_number, data, fleet=kind != "stops")
+
+    def _deliver_remote(self, kind: str, bus_number: str, data: dict) -> None:
+        if kind.startswith("sync."):
+            if self._sync_handler is not None:
+                self._sync_handler(kind, bus_number, data)
+            return
+        deliver = self._deliver.get(kind)
+        if deliver is not None:
+            deliver(bus_number, data)
+
     async def broadcast_location(self, bus_number: str, location_data: dict):
         """Broadcast location update to all connected passengers for a bus"""
-        if bus_number not in self.active_connections:
+        await self._publish("location", bus_number, location_data)
+
+    def _deliver_location(self, bus_number: str, location_data: dict) -> None:
+        if not self._has_subscribers(bus_number, fleet=True):
             return
+        self._positions[bus_number] = (location_data["latitude"], location_data["longitude"])
         
-        # Calculate last_seen_seconds
+        # Normalize recorded_at once: ISO text for the frame, aware datetime for last_seen_seconds
         recorded_at = location_data.get("recorded_at")
-        if isinstance(recorded_at, str):
+        if isinstance(recorded_at, datetime):
+            recorded_at_iso = recorded_at.isoformat()
+            if recorded_at.tzinfo is None:
+                recorded_at = recorded_at.replace(tzinfo=timezone.utc)
+        elif isinstance(recorded_at, str):
+            recorded_at_iso = recorded_at
             try:
                 recorded_at = datetime.fromisoformat(recorded_at.replace("Z", "+00:00"))
-            except:
+            except ValueError:
                 recorded_at = datetime.now(timezone.utc)
-        elif isinstance(recorded_at, datetime):
             if recorded_at.tzinfo is None:
                 recorded_at = recorded_at.replace(tzinfo=timezone.utc)
         else:
+            recorded_at_iso = recorded_at
             recorded_at = datetime.now(timezone.utc)
         
-        now = datetime.now(timezone.utc)
-        last_seen_seconds = int((now - recorded_at).total_seconds())
+        last_seen_seconds = int((datetime.now(timezone.utc) - recorded_at).total_seconds())
         
         message = {
             "type": "location_update",
             "bus_number": bus_number,
             "latitude": location_data["latitude"],
             "longitude": location_data["longitude"],
-            "recorded_at": location_data["recorded_at"].isoformat() if isinstance(location_data["recorded_at"], datetime) else location_data["recorded_at"],
+            "recorded_at": recorded_at_iso,
             "last_seen_seconds": last_seen_seconds,
             "status": "online" if last_seen_seconds < 120 else "stale",
         }
         
-        # Send to all connected clients
-        disconnected = set()
-        for connection in self.active_connections[bus_number]:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error sending to WebSocket: {e}")
-                disconnected.add(connection)
-        
-        # Remove disconnected connections
-        for conn in disconnected:
-            self.disconnect(conn, bus_number)
+        # Enqueue for every connected client; sender tasks do the writes
+        self._fan_out(bus_number, message, fleet=True, binary=lambda: encode_location(
+            bus_number, message["latitude"], message["longitude"], recorded_at, message["status"],
+        ))
     
     async def broadcast_delay(self, bus_number: str, delay_data: dict):
         """Broadcast delay update to all connected passengers"""
-        if bus_number not in self.active_connections:
+        await self._publish("delay", bus_number, delay_data)
+
+    def _deliver_delay(self, bus_number: str, delay_data: dict) -> None:
+        if not self._has_subscribers(bus_number, fleet=True):
             return
         
         message = {
@@ -86,22 +634,144 @@ class WebSocketManager:
             "next_stop": delay_data.get("next_stop"),
         }
         
-        disconnected = set()
-        for connection in self.active_connections[bus_number]:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error sending delay update: {e}")
-                disconnected.add(connection)
+        self._fan_out(bus_number, message, fleet=True, binary=lambda: encode_delay(
+            bus_number, message["delay_minutes"],
+            delay_data.get("current_stop_index"), delay_data.get("next_stop_index"),
+        ))
+    
+    async def broadcast_stops(self, bus_number: str, stops_data: dict):
+        """Broadcast a new stop ETA list (StopEtaResponse as JSON) so clients never re-poll /stops.
+        Plain clients get the full list; delta clients get only the stops that changed."""
+        await self._publish("stops", bus_number, stops_data)
+
+    def _deliver_stops(self, bus_number: str, stops_data: dict) -> None:
+        # Each worker keeps its own delta base and seq for its own connections
+        clients = self.active_connections.get(bus_number, {})
+        replay = self._replay.get(bus_number)
+        watchers = self._watchers.get(bus_number, ())
+        if not clients and replay is None and not watchers:
+            return
+        
+        stops = stops_data.get("stops", [])
+        previous = self._stop_snapshots.get(bus_number)
+        seq = self.set_stop_snapshot(bus_number, stops)
+        
+        # Fleet streams watching the bus get the full list like plain passenger sockets
+        plain = [c for c in clients.values() if not c.delta and not c.sse] + list(watchers)
+        if plain or replay is not None:
+            frame = self.encode({
+                "type": "stops_update",
+                "bus_number": bus_number,
+                "stops": stops,
+            })
+            for client in plain:
+                self._enqueue(client, frame)
+            if replay is not None:
+                # Event streams get the full list too, numbered for resume
+                event = replay.add(frame)
+                for client in clients.values():
+                    if client.sse:
+                        self._enqueue(client, event)
         
-        for conn in disconnected:
-            self.disconnect(conn, bus_number)
+        versioned = [c for c in clients.values() if c.delta]
+        if versioned:
+            if previous is None or _route_fields(previous[1]) != _route_fields(stops):
+                # No base or the route changed (stops, positions, schedule): send everything
+                message = self._snapshot_message(bus_number, seq, stops)
+            else:
+                message = {
+                    "type": "stops_delta",
+                    "bus_number": bus_number,
+                    "seq": seq,
+                    "changes": [
+                        {"index": idx, **{field: stop.get(field) for field in DELTA_FIELDS}}
+                        for idx, (old, stop) in enumerate(zip(previous[1], stops))
+                        if any(old.get(field) != stop.get(field) for field in DELTA_FIELDS)
+                    ],
+                }
+            frame = self.encode(message)
+            for client in versioned:
+                self._enqueue(client, frame)
+    
+    def get_stop_snapshot(self, bus_number: str) -> Optional[Tuple[int, List[dict]]]:
+        """(seq, stops) last sent for a bus, if any"""
+        return self._stop_snapshots.get(bus_number)
+    
+    def set_stop_snapshot(self, bus_number: str, stops: List[dict]) -> int:
+        """Store a new stop list as the delta base and return its sequence number"""
+        previous = self._stop_snapshots.get(bus_number)
+        seq = (previous[0] if previous else 0) + 1
+        self._stop_snapshots[bus_number] = (seq, stops)
+        return seq
+    
+    def send_stop_snapshot(self, websocket: WebSocket, bus_number: str) -> bool:
+        """Queue the current full stop list for one connection (connect/resync). False if none cached."""
+        snapshot = self._stop_snapshots.get(bus_number)
+        if snapshot is None:
+            return False
+        self.send(websocket, bus_number, self._snapshot_message(bus_number, *snapshot))
+        return True
+    
+    @staticmethod
+    def _snapshot_message(bus_number: str, seq: int, stops: List[dict]) -> dict:
+        return {
+            "type": "stops_snapshot",
+            "bus_number": bus_number,
+            "seq": seq,
+            "stops": stops,
+        }
     
     def get_connection_count(self, bus_number: str) -> int:
         """Get number of connected passengers for a bus"""
-        return len(self.active_connections.get(bus_number, set()))
+        return len(self.active_connections.get(bus_number, {}))
+
+    def set_bbox(self, websocket: WebSocket, bbox: Optional[Tuple[float, float, float, float]]) -> None:
+        """Limit a fleet stream to buses inside (min_lon, min_lat, max_lon, max_lat); None for all"""
+        client = self.active_connections.get(FLEET_TOPIC, {}).get(websocket)
+        if client is not None:
+            client.bbox = bbox
+
+    def connection_counts(self) -> Dict[str, int]:
+        """bus_number -> connected passengers on this worker (capacity planning)"""
+        return {
+            bus_number: len(clients)
+            for bus_number, clients in self.active_connections.items()
+            if bus_number != FLEET_TOPIC
+        }
+
+    def metrics(self) -> Dict:
+        counts = self.connection_counts()
+        return {
+            "connections": sum(counts.values()),
+            "per_bus": counts,
+            "fleet_streams": self.get_connection_count(FLEET_TOPIC),
+            "event_streams": sum(
+                1 for clients in self.active_connections.values() for client in clients.values() if client.sse
+            ),
+            "replay_buffers": len(self._replay),
+            "resumed_streams": self.resumed_streams,
+            "evicted": self.evicted,
+            "reaped": self.reaped,
+            "heartbeats": self.heartbeats,
+            "conflation": {
+                "window_ms": int(self.conflation_seconds * 1000),
+                "sent": self.sent_events,
+                "coalesced": self.coalesced_events,
+                "coalesced_ratio": round(self.coalesced_events / (self.sent_events + self.coalesced_events), 3)
+                if self.sent_events + self.coalesced_events else 0.0,
+            },
+            "pubsub": self.pubsub.metrics(),
+        }
+
+    def has_listeners(self, bus_number: str) -> bool:
+        """True if any worker has passengers connected for this bus (or keeps its events for resuming streams)"""
+        return (
+            self.get_connection_count(bus_number) > 0
+            or bus_number in self._replay
+            or bus_number in self._watchers
+            or self.pubsub.has_remote_subscribers(bus_number)
+        )
 
 
 # Global WebSocket manager instance
 websocket_manager = WebSocketManager()
-
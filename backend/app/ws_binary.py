@@ -0,0 +1,58 @@
+"""
+Compact binary frames for WebSocket clients that negotiate BINARY_SUBPROTOCOL
+(Sec-WebSocket-Protocol) on the passenger or admin fleet socket.
+
+Only the high-rate frames are binary; snapshots, stop lists, heartbeats and errors stay
+JSON text frames on the same socket. All fields are little-endian.
+
+location_update (type 1), 14-byte header + bus number:
+    u8 type, u8 status (0 online, 1 stale), i32 latitude * 1e7, i32 longitude * 1e7,
+    u32 recorded_at (epoch seconds)
+delay_update (type 2), 7-byte header + bus number:
+    u8 type, i16 delay_minutes, i16 current_stop_index, i16 next_stop_index (-1 = unknown)
+Both end with u8 length + UTF-8 bus_number.
+"""
+from datetime import datetime
+import struct
+from typing import Optional
+
+BINARY_SUBPROTOCOL = "bustracker.bin.v1"
+
+FRAME_LOCATION = 1
+FRAME_DELAY = 2
+
+STATUS_CODES = {"online": 0, "stale": 1}
+
+_LOCATION = struct.Struct("<BBiiI")
+_DELAY = struct.Struct("<Bhhh")
+COORD_SCALE = 10_000_000
+
+
+def _int16(value: Optional[int], default: int = -1) -> int:
+    if value is None:
+        return default
+    return max(-32768, min(32767, int(value)))
+
+
+def _bus_tail(bus_number: str) -> bytes:
+    raw = bus_number.encode("utf-8")[:255]
+    return bytes((len(raw),)) + raw
+
+
+def encode_location(bus_number: str, latitude: float, longitude: float, recorded_at: datetime, status: str) -> bytes:
+    return _LOCATION.pack(
+        FRAME_LOCATION,
+        STATUS_CODES.get(status, 1),
+        round(latitude * COORD_SCALE),
+        round(longitude * COORD_SCALE),
+        max(0, int(recorded_at.timestamp())),
+    ) + _bus_tail(bus_number)
+
+
+def encode_delay(bus_number: str, delay_minutes: Optional[int], current_stop_index: Optional[int], next_stop_index: Optional[int]) -> bytes:
+    return _DELAY.pack(
+        FRAME_DELAY,
+        _int16(delay_minutes, 0),
+        _int16(current_stop_index),
+        _int16(next_stop_index),
+    ) + _bus_tail(bus_number)
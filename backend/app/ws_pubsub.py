@@ -0,0 +1,351 @@
+"""
+Transport that carries WebSocket broadcasts between worker processes.
+
+WebSocketManager always delivers to its own connections directly; the pub/sub backend
+only forwards the same event (kind, bus_number, data) to the other workers, which
+deliver it to theirs.
+
+memory: single process, nothing to forward.
+broker: one worker hosts a small newline-delimited JSON broker on a Unix socket
+        (TCP loopback where AF_UNIX servers are unavailable, e.g. Windows) and every
+        worker, including that one, connects to it. Workers subscribe per bus, so events
+        only go to workers with passengers on that bus (or a fleet stream, which subscribes
+        to FLEET_TOPIC). If the hosting worker exits the
+        others reconnect and one of them takes over.
+
+The broker also carries state sync events (see state_sync): broadcast() sends them to
+every other worker regardless of subscriptions. Events sent while a worker is
+disconnected are lost, so after every (re)connect the worker is handed a RESYNC event
+and reloads its in-memory state from the DB.
+"""
+from typing import Any, Callable, Dict, Optional, Set
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+try:
+    import fcntl  # Broker election lock for Unix socket addresses
+except ImportError:
+    fcntl = None
+
+# Topic for streams that want every bus (admin fleet view)
+FLEET_TOPIC = "*"
+# Delivered locally after connecting to the broker: state sync events may have been missed
+RESYNC = "sync.resync"
+
+# (kind, bus_number, data) -> deliver to this worker's connections
+Handler = Callable[[str, str, Any], None]
+
+RECONNECT_DELAY_SECONDS = 0.5
+# Largest event line accepted (a full stop list for a long route is well below this)
+MAX_LINE_BYTES = 4 * 1024 * 1024
+# A worker whose unread broker output grows past this is disconnected (it reconnects and resubscribes)
+MAX_WORKER_BUFFER_BYTES = 8 * 1024 * 1024
+
+
+def default_address() -> str:
+    if sys.platform != "win32" and hasattr(asyncio, "start_unix_server") and fcntl is not None:
+        return "unix://" + os.path.join(tempfile.gettempdir(), "bus-tracker-ws.sock")
+    return "tcp://127.0.0.1:8765"
+
+
+def _encode(message: dict) -> bytes:
+    # Location events carry datetimes; everything else is plain JSON already
+    return json.dumps(message, separators=(",", ":"), default=lambda o: o.isoformat()).encode("utf-8") + b"\n"
+
+
+class InProcessPubSub:
+    """Single-process backend: every subscriber is local, so publishing is a no-op"""
+
+    async def start(self, handler: Handler) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, kind: str, bus_number: str, data: Any, fleet: bool = True) -> None:
+        pass
+
+    def broadcast(self, kind: str, bus_number: str, data: Any) -> None:
+        pass
+
+    def subscribe(self, bus_number: str) -> None:
+        pass
+
+    def unsubscribe(self, bus_number: str) -> None:
+        pass
+
+    def has_remote_subscribers(self, bus_number: str) -> bool:
+        return False
+
+    def metrics(self) -> Dict:
+        return {"backend": "memory"}
+
+
+class _Broker:
+    """Routes pub events to the other workers subscribed to the bus and tells each worker
+    how many *other* workers listen to a bus (so publishers can skip unwatched buses)."""
+
+    def __init__(self):
+        self._workers: Dict[asyncio.StreamWriter, Set[str]] = {}
+        self._buses: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._workers[writer] = set()
+        for bus_number, workers in self._buses.items():
+            self._send(writer, {"op": "interest", "bus": bus_number, "workers": len(workers)})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                bus_number = message.get("bus")
+                if op == "pub":
+                    if message.get("all"):
+                        targets = set(self._workers)
+                    else:
+                        targets = set(self._buses.get(bus_number, ()))
+                    if message.get("fleet"):
+                        targets |= self._buses.get(FLEET_TOPIC, set())
+                    for worker in targets:
+                        if worker is not writer:
+                            self._forward(worker, line)
+                elif op == "sub":
+                    self._workers[writer].add(bus_number)
+                    self._buses.setdefault(bus_number, set()).add(writer)
+                    self._announce(bus_number)
+                elif op == "unsub":
+                    self._remove(writer, bus_number)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"WebSocket pub/sub broker error: {e}")
+        finally:
+            for bus_number in list(self._workers.pop(writer, ())):
+                self._remove(writer, bus_number)
+            writer.close()
+
+    def close(self) -> None:
+        """Drop every worker connection so they fail over to a new broker"""
+        for writer in list(self._workers):
+            writer.close()
+
+    def _remove(self, writer: asyncio.StreamWriter, bus_number: str) -> None:
+        self._workers.get(writer, set()).discard(bus_number)
+        workers = self._buses.get(bus_number)
+        if workers is None:
+            return
+        workers.discard(writer)
+        if not workers:
+            del self._buses[bus_number]
+        self._announce(bus_number)
+
+    def _announce(self, bus_number: str) -> None:
+        workers = self._buses.get(bus_number, set())
+        for writer in list(self._workers):
+            others = len(workers) - (1 if writer in workers else 0)
+            self._send(writer, {"op": "interest", "bus": bus_number, "workers": others})
+
+    def _send(self, writer: asyncio.StreamWriter, message: dict) -> None:
+        self._forward(writer, _encode(message))
+
+    def _forward(self, writer: asyncio.StreamWriter, line: bytes) -> None:
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_WORKER_BUFFER_BYTES:
+            print("WebSocket pub/sub worker too slow, disconnecting it")
+            writer.close()
+            return
+        writer.write(line)
+
+
+class BrokerPubSub:
+    """Multi-process backend: connects to the local broker, hosting it if nobody else does"""
+
+    def __init__(self, address: str):
+        self.address = address
+        self._handler: Optional[Handler] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._broker: Optional[_Broker] = None
+        self._lock_file = None
+        self._subscribed: Set[str] = set()
+        # bus_number -> number of other workers with passengers on it (from the broker)
+        self._remote: Dict[str, int] = {}
+        # Metrics
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+
+    @property
+    def _unix_path(self) -> Optional[str]:
+        return self.address[len("unix://"):] if self.address.startswith("unix://") else None
+
+    async def start(self, handler: Handler) -> None:
+        self._handler = handler
+        self._loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            self._broker.close()
+            self._server = None
+            self._broker = None
+            if self._unix_path:
+                try:
+                    os.unlink(self._unix_path)
+                except OSError:
+                    pass
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def publish(self, kind: str, bus_number: str, data: Any, fleet: bool = True) -> None:
+        """Forward an event to the other workers; fleet=False skips fleet-only subscribers"""
+        if self._writer is None:
+            return
+        if not self._remote.get(bus_number) and not (fleet and self._remote.get(FLEET_TOPIC)):
+            return
+        self._write({"op": "pub", "kind": kind, "bus": bus_number, "data": data, "fleet": fleet})
+        self.published += 1
+        try:
+            await self._writer.drain()
+        except (ConnectionError, AttributeError):
+            pass
+
+    def broadcast(self, kind: str, bus_number: str, data: Any) -> None:
+        """Send an event to every other worker (state sync). Callable from any thread."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self.published += 1
+        self._loop.call_soon_threadsafe(self._write, {"op": "pub", "kind": kind, "bus": bus_number, "data": data, "all": True})
+
+    def subscribe(self, bus_number: str) -> None:
+        self._subscribed.add(bus_number)
+        self._write({"op": "sub", "bus": bus_number})
+
+    def unsubscribe(self, bus_number: str) -> None:
+        self._subscribed.discard(bus_number)
+        self._write({"op": "unsub", "bus": bus_number})
+
+    def has_remote_subscribers(self, bus_number: str) -> bool:
+        return self._remote.get(bus_number, 0) > 0
+
+    def metrics(self) -> Dict:
+        return {
+            "backend": "broker",
+            "address": self.address,
+            "connected": self._writer is not None,
+            "hosting_broker": self._server is not None,
+            "subscribed_buses": len(self._subscribed),
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+    def _write(self, message: dict) -> None:
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_encode(message))
+
+    async def _open(self):
+        path = self._unix_path
+        if path:
+            return await asyncio.open_unix_connection(path, limit=MAX_LINE_BYTES)
+        host, port = self.address[len("tcp://"):].rsplit(":", 1)
+        return await asyncio.open_connection(host, int(port), limit=MAX_LINE_BYTES)
+
+    async def _host(self) -> bool:
+        """Try to become the broker. False if another worker already holds it."""
+        if self._server is not None:
+            return False
+        broker = _Broker()
+        path = self._unix_path
+        if path:
+            # The lock decides who may replace a stale socket file left by a dead broker
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._server = await asyncio.start_unix_server(broker.handle, path=path, limit=MAX_LINE_BYTES)
+            self._lock_file = lock_file
+        else:
+            host, port = self.address[len("tcp://"):].rsplit(":", 1)
+            try:
+                self._server = await asyncio.start_server(broker.handle, host, int(port), limit=MAX_LINE_BYTES)
+            except OSError:
+                return False
+        self._broker = broker
+        print(f"WebSocket pub/sub broker listening on {self.address}")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader, writer = await self._open()
+            except OSError:
+                if not await self._host():
+                    await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+
+            self._writer = writer
+            for bus_number in self._subscribed:
+                self._write({"op": "sub", "bus": bus_number})
+            try:
+                self._handler(RESYNC, "", None)
+            except Exception as e:
+                print(f"WebSocket pub/sub resync error: {e}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    if message["op"] == "interest":
+                        if message["workers"] > 0:
+                            self._remote[message["bus"]] = message["workers"]
+                        else:
+                            self._remote.pop(message["bus"], None)
+                    elif message["op"] == "pub":
+                        self.received += 1
+                        try:
+                            self._handler(message["kind"], message["bus"], message["data"])
+                        except Exception as e:
+                            print(f"WebSocket pub/sub delivery error: {e}")
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                print(f"WebSocket pub/sub connection lost: {e}")
+            finally:
+                self._writer = None
+                self._remote.clear()
+                writer.close()
+            self.reconnects += 1
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+
+def create_pubsub(backend: str, address: str = ""):
+    """Build the pub/sub backend named by settings.ws_pubsub_backend"""
+    if backend == "memory":
+        return InProcessPubSub()
+    if backend == "broker":
+        return BrokerPubSub(address or default_address())
+    raise ValueError(f"Unknown WebSocket pub/sub backend: {backend!r} (expected 'memory' or 'broker')")
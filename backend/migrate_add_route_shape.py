@@ -0,0 +1,28 @@
+"""Add the optional shape (road polyline) column to routes table"""
+from sqlalchemy import text, inspect
+from app.database import engine
+
+def migrate():
+    conn = engine.connect()
+    try:
+        inspector = inspect(engine)
+        existing_cols = [c['name'] for c in inspector.get_columns('routes')]
+        
+        if 'shape' not in existing_cols:
+            conn.execute(text('ALTER TABLE routes ADD COLUMN shape TEXT'))
+            print('[OK] Added shape column')
+        else:
+            print('[OK] shape column already exists')
+            
+        conn.commit()
+        print('Migration completed successfully!')
+    except Exception as e:
+        print(f'Error during migration: {e}')
+        import traceback
+        traceback.print_exc()
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+# The engine is built from settings at import, so point it at a throwaway SQLite file first
+_DB_DIR = tempfile.mkdtemp(prefix="bustracker-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+
+from datetime import datetime, timedelta, timezone
+
+import bcrypt
+import pytest
+
+from app import state_sync
+from app.database import Base, SessionLocal, engine
+from app.models import Bus, Route, Stop
+
+BUS_NUMBER = "123"
+BUS_PASSWORD = "pw"
+ADMIN_HEADERS = {"X-Admin-Password": "admin123"}
+
+
+@pytest.fixture
+def db():
+    """Fresh tables and empty in-process caches"""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    state_sync.resync()
+    yield engine
+    state_sync.resync()
+
+
+@pytest.fixture
+def seeded(db):
+    """Bus 123 (password "pw") started ten minutes ago on route A with six stops, five minutes apart"""
+    session = SessionLocal()
+    start = (datetime.now(timezone.utc) - timedelta(minutes=10)).replace(tzinfo=None, second=0, microsecond=0)
+    session.add(Bus(
+        bus_number=BUS_NUMBER,
+        password_hash=bcrypt.hashpw(BUS_PASSWORD.encode(), bcrypt.gensalt()).decode(),
+        start_time=start,
+        is_active=True,
+    ))
+    session.commit()
+    route = Route(bus_number=BUS_NUMBER, route_name="A")
+    session.add(route)
+    session.flush()
+    for i in range(6):
+        session.add(Stop(
+            route_id=route.route_id, stop_name=f"S{i}", latitude=19.0 + 0.01 * i, longitude=72.8 + 0.01 * i,
+            sequence_order=i + 1, scheduled_arrival_minutes=5 * i,
+        ))
+    session.commit()
+    session.close()
+    return BUS_NUMBER
+
+
+@pytest.fixture
+def client(seeded):
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def driver_headers(client):
+    response = client.post("/auth/driver/login", json={"bus_number": BUS_NUMBER, "password": BUS_PASSWORD})
+    assert response.status_code == 200
+    return {"X-Session-Token": response.json()["session_token"]}
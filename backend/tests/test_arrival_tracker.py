@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from app.arrival_tracker import FULL_SCAN_EVERY, LOOKAHEAD_STOPS, SessionArrivals
+from app.database import SessionLocal
+from app.db_store import DatabaseStore
+
+from conftest import BUS_NUMBER, BUS_PASSWORD
+
+BASE = datetime(2026, 10, 17, 7, 0)
+
+
+def test_lookahead_window_follows_the_furthest_arrival():
+    state = SessionArrivals({})
+    state.sync_route(1, list(range(10)))
+    # Nothing matched yet: the whole route
+    assert state.candidate_indices(10) == range(10)
+    state.mark(0, 0, BASE)
+    assert state.candidate_indices(10) == range(1, 1 + LOOKAHEAD_STOPS)
+    # Stop 1 was missed (GPS gap); stop 2 is still in the window, and the window moves past both
+    state.mark(2, 2, BASE)
+    assert state.candidate_indices(10) == range(3, 3 + LOOKAHEAD_STOPS)
+    # Near the end the window stops at the last stop
+    state.mark(8, 8, BASE)
+    assert state.candidate_indices(10) == range(9, 10)
+
+
+def test_every_full_scan_every_ping_tests_the_whole_route():
+    state = SessionArrivals({0: BASE})
+    state.sync_route(1, list(range(10)))
+    windows = [state.candidate_indices(10) for _ in range(2 * FULL_SCAN_EVERY)]
+    full = [ping for ping, window in enumerate(windows, start=1) if window == range(10)]
+    assert full == [FULL_SCAN_EVERY, 2 * FULL_SCAN_EVERY]
+    assert all(window == range(1, 1 + LOOKAHEAD_STOPS) for ping, window in enumerate(windows, start=1) if ping not in full)
+
+
+def test_sync_route_reanchors_on_a_new_route_version():
+    state = SessionArrivals({3: BASE, 5: BASE})
+    state.sync_route(1, [1, 2, 3, 4, 5, 6])
+    assert state.last_index == 4
+    # Admin reordered the stops
+    state.sync_route(2, [5, 6, 1, 2, 3, 4])
+    assert state.last_index == 4
+    state.sync_route(3, [5, 1, 2, 4, 6])
+    assert state.last_index == 0
+
+
+def _fix(stop_index: int, seconds: int) -> dict:
+    # Seeded stops sit at 19.0 + 0.01 i, 72.8 + 0.01 i, about 1.5 km apart
+    return {"latitude": 19.0 + 0.01 * stop_index, "longitude": 72.8 + 0.01 * stop_index,
+            "recorded_at": BASE + timedelta(seconds=seconds)}
+
+
+def test_stop_beyond_the_window_is_caught_by_the_full_scan(seeded):
+    db = SessionLocal()
+    try:
+        store = DatabaseStore(db)
+        assert store.login(BUS_NUMBER, BUS_PASSWORD) is not None
+        session_id = store._active_session_id(BUS_NUMBER)
+
+        store.record_stop_arrivals_for_fixes(BUS_NUMBER, session_id, [_fix(0, 0)])
+        assert store.get_stop_arrival_count(session_id) == 1
+
+        # GPS gap: the next fixes are at the last stop, past the window right after stop 0
+        assert 5 >= 1 + LOOKAHEAD_STOPS
+        store.record_stop_arrivals_for_fixes(
+            BUS_NUMBER, session_id, [_fix(5, 60 + i) for i in range(FULL_SCAN_EVERY - 2)],
+        )
+        assert store.get_stop_arrival_count(session_id) == 1
+        # The FULL_SCAN_EVERY-th ping scans the whole route and re-anchors there
+        store.record_stop_arrivals_for_fixes(BUS_NUMBER, session_id, [_fix(5, 200)])
+        arrivals = store.get_stop_arrivals_for_session(session_id)
+        assert sorted(arrivals) == [1, 6]
+        assert arrivals[6] == BASE + timedelta(seconds=200)
+        assert store.get_stop_arrival_count(session_id) == 2
+    finally:
+        db.close()
@@ -0,0 +1,162 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.eta import _compute_route_distances, _delay_against_schedule, calculate_etas_from_scheduled_times
+from app.geometry import haversine_km
+
+IST = timezone(timedelta(hours=5, minutes=30))
+
+
+def _baseline_eta(current_lat, current_lon, stops, current_time, target_stop_idx):
+    """The original per-stop implementation: a haversine loop over the whole route for every stop"""
+    if not stops or target_stop_idx < 0 or target_stop_idx >= len(stops):
+        return None, None
+    if current_lat is None or current_lon is None:
+        return None, None
+    target_stop = stops[target_stop_idx]
+    if not target_stop.get("latitude") or not target_stop.get("longitude"):
+        return None, None
+
+    route_distances = [0.0]
+    for i in range(1, len(stops)):
+        prev, curr = stops[i - 1], stops[i]
+        if prev.get("latitude") and prev.get("longitude") and curr.get("latitude") and curr.get("longitude"):
+            route_distances.append(route_distances[-1] + haversine_km(
+                prev["latitude"], prev["longitude"], curr["latitude"], curr["longitude"]))
+        else:
+            route_distances.append(route_distances[-1] + 1.0)
+
+    min_dist_to_route = float("inf")
+    bus_distance_from_start = 0.0
+    current_segment_idx = 0
+    for i in range(len(stops) - 1):
+        stop_a, stop_b = stops[i], stops[i + 1]
+        if not (stop_a.get("latitude") and stop_b.get("latitude")):
+            continue
+        dist_a = haversine_km(current_lat, current_lon, stop_a["latitude"], stop_a["longitude"])
+        dist_b = haversine_km(current_lat, current_lon, stop_b["latitude"], stop_b["longitude"])
+        segment_dist = route_distances[i + 1] - route_distances[i]
+        if segment_dist > 0.001:
+            total_dist = dist_a + dist_b
+            if total_dist > 0.001:
+                progress_in_segment = max(0.0, min(1.0, dist_a / total_dist))
+                bus_dist_approx = route_distances[i] + segment_dist * progress_in_segment
+            else:
+                bus_dist_approx = route_distances[i] if dist_a < dist_b else route_distances[i + 1]
+        else:
+            bus_dist_approx = route_distances[i]
+        if min(dist_a, dist_b) < min_dist_to_route:
+            min_dist_to_route = min(dist_a, dist_b)
+            bus_distance_from_start = bus_dist_approx
+            current_segment_idx = i
+
+    if bus_distance_from_start >= route_distances[target_stop_idx]:
+        return current_time, 0
+
+    scheduled_minutes = []
+    for stop in stops:
+        minutes = stop.get("scheduled_arrival_minutes")
+        if minutes is not None:
+            scheduled_minutes.append(minutes)
+        elif scheduled_minutes:
+            scheduled_minutes.append(scheduled_minutes[-1] + 10)
+        else:
+            scheduled_minutes.append(0)
+    if len(scheduled_minutes) < 2:
+        return None, None
+
+    if current_segment_idx < len(scheduled_minutes) - 1:
+        segment_start_minutes = scheduled_minutes[current_segment_idx]
+        segment_end_minutes = scheduled_minutes[current_segment_idx + 1]
+        segment_distance = route_distances[current_segment_idx + 1] - route_distances[current_segment_idx]
+        if segment_distance > 0.001:
+            progress = (bus_distance_from_start - route_distances[current_segment_idx]) / segment_distance
+            progress = max(0.0, min(1.0, progress))
+            current_minutes_from_start = segment_start_minutes + (segment_end_minutes - segment_start_minutes) * progress
+        else:
+            current_minutes_from_start = segment_start_minutes
+    else:
+        current_minutes_from_start = scheduled_minutes[-1]
+
+    remaining_minutes = max(0, scheduled_minutes[target_stop_idx] - current_minutes_from_start)
+    eta = current_time + timedelta(minutes=remaining_minutes)
+    return eta, _delay_against_schedule(eta, target_stop.get("scheduled"))
+
+
+def _route(rng: random.Random, n: int) -> list:
+    """Random route: some stops without coordinates or schedule minutes, zero-length segments, mixed schedule types"""
+    stops, lat, lon, minutes = [], 19 + rng.random(), 72 + rng.random(), 0
+    base = datetime(2026, 10, 17, 7, 0)
+    for i in range(n):
+        lat += rng.uniform(-0.02, 0.02)
+        lon += rng.uniform(-0.02, 0.02)
+        minutes += rng.choice([0, 2, 5, 7])
+        stop = {"name": f"S{i}", "latitude": lat, "longitude": lon, "scheduled_arrival_minutes": minutes}
+        r = rng.random()
+        if r < 0.05:
+            stop["latitude"] = stop["longitude"] = None
+        elif r < 0.08:
+            stop["scheduled_arrival_minutes"] = None
+        elif r < 0.10 and stops:
+            stop["latitude"], stop["longitude"] = stops[-1]["latitude"], stops[-1]["longitude"]
+        scheduled = base + timedelta(minutes=minutes)
+        k = rng.random()
+        stop["scheduled"] = (
+            scheduled.replace(tzinfo=IST) if k < 0.5
+            else scheduled if k < 0.7
+            else scheduled.isoformat() + "Z" if k < 0.85
+            else None
+        )
+        stops.append(stop)
+    return stops
+
+
+def _bus_position(rng: random.Random, stops: list) -> tuple:
+    located = [s for s in stops if s["latitude"]]
+    if located and rng.random() < 0.3:
+        stop = rng.choice(located)
+        return stop["latitude"], stop["longitude"]
+    if located:
+        return located[0]["latitude"] + rng.uniform(-0.05, 0.1), located[0]["longitude"] + rng.uniform(-0.05, 0.1)
+    return 19.3, 72.3
+
+
+def _assert_same(got, expected):
+    if expected[0] is None:
+        assert got == expected
+    else:
+        assert abs(got[0] - expected[0]) <= timedelta(milliseconds=1)
+        assert got[1] == expected[1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_baseline_on_generated_routes(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        stops = _route(rng, rng.choice([0, 1, 2, 3, 5, 10, 25, 50]))
+        lat, lon = _bus_position(rng, stops)
+        now = datetime(2026, 10, 17, 7, rng.randrange(60), rng.randrange(60), tzinfo=IST)
+        etas = calculate_etas_from_scheduled_times(lat, lon, stops, now)
+        assert len(etas) == len(stops)
+        for idx, got in enumerate(etas):
+            _assert_same(got, _baseline_eta(lat, lon, stops, now, idx))
+
+
+def test_precomputed_route_distances_give_the_same_etas():
+    rng = random.Random(42)
+    for _ in range(100):
+        stops = _route(rng, 20)
+        lat, lon = _bus_position(rng, stops)
+        now = datetime(2026, 10, 17, 7, 30, tzinfo=IST)
+        route_distances = _compute_route_distances(stops)
+        assert calculate_etas_from_scheduled_times(lat, lon, stops, now, route_distances=route_distances) == \
+            calculate_etas_from_scheduled_times(lat, lon, stops, now)
+
+
+def test_no_gps_gives_no_etas():
+    stops = _route(random.Random(1), 5)
+    now = datetime(2026, 10, 17, 7, 30, tzinfo=IST)
+    assert calculate_etas_from_scheduled_times(None, 72.8, stops, now) == [(None, None)] * 5
+    assert calculate_etas_from_scheduled_times(19.0, 72.8, [], now) == []
@@ -0,0 +1,46 @@
+import numpy as np
+
+from app.geometry import (
+    EARTH_RADIUS_KM,
+    FAST_PATH_MAX_KM,
+    distances_km,
+    equirectangular_km_array,
+    haversine_km,
+    haversine_km_array,
+)
+
+
+def _pairs(max_lat: float, min_km: float, max_km: float, samples: int, seed: int):
+    """Random point pairs min_km..max_km apart, first point within +-max_lat"""
+    rng = np.random.default_rng(seed)
+    lat1 = rng.uniform(-max_lat, max_lat, samples)
+    lon1 = rng.uniform(-180, 180, samples)
+    bearing = rng.uniform(0, 2 * np.pi, samples)
+    dist = rng.uniform(min_km, max_km, samples)
+    lat2 = lat1 + np.degrees(dist * np.cos(bearing) / EARTH_RADIUS_KM)
+    lon2 = lon1 + np.degrees(dist * np.sin(bearing) / (EARTH_RADIUS_KM * np.cos(np.radians(lat1))))
+    return lat1, lon1, lat2, lon2
+
+
+def test_fast_path_relative_error_below_bound():
+    for seed in range(5):
+        lat1, lon1, lat2, lon2 = _pairs(80.0, 0.005, FAST_PATH_MAX_KM, 20000, seed)
+        exact = haversine_km_array(lat1, lon1, lat2, lon2)
+        approx = equirectangular_km_array(lat1, lon1, lat2, lon2)
+        assert np.max(np.abs(approx - exact) / exact) < 1e-7
+
+
+def test_haversine_array_matches_scalar():
+    lat1, lon1, lat2, lon2 = _pairs(60.0, 0.01, 50.0, 200, seed=1)
+    expected = [haversine_km(*p) for p in zip(lat1, lon1, lat2, lon2)]
+    np.testing.assert_allclose(haversine_km_array(lat1, lon1, lat2, lon2), expected, rtol=1e-9)
+
+
+def test_distances_km_near_and_far_points():
+    # Mix of points inside and well beyond FAST_PATH_MAX_KM from the origin
+    lat, lon = 19.07, 72.87
+    rng = np.random.default_rng(2)
+    lats = lat + rng.uniform(-0.5, 0.5, 500)
+    lons = lon + rng.uniform(-0.5, 0.5, 500)
+    expected = np.array([haversine_km(lat, lon, a, b) for a, b in zip(lats, lons)])
+    np.testing.assert_allclose(distances_km(lat, lon, lats, lons), expected, rtol=1e-7)
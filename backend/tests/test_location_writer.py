@@ -0,0 +1,144 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import OperationalError
+
+import app.db_store
+import app.location_writer
+from app.config import settings
+from app.database import SessionLocal
+from app.location_writer import RETRY_BACKOFF_MIN_SECONDS, LocationWriteBehind
+from app.models import Location
+
+
+class _FailingEngine:
+    """Stands in for the engine while the DB is down"""
+
+    def begin(self):
+        raise OperationalError("INSERT INTO locations", {}, Exception("database is locked"))
+
+
+def _rows(count: int, start: int = 0) -> list:
+    base = datetime(2026, 10, 17, 7, 0)
+    return [
+        {"bus_number": "123", "session_id": None, "latitude": 19.0 + i / 1000, "longitude": 72.8,
+         "recorded_at": base + timedelta(seconds=i)}
+        for i in range(start, start + count)
+    ]
+
+
+def _stored() -> list:
+    session = SessionLocal()
+    try:
+        return [row.latitude for row in session.query(Location).order_by(Location.recorded_at)]
+    finally:
+        session.close()
+
+
+def _wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_flushes_when_a_batch_is_full(seeded):
+    writer = LocationWriteBehind(max_size=100, batch_size=3, flush_interval=60)
+    writer.start()
+    try:
+        writer.enqueue(_rows(2))
+        time.sleep(0.1)
+        assert _stored() == []
+        writer.enqueue(_rows(1, start=2))
+        assert _wait_for(lambda: len(_stored()) == 3)
+    finally:
+        writer.stop()
+
+
+def test_flushes_on_the_interval(seeded):
+    writer = LocationWriteBehind(max_size=100, batch_size=100, flush_interval=0.05)
+    writer.start()
+    try:
+        writer.enqueue(_rows(1))
+        assert _wait_for(lambda: len(_stored()) == 1)
+    finally:
+        writer.stop()
+
+
+def test_stop_drains_the_queue(seeded):
+    writer = LocationWriteBehind(max_size=100, batch_size=100, flush_interval=60)
+    writer.start()
+    writer.enqueue(_rows(5))
+    writer.stop()
+    assert not writer.running
+    assert len(_stored()) == 5
+    assert writer.metrics()["queue_depth"] == 0
+
+
+def test_failed_batch_is_kept_and_retried_first_after_backoff(seeded, monkeypatch):
+    writer = LocationWriteBehind(max_size=100, batch_size=2, flush_interval=60)
+    writer.enqueue(_rows(3))
+    monkeypatch.setattr(app.location_writer, "engine", _FailingEngine())
+
+    assert writer.flush() == 0
+    metrics = writer.metrics()
+    assert (metrics["retry_depth"], metrics["queue_depth"], metrics["failed_flushes"]) == (2, 1, 1)
+    # Backing off: a plain flush does not touch the DB, a forced one does and doubles the wait
+    assert writer.flush() == 0
+    assert writer.metrics()["flushes"] == 1
+    writer.flush(force=True)
+    assert writer._backoff == RETRY_BACKOFF_MIN_SECONDS * 2
+    assert writer.retry_after_seconds() >= 1
+
+    monkeypatch.undo()
+    assert writer.flush(force=True) == 3
+    assert _stored() == [row["latitude"] for row in _rows(3)]
+    assert writer._retry == [] and writer._backoff == 0.0
+
+
+def test_rejected_row_is_dropped_alone(seeded):
+    writer = LocationWriteBehind(max_size=100, batch_size=10, flush_interval=60)
+    rows = _rows(3)
+    rows[1]["latitude"] = None  # NOT NULL column: IntegrityError for this row only
+    writer.enqueue(rows)
+    assert writer.flush() == 2
+    assert _stored() == [rows[0]["latitude"], rows[2]["latitude"]]
+    metrics = writer.metrics()
+    assert (metrics["flushed"], metrics["dropped"], metrics["retry_depth"]) == (2, 1, 0)
+
+
+def test_metrics_count_the_queue(seeded):
+    writer = LocationWriteBehind(max_size=4, batch_size=10, flush_interval=60)
+    writer.enqueue(_rows(4))
+    writer.enqueue(_rows(2, start=4))  # Full: flushed inline before queuing
+    metrics = writer.metrics()
+    assert metrics["queue_capacity"] == 4
+    assert metrics["queue_depth"] == 2
+    assert (metrics["enqueued"], metrics["flushed"], metrics["flushes"], metrics["inline_flushes"]) == (6, 4, 1, 1)
+    assert metrics["max_flush_ms"] >= metrics["last_flush_ms"] > 0
+
+
+def _fixes(count: int) -> dict:
+    now = datetime.now(timezone.utc)
+    return {"locations": [
+        {"latitude": 19.0, "longitude": 72.8, "recorded_at": (now + timedelta(seconds=i)).isoformat()}
+        for i in range(count)
+    ]}
+
+
+def test_full_queue_with_failing_db_answers_503(client, driver_headers, monkeypatch):
+    writer = LocationWriteBehind(max_size=4, batch_size=2, flush_interval=60)
+    monkeypatch.setattr(settings, "location_write_behind", True)
+    monkeypatch.setattr(app.db_store, "location_writer", writer)
+    monkeypatch.setattr(app.location_writer, "engine", _FailingEngine())
+
+    assert client.post("/driver/locations", json=_fixes(4), headers=driver_headers).status_code == 200
+    # Queue is full; the inline flush fails, so the batch is refused rather than lost
+    response = client.post("/driver/locations", json=_fixes(1), headers=driver_headers)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert writer.metrics()["queue_depth"] + writer.metrics()["retry_depth"] == 4
+    fix = _fixes(1)["locations"][0]
+    assert client.post("/driver/location", json=fix, headers=driver_headers).status_code == 503
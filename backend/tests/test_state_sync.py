@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+from app.database import SessionLocal
+from app.eta_cache import eta_cache
+from app.live_state import live_state
+from app.models import Stop
+from app.route_cache import route_cache
+from app.session_cache import session_cache
+
+from conftest import ADMIN_HEADERS, BUS_NUMBER
+
+
+def _fix(latitude=19.0, longitude=72.8) -> dict:
+    return {"latitude": latitude, "longitude": longitude, "recorded_at": datetime.now(timezone.utc).isoformat()}
+
+
+def _stop_ids() -> list:
+    session = SessionLocal()
+    try:
+        return [stop.stop_id for stop in session.query(Stop).order_by(Stop.sequence_order)]
+    finally:
+        session.close()
+
+
+def _cached_tokens(bus_number: str) -> list:
+    return [token for token, (_, info) in session_cache._entries.items() if info["bus_number"] == bus_number]
+
+
+def test_stop_edit_evicts_the_compiled_route_and_etas(client, driver_headers):
+    assert client.post("/driver/location", json=_fix(), headers=driver_headers).status_code == 200
+    assert client.get(f"/passenger/bus/{BUS_NUMBER}/stops").json()["stops"][1]["latitude"] == 19.01
+    version = route_cache.peek(BUS_NUMBER).version
+    assert BUS_NUMBER in eta_cache._entries
+
+    response = client.put(
+        f"/admin/buses/{BUS_NUMBER}/stops/{_stop_ids()[1]}", params={"latitude": 19.5}, headers=ADMIN_HEADERS,
+    )
+    assert response.status_code == 200
+    assert route_cache.peek(BUS_NUMBER) is None
+    assert BUS_NUMBER not in eta_cache._entries
+    assert client.get(f"/passenger/bus/{BUS_NUMBER}/stops").json()["stops"][1]["latitude"] == 19.5
+    assert route_cache.peek(BUS_NUMBER).version != version
+
+
+def test_deleted_bus_loses_its_caches_and_its_token(client, driver_headers):
+    assert client.post("/driver/location", json=_fix(), headers=driver_headers).status_code == 200
+    client.get(f"/passenger/bus/{BUS_NUMBER}/stops")
+    assert _cached_tokens(BUS_NUMBER) and route_cache.peek(BUS_NUMBER) is not None
+    assert live_state.get(BUS_NUMBER) is not None
+
+    assert client.delete(f"/admin/buses/{BUS_NUMBER}", headers=ADMIN_HEADERS).status_code == 200
+    assert _cached_tokens(BUS_NUMBER) == []
+    assert route_cache.peek(BUS_NUMBER) is None
+    assert BUS_NUMBER not in eta_cache._entries
+    assert live_state.get(BUS_NUMBER) is None
+    assert client.post("/driver/location", json=_fix(), headers=driver_headers).status_code == 401
+
+
+def test_ended_session_token_gets_401(client, driver_headers):
+    assert client.post("/driver/location", json=_fix(), headers=driver_headers).status_code == 200
+    assert _cached_tokens(BUS_NUMBER)
+    drivers = client.get("/admin/active-drivers", headers=ADMIN_HEADERS).json()
+    session_id = next(d["session_id"] for d in drivers if d["bus_number"] == BUS_NUMBER)
+
+    assert client.delete(f"/admin/active-drivers/{session_id}", headers=ADMIN_HEADERS).status_code == 200
+    assert _cached_tokens(BUS_NUMBER) == []
+    assert client.post("/driver/location", json=_fix(), headers=driver_headers).status_code == 401
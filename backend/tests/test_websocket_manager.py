@@ -0,0 +1,228 @@
+import asyncio
+import json
+
+from app.websocket_manager import WS_CLOSE_IDLE, WebSocketManager, _ReplayBuffer
+
+
+class _FakeSocket:
+    scope = {}
+
+    def __init__(self):
+        self.frames = []
+        self.closed = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def _tag(frame):
+    if frame["type"] == "stops_update":
+        return "stops", frame["stops"][0]["ping"]
+    if frame["type"] == "location_update":
+        return "location", frame["latitude"]
+    return "delay", frame["delay_minutes"]
+
+
+async def _pings(count: int, gap: float, conflation_ms: int = 100):
+    """Delay, location and stops for each ping, as the driver endpoint publishes them"""
+    manager = WebSocketManager(conflation_ms=conflation_ms)
+    socket = _FakeSocket()
+    await manager.connect(socket, "1")
+    for ping in range(count):
+        await manager.broadcast_delay("1", {"delay_minutes": ping})
+        await manager.broadcast_location("1", {"latitude": ping, "longitude": ping, "recorded_at": None})
+        await manager.broadcast_stops("1", {"stops": [{"ping": ping}]})
+        await asyncio.sleep(gap)
+    await asyncio.sleep(conflation_ms / 1000 * 3)
+    manager.disconnect(socket, "1")
+    return manager, [_tag(frame) for frame in socket.frames]
+
+
+def test_conflation_keeps_publish_order():
+    manager, frames = asyncio.run(_pings(count=15, gap=0.02))
+    assert manager.coalesced_events > 0
+    # Every flush carries delay, location and stops of one ping, in that order
+    assert len(frames) % 3 == 0
+    for i in range(0, len(frames), 3):
+        (k1, p1), (k2, p2), (k3, p3) = frames[i:i + 3]
+        assert (k1, k2, k3) == ("delay", "location", "stops")
+        assert p1 == p2 == p3
+    assert frames[-1] == ("stops", 14)
+    assert manager._windows == {}
+
+
+def test_single_ping_is_not_delayed():
+    # gap=0.01 is well inside the 100 ms window: everything must already be out by then
+    async def run():
+        manager = WebSocketManager(conflation_ms=100)
+        socket = _FakeSocket()
+        await manager.connect(socket, "1")
+        await manager.broadcast_delay("1", {"delay_minutes": 0})
+        await manager.broadcast_location("1", {"latitude": 0, "longitude": 0, "recorded_at": None})
+        await manager.broadcast_stops("1", {"stops": [{"ping": 0}]})
+        await asyncio.sleep(0.01)
+        frames = [_tag(frame) for frame in socket.frames]
+        manager.disconnect(socket, "1")
+        return frames
+
+    assert asyncio.run(run()) == [("delay", 0), ("location", 0), ("stops", 0)]
+
+
+def _stop(name, eta, lat=19.0, scheduled="2026-10-17T07:00:00"):
+    return {"stop_name": name, "scheduled_time": scheduled, "eta": eta, "actual_arrived_at": None,
+            "delay_minutes": 0, "status": "on_time", "latitude": lat, "longitude": 72.8}
+
+
+def test_delta_clients_get_snapshot_deltas_and_resync():
+    async def run():
+        manager = WebSocketManager(conflation_ms=0)
+        socket = _FakeSocket()
+        await manager.connect(socket, "1", delta=True)
+
+        async def publish(stops):
+            await manager.broadcast_stops("1", {"stops": stops})
+            await asyncio.sleep(0.01)
+
+        await publish([_stop("A", "07:00"), _stop("B", "07:05")])
+        await publish([_stop("A", "07:01"), _stop("B", "07:05")])
+        await publish([_stop("A", "07:02"), _stop("B", "07:06")])
+        # Client noticed a gap and sent "resync"
+        manager.send_stop_snapshot(socket, "1")
+        await asyncio.sleep(0.01)
+        manager.disconnect(socket, "1")
+        return socket.frames
+
+    snapshot, delta, delta2, resync = asyncio.run(run())
+    assert (snapshot["type"], snapshot["seq"]) == ("stops_snapshot", 1)
+    assert (delta["type"], delta["seq"]) == ("stops_delta", 2)
+    assert [change["index"] for change in delta["changes"]] == [0]
+    assert delta["changes"][0]["eta"] == "07:01"
+    assert [change["index"] for change in delta2["changes"]] == [0, 1]
+    assert (resync["type"], resync["seq"]) == ("stops_snapshot", 3)
+    assert [s["eta"] for s in resync["stops"]] == ["07:02", "07:06"]
+
+
+def test_route_edit_sends_a_new_snapshot_to_delta_clients():
+    async def run():
+        manager = WebSocketManager(conflation_ms=0)
+        socket = _FakeSocket()
+        await manager.connect(socket, "1", delta=True)
+        for stops in (
+            [_stop("A", "07:00"), _stop("B", "07:05")],
+            [_stop("A", "07:00"), _stop("B", "07:05", lat=19.5)],  # Admin moved a stop
+            [_stop("A", "07:00"), _stop("B", "07:05", lat=19.5, scheduled="2026-10-17T07:10:00")],
+            [_stop("A", "07:00"), _stop("B2", "07:05", lat=19.5, scheduled="2026-10-17T07:10:00")],
+        ):
+            await manager.broadcast_stops("1", {"stops": stops})
+            await asyncio.sleep(0.01)
+        manager.disconnect(socket, "1")
+        return socket.frames
+
+    frames = asyncio.run(run())
+    assert [(frame["type"], frame["seq"]) for frame in frames] == [("stops_snapshot", seq) for seq in (1, 2, 3, 4)]
+    assert frames[1]["stops"][1]["latitude"] == 19.5
+
+
+def test_timer_wheel_heartbeats_quiet_sockets_and_reaps_silent_ones():
+    async def run():
+        manager = WebSocketManager(conflation_ms=0, heartbeat_seconds=3, idle_timeout_seconds=10)
+        chatty, silent = _FakeSocket(), _FakeSocket()
+        await manager.connect(chatty, "1")
+        manager._tick += 1  # Second connection lands in the next slot
+        await manager.connect(silent, "1")
+        clients = manager.active_connections["1"]
+        start = clients[silent].last_seen
+        clients[chatty].last_seen = start
+        visits = {chatty: [], silent: []}
+
+        # Fake clock: one wheel tick per second, as _heartbeat_loop does
+        for second in range(1, 13):
+            now = start + second
+            manager._tick += 1
+            slot = manager._wheel[manager._tick % manager.heartbeat_seconds]
+            for socket in visits:
+                if clients.get(socket) in slot:
+                    visits[socket].append(second)
+            if chatty in clients:
+                clients[chatty].last_seen = now  # Answers every heartbeat
+            manager._check_slot(slot, now)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        return manager, visits, chatty, silent
+
+    manager, visits, chatty, silent = asyncio.run(run())
+    # Each connection is visited once per heartbeat interval
+    assert all(b - a == 3 for a, b in zip(visits[silent], visits[silent][1:]))
+    assert visits[chatty] == [2, 5, 8, 11]
+    assert chatty.closed is None and silent.closed == WS_CLOSE_IDLE
+    assert visits[silent][-1] == 12 and manager.reaped == 1
+    # The silent socket got heartbeats at every visit before it was reaped
+    assert silent.frames == [{"type": "heartbeat"}] * (len(visits[silent]) - 1)
+    assert chatty.frames == []
+    assert silent not in manager.active_connections["1"]
+
+
+def test_replay_buffer_returns_frames_after_an_id_it_still_holds():
+    replay = _ReplayBuffer(size=3)
+    ids = []
+    for i in range(5):
+        replay.add(f'{{"n":{i}}}')
+        ids.append(replay.last_id)
+    # Holds events 3..5: resuming after 2, 3 or 4 works, after 1 events were lost
+    assert [frame.split("data: ")[1].strip() for frame in replay.since(ids[1])] == ['{"n":2}', '{"n":3}', '{"n":4}']
+    assert len(replay.since(ids[3])) == 1
+    assert replay.since(ids[4]) == []
+    assert replay.since(ids[0]) is None
+    assert replay.since(f"{replay.token}-9") is None
+    assert replay.since(f"{_ReplayBuffer(size=3).token}-4") is None
+    assert replay.since("garbage") is None
+
+
+def _queued(manager, bus_number, stream):
+    queue = manager.active_connections[bus_number][stream].queue
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+def test_stream_resumes_inside_the_buffer_and_falls_back_to_a_snapshot_otherwise():
+    async def run():
+        manager = WebSocketManager(conflation_ms=0, replay_size=4)
+        other_worker = WebSocketManager(conflation_ms=0, replay_size=4)
+        first, resumed = manager.connect_stream("1")
+        assert not resumed
+        for i in range(3):
+            await manager.broadcast_delay("1", {"delay_minutes": i})
+        frames = _queued(manager, "1", first)
+        after_first = frames[0].split("\n")[0][len("id: "):]
+        manager.disconnect(first, "1")
+
+        # Reconnect inside the buffer: the two missed events, no snapshot needed
+        assert manager.can_resume("1", after_first)
+        stream, resumed = manager.connect_stream("1", after_first)
+        assert resumed and _queued(manager, "1", stream) == frames[1:]
+        manager.disconnect(stream, "1")
+
+        # Older than the buffer
+        for i in range(3, 8):
+            await manager.broadcast_delay("1", {"delay_minutes": i})
+        assert not manager.can_resume("1", after_first)
+        stream, resumed = manager.connect_stream("1", after_first)
+        assert not resumed and _queued(manager, "1", stream) == []
+        manager.disconnect(stream, "1")
+
+        # An id issued by another worker's buffer, even with a seq this one has
+        other, _ = other_worker.connect_stream("1")
+        await other_worker.broadcast_delay("1", {"delay_minutes": 0})
+        foreign_id = _queued(other_worker, "1", other)[0].split("\n")[0][len("id: "):]
+        assert foreign_id.endswith("-1")
+        assert not manager.can_resume("1", foreign_id)
+        stream, resumed = manager.connect_stream("1", foreign_id)
+        assert not resumed
+        return manager.resumed_streams
+
+    assert asyncio.run(run()) == 1
@@ -16,6 +16,12 @@ interface DriverApi {
         @Header("X-Session-Token") token: String,
         @Body req: LocationUpdateRequest,
     ): Response<LocationResponse>
+
+    @POST("driver/locations")
+    suspend fun sendLocations(
+        @Header("X-Session-Token") token: String,
+        @Body req: LocationBatchRequest,
+    ): Response<LocationResponse>
 }
 
 data class LocationResponse(
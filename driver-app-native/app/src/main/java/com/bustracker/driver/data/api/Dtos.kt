@@ -17,3 +17,7 @@ data class LocationUpdateRequest(
     @SerializedName("longitude") val longitude: Double,
     @SerializedName("recorded_at") val recordedAt: String, // ISO-8601
 )
+
+data class LocationBatchRequest(
+    @SerializedName("locations") val locations: List<LocationUpdateRequest>, // oldest first
+)
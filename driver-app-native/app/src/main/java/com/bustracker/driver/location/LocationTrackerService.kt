@@ -18,6 +18,7 @@ import androidx.core.app.NotificationCompat
 import com.bustracker.driver.MainActivity
 import com.bustracker.driver.R
 import com.bustracker.driver.data.api.ApiClient
+import com.bustracker.driver.data.api.LocationBatchRequest
 import com.bustracker.driver.data.api.LocationUpdateRequest
 import com.bustracker.driver.data.prefs.AppPreferences
 import com.google.android.gms.location.FusedLocationProviderClient
@@ -33,6 +34,8 @@ import kotlinx.coroutines.cancel
 import kotlinx.coroutines.delay
 import kotlinx.coroutines.isActive
 import kotlinx.coroutines.launch
+import kotlinx.coroutines.sync.Mutex
+import kotlinx.coroutines.sync.withLock
 import kotlinx.coroutines.withContext
 import java.time.Instant
 
@@ -44,6 +47,10 @@ private const val MIN_INTERVAL_MS = 5_000L
 private const val MIN_DISTANCE_M = 0f
 private const val ALARM_CHECK_MS = 30_000L
 private const val ALARM_THRESHOLD_MS = 60_000L
+// Server limit for POST /driver/locations
+private const val MAX_BATCH = 500
+// Fixes kept while the server is unreachable (~5 h at INTERVAL_MS); the oldest are dropped beyond this
+private const val MAX_PENDING = 2_000
 
 class LocationTrackerService : Service() {
 
@@ -51,6 +58,11 @@ class LocationTrackerService : Service() {
     private lateinit var prefs: AppPreferences
     private var fusedClient: FusedLocationProviderClient? = null
     private var locationCallback: LocationCallback? = null
+    // Fixes not yet accepted by the server, oldest first; only touched under sendMutex
+    private val pending = ArrayDeque<LocationUpdateRequest>()
+    private val sendMutex = Mutex()
+    // Set from Retry-After on 503/429: fixes keep queuing but nothing is sent before this time
+    private var nextSendAtMs = 0L
 
     override fun onCreate() {
         super.onCreate()
@@ -166,37 +178,64 @@ class LocationTrackerService : Service() {
         }
     }
 
-    private fun formatRecordedAt(): String {
-        val s = Instant.now().toString()
+    private fun formatRecordedAt(timeMs: Long): String {
+        val s = Instant.ofEpochMilli(timeMs).toString()
         return if (s.contains(".") && s.length > 27) s.take(26) + "Z" else s
     }
 
     private suspend fun sendAndRecord(token: String, location: android.location.Location) =
         withContext(Dispatchers.IO) {
-            try {
+            // Stamped with the fix time, so fixes sent late from the backlog keep their real time
+            val fix = LocationUpdateRequest(
+                latitude = location.latitude,
+                longitude = location.longitude,
+                recordedAt = formatRecordedAt(if (location.time > 0) location.time else System.currentTimeMillis())
+            )
+            sendMutex.withLock {
+                pending.addLast(fix)
+                while (pending.size > MAX_PENDING) pending.removeFirst()
+                flushPending(token)
+            }
+        }
+
+    /** Send the backlog oldest first: one fix via /driver/location, more in batches via /driver/locations */
+    private suspend fun flushPending(token: String) {
+        if (System.currentTimeMillis() < nextSendAtMs) return
+        while (pending.isNotEmpty()) {
+            val chunk = pending.take(MAX_BATCH)
+            val res = try {
                 val api = ApiClient.api()
-                val req = LocationUpdateRequest(
-                    latitude = location.latitude,
-                    longitude = location.longitude,
-                    recordedAt = formatRecordedAt()
-                )
-                val res = api.sendLocation(token, req)
-                if (res.isSuccessful) {
-                    prefs.setLastLocationSentMs(System.currentTimeMillis())
-                    prefs.setLastSendError(null)
-                } else {
-                    val msg = when (res.code()) {
-                        401 -> "Session expired - log in again"
-                        404, 500 -> "Server error (${res.code()})"
-                        else -> "Failed to send (${res.code()})"
-                    }
-                    prefs.setLastSendError(msg)
-                }
+                if (chunk.size == 1) api.sendLocation(token, chunk[0])
+                else api.sendLocations(token, LocationBatchRequest(locations = chunk))
             } catch (e: Exception) {
-                val msg = "Cannot reach server - check API URL and internet"
-                prefs.setLastSendError(msg)
+                // Offline: keep everything and retry with the next fix
+                prefs.setLastSendError("Cannot reach server - check API URL and internet")
+                return
             }
+            if (res.isSuccessful) {
+                repeat(chunk.size) { pending.removeFirst() }
+                prefs.setLastLocationSentMs(System.currentTimeMillis())
+                prefs.setLastSendError(null)
+                continue
+            }
+            val msg = when (res.code()) {
+                401 -> "Session expired - log in again"
+                404, 500 -> "Server error (${res.code()})"
+                503 -> "Server busy - fixes kept and resent shortly"
+                else -> "Failed to send (${res.code()})"
+            }
+            prefs.setLastSendError(msg)
+            if (res.code() == 503 || res.code() == 429) {
+                val retryAfterS = res.headers()["Retry-After"]?.trim()?.toLongOrNull() ?: 1L
+                nextSendAtMs = System.currentTimeMillis() + retryAfterS.coerceIn(1L, 300L) * 1000
+            }
+            // Other client errors reject the fixes themselves; resending them cannot succeed
+            if (res.code() in 400..499 && res.code() !in listOf(401, 408, 429)) {
+                repeat(chunk.size) { pending.removeFirst() }
+            }
+            return
         }
+    }
 
     private fun stopLocationUpdates() {
         locationCallback?.let { fusedClient?.removeLocationUpdates(it) }